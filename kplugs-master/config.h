@@ -4,7 +4,7 @@
 #define CONFIG
 
 #define VERSION_MAJOR		(1)
-#define VERSION_MINOR		(0)
+#define VERSION_MINOR		(1)
 
 #define MAX_RECUR			(20)
 #define MAX_CALL_RECUR		(30)
@@ -16,6 +16,25 @@
 
 #define STACK_MAX_PARAMETERS (15)
 
+#define KPLUGS_ARENA_MAX	(0x1000000)
+
+/* the mmap offsets of the events rings of a file and of the global events rings (past any arena) */
+#define KPLUGS_EVENTS_OFFSET		(0x10000000)
+#define KPLUGS_GLOBAL_EVENTS_OFFSET	(0x20000000)
+
+/* must be a power of two */
+#define CONTEXT_HASH_SIZE	(64)
+
+/* the maximum number of maps in a context, and of keys in a map */
+#define CONTEXT_MAX_MAPS	(64)
+#define KPLUGS_MAP_MAX		(0x100000)
+
+/* the maximum number of functions in a module that is loaded or unloaded with one command */
+#define KPLUGS_MODULE_MAX	(0x1000)
+
+/* define PROFILING to count calls, run times and executed opcodes of functions that were loaded with FUNC_PROFILE
+ * (the debug build defines it). without it the vm has no instrumentation at all */
+
 #ifdef DEBUG
 
 #define DEBUG_PRINT(...) output_string(__VA_ARGS__)
@@ -4,6 +4,69 @@
 #include "vm.h"
 #include "types.h"
 
+extern context_t *GLOBAL_CONTEXT;
+
+/* the resolved call targets are valid only while this generation doesn't change.
+ * the vm takes the lock when it resolves a call, and it may run in an interrupt (hooks and ipis), so interrupts are disabled under it */
+static spinlock_t calls_lock;
+static word calls_gen;
+
+/* start the contexts - makes sure all the structures are initialized */
+void context_start(void)
+{
+	spin_lock_init(&calls_lock);
+	calls_gen = 1;
+}
+
+/* invalidate every resolved call target */
+void context_invalidate_calls(void)
+{
+	unsigned long flags;
+
+	spin_lock_irqsave(&calls_lock, flags);
+	calls_gen++;
+	spin_unlock_irqrestore(&calls_lock, flags);
+}
+
+/* the hash of a function's name */
+static word context_hash_name(const char *name)
+{
+	word hash = 5381;
+
+	while (*name) {
+		hash = (hash * 33) ^ (byte)*name;
+		name++;
+	}
+
+	return hash & (CONTEXT_HASH_SIZE - 1);
+}
+
+/* the hash of a function's address */
+static word context_hash_handle(byte *ptr)
+{
+	return (((word)ptr) / sizeof(word)) & (CONTEXT_HASH_SIZE - 1);
+}
+
+/* add a node to a hash chain (the context must be locked) */
+static void context_hash_add(hash_node_t **head, hash_node_t *node)
+{
+	node->next = *head;
+	rcu_assign_pointer(*head, node);
+}
+
+/* remove a node from a hash chain (the context must be locked).
+ * the node keeps its next pointer, so lookups that are still on it can continue */
+static void context_hash_remove(hash_node_t **head, hash_node_t *node)
+{
+	while (*head != NULL) {
+		if (*head == node) {
+			rcu_assign_pointer(*head, node->next);
+			return;
+		}
+		head = &(*head)->next;
+	}
+}
+
 /* create a new context */
 int context_create(context_t **cont)
 {
@@ -13,12 +76,18 @@ int context_create(context_t **cont)
 		ERROR(-ERROR_MEM);
 	}
 
+	memory_set((*cont)->names, 0, sizeof((*cont)->names));
+	memory_set((*cont)->handles, 0, sizeof((*cont)->handles));
 	(*cont)->funcs.next = NULL;
 	(*cont)->funcs.prev = NULL;
 	(*cont)->anonym.next = NULL;
 	(*cont)->anonym.prev = NULL;
 	(*cont)->has_answer = 0;
 	(*cont)->last_exception.had_exception = 0;
+	(*cont)->arena = NULL;
+	(*cont)->arena_size = 0;
+	(*cont)->events = NULL;
+	memory_set((*cont)->maps, 0, sizeof((*cont)->maps));
 	spin_lock_init(&(*cont)->lock);
 
 	return 0;
@@ -36,25 +105,29 @@ void context_unlock(context_t *cont)
 	spin_unlock(&cont->lock);
 }
 
-/* add a function to a context */
-int context_add_function(context_t *cont, function_t *func)
+/* check that a function's name doesn't exist in a context (the context must be locked) */
+static int context_check_name(context_t *cont, function_t *func)
 {
 	function_t *check_func = NULL;
-	int err = 0;
+	hash_node_t *node;
 
-	context_lock(cont);
+	node = cont->names[context_hash_name(func->name)];
+	while (node != NULL) {
+		check_func = LIST_TO_STRUCT(function_t, name_node, node);
+		if (!string_compare(check_func->name, func->name)) {
+			ERROR(-ERROR_FEXIST);
+		}
+		node = node->next;
+	}
+
+	return 0;
+}
 
+/* add a function to the context (the context must be locked) */
+static void context_link_function(context_t *cont, function_t *func)
+{
 	if (func->name != NULL) {
 		/* this is a function with a name */
-		check_func = LIST_TO_STRUCT(function_t, list, cont->funcs.next);
-
-		/* check that we don't have this function's name already */
-		while (check_func != NULL) {
-			if (!string_compare(check_func->name, func->name)) {
-				ERROR_CLEAN(-ERROR_FEXIST);
-			}
-			check_func = LIST_TO_STRUCT(function_t, list, check_func->list.next);
-		}
 
 		/* add the function to the funcs list */
 		func->list.next = cont->funcs.next;
@@ -80,21 +153,64 @@ int context_add_function(context_t *cont, function_t *func)
 
 	func->cont = cont;
 
+	/* publish the function to the lookups */
+	if (func->name != NULL) {
+		context_hash_add(&cont->names[context_hash_name(func->name)], &func->name_node);
+	}
+	context_hash_add(&cont->handles[context_hash_handle(func->func_code)], &func->handle_node);
+}
+
+/* add a function to a context */
+int context_add_function(context_t *cont, function_t *func)
+{
+	return context_add_functions(cont, &func, 1);
+}
+
+/* add functions to a context together. if one of the names already exists none of them is added */
+int context_add_functions(context_t *cont, function_t **funcs, word num)
+{
+	word iter, other;
+	int err = 0;
+
+	context_lock(cont);
+
+	/* check that we don't have the functions' names already (in the context or in the other functions) */
+	for (iter = 0; iter < num; ++iter) {
+		if (funcs[iter]->name == NULL) {
+			continue;
+		}
+
+		err = context_check_name(cont, funcs[iter]);
+		CHECK_ERROR(err);
+
+		for (other = 0; other < iter; ++other) {
+			if (funcs[other]->name != NULL && !string_compare(funcs[other]->name, funcs[iter]->name)) {
+				ERROR_CLEAN(-ERROR_FEXIST);
+			}
+		}
+	}
+
+	/* the functions are published under the same lock, so no one sees only some of them */
+	for (iter = 0; iter < num; ++iter) {
+		context_link_function(cont, funcs[iter]);
+	}
+
+	/* the new functions may hide global functions with the same names */
+	context_invalidate_calls();
+
 clean:
 	context_unlock(cont);
 	return err;
 }
 
-/* remove and delete a function from the context */
-void context_free_function(function_t *func)
+/* remove a function from the context (the context must be locked). returns 0 if it was already removed */
+static int context_unlink_function(function_t *func)
 {
 	context_t *cont = func->cont;
 
-	context_lock(cont);
-
-	if (NULL == func->list.prev && NULL == func->list.next) {
+	if (NULL == func->list.prev) {
 		/* This is a race condition! The function was already removed from the context... */
-		goto clean;
+		return 0;
 	}
 
 	func->list.prev->next = func->list.next;
@@ -105,22 +221,146 @@ void context_free_function(function_t *func)
 	func->list.prev = NULL;
 	func->list.next = NULL;
 
-	function_put(func);
+	if (func->name != NULL) {
+		context_hash_remove(&cont->names[context_hash_name(func->name)], &func->name_node);
+	}
+	context_hash_remove(&cont->handles[context_hash_handle(func->func_code)], &func->handle_node);
+
+	/* no one should call this function through a resolved call anymore */
+	context_invalidate_calls();
+
+	return 1;
+}
+
+/* drop the context's reference to a function that was removed from it */
+static void context_put_function(struct rcu_head *head)
+{
+	function_put(LIST_TO_STRUCT(function_t, rcu, head));
+}
+
+/* remove and delete a function from the context */
+void context_free_function(function_t *func)
+{
+	context_t *cont = func->cont;
+	int removed;
+
+	context_lock(cont);
+	removed = context_unlink_function(func);
+	context_unlock(cont);
+
+	if (removed) {
+		/* drop the context's reference after the lookups that may still see the function, without waiting for them */
+		call_rcu(&func->rcu, context_put_function);
+	}
+}
+
+/* remove and delete functions from a context by their handles, together. if one of the handles
+ * is not found none of them is removed */
+int context_free_functions(context_t *cont, byte **handles, word num)
+{
+	function_t **funcs;
+	hash_node_t *node;
+	word iter;
+	int err = 0;
+
+	funcs = memory_alloc(num * sizeof(function_t *));
+	if (NULL == funcs) {
+		ERROR(-ERROR_MEM);
+	}
+
+	context_lock(cont);
+
+	/* find all the functions before we remove any of them */
+	for (iter = 0; iter < num; ++iter) {
+		funcs[iter] = NULL;
+
+		node = cont->handles[context_hash_handle(handles[iter])];
+		while (node != NULL) {
+			if (LIST_TO_STRUCT(function_t, handle_node, node)->func_code == handles[iter]) {
+				funcs[iter] = LIST_TO_STRUCT(function_t, handle_node, node);
+				break;
+			}
+			node = node->next;
+		}
+
+		if (NULL == funcs[iter]) {
+			context_unlock(cont);
+			ERROR_CLEAN(-ERROR_UFUNC);
+		}
+	}
+
+	for (iter = 0; iter < num; ++iter) {
+		if (!context_unlink_function(funcs[iter])) {
+			/* the same handle appeared twice */
+			funcs[iter] = NULL;
+		}
+	}
 
-clean:
 	context_unlock(cont);
+
+	/* wait only once for the lookups that may still see the functions */
+	synchronize_rcu();
+
+	for (iter = 0; iter < num; ++iter) {
+		if (NULL != funcs[iter]) {
+			function_put(funcs[iter]);
+		}
+	}
+
+clean:
+	memory_free(funcs);
+	return err;
 }
 
 /* delete a context */
 void context_free(context_t *cont)
 {
+	list_head_t removed;
+	function_t *func;
+	events_t *events = cont->events;
+	hashmap_t *maps[CONTEXT_MAX_MAPS];
+	word index;
+
 	/* we don't need to lock because this is called only when we free the context anyway */
 
-	while (cont->funcs.next != NULL) {
-		context_free_function(LIST_TO_STRUCT(function_t, list, cont->funcs.next));
+	/* functions that still run may emit or use the maps until the rcu wait below */
+	rcu_assign_pointer(cont->events, NULL);
+	for (index = 0; index < CONTEXT_MAX_MAPS; ++index) {
+		maps[index] = cont->maps[index];
+		rcu_assign_pointer(cont->maps[index], NULL);
+	}
+
+	/* remove all the functions, and wait only once for the lookups that may still see them */
+	removed.next = NULL;
+	while (cont->funcs.next != NULL || cont->anonym.next != NULL) {
+		func = LIST_TO_STRUCT(function_t, list, (cont->funcs.next != NULL) ? cont->funcs.next : cont->anonym.next);
+		context_unlink_function(func);
+
+		func->list.next = removed.next;
+		removed.next = &func->list;
+	}
+
+	synchronize_rcu();
+
+	while (removed.next != NULL) {
+		func = LIST_TO_STRUCT(function_t, list, removed.next);
+		removed.next = func->list.next;
+		func->list.next = NULL;
+		function_put(func);
+	}
+
+	if (NULL != cont->arena) {
+		memory_free_shared(cont->arena, cont->arena_size);
 	}
-	while (cont->anonym.next != NULL) {
-		context_free_function(LIST_TO_STRUCT(function_t, list, cont->anonym.next));
+
+	if (NULL != events) {
+		events_free(events);
+	}
+
+	for (index = 0; index < CONTEXT_MAX_MAPS; ++index) {
+		if (NULL != maps[index]) {
+			hashmap_free(maps[index]);
+		}
 	}
 
 	memory_free(cont);
@@ -129,45 +369,155 @@ void context_free(context_t *cont)
 /* find a function by name */
 void *context_find_function(context_t *cont, byte *name)
 {
-	function_t *func;
-	
-	context_lock(cont);
+	function_t *func = NULL;
+	hash_node_t *node;
 
-	func = LIST_TO_STRUCT(function_t, list, cont->funcs.next);
-	while (func != NULL) {
+	rcu_read_lock();
+
+	node = rcu_dereference(cont->names[context_hash_name((char *)name)]);
+	while (node != NULL) {
+		func = LIST_TO_STRUCT(function_t, name_node, node);
 		if (!string_compare(func->name, (char *)name)) {
 			function_get(func);
 			goto clean;
 		}
-		func = LIST_TO_STRUCT(function_t, list, func->list.next);
+		node = rcu_dereference(node->next);
 	}
+	func = NULL;
 
 clean:
-	context_unlock(cont);
+	rcu_read_unlock();
 	return func;
 }
 
-/* find an anonymous function by address */
-void *context_find_anonymous(context_t *cont, byte *ptr)
+/* find a function by its address (its handle) */
+void *context_find_handle(context_t *cont, byte *ptr)
 {
-	function_t *func;
+	function_t *func = NULL;
+	hash_node_t *node;
 
-	context_lock(cont);
+	rcu_read_lock();
 
-	func = LIST_TO_STRUCT(function_t, list, cont->anonym.next);
-	while (func != NULL) {
+	node = rcu_dereference(cont->handles[context_hash_handle(ptr)]);
+	while (node != NULL) {
+		func = LIST_TO_STRUCT(function_t, handle_node, node);
 		if (func->func_code == ptr) {
 			function_get(func);
 			goto clean;
 		}
-		func = LIST_TO_STRUCT(function_t, list, func->list.next);
+		node = rcu_dereference(node->next);
 	}
+	func = NULL;
 
 clean:
-	context_unlock(cont);
+	rcu_read_unlock();
 	return func;
 }
 
+/* find an anonymous function by address */
+void *context_find_anonymous(context_t *cont, byte *ptr)
+{
+	function_t *func = context_find_handle(cont, ptr);
+
+	if (NULL != func && NULL != func->name) {
+		/* it's not an anonymous function */
+		function_put(func);
+		func = NULL;
+	}
+
+	return func;
+}
+
+/* find the external function that a function calls by a string */
+void *context_resolve_external(function_t *func, word string)
+{
+	call_slot_t *slot = &func->call_slots[string - 1];
+	void *found;
+	word gen;
+	unsigned long flags;
+
+	/* the slot is written under the calls lock: first the target, then its generation */
+	gen = ACCESS_ONCE(slot->gen);
+	smp_rmb();
+	found = ACCESS_ONCE(slot->external);
+	smp_rmb();
+
+	if (NULL != found && gen == ACCESS_ONCE(calls_gen)) {
+		return found;
+	}
+
+	gen = ACCESS_ONCE(calls_gen);
+	smp_rmb();
+
+	found = find_external_function(func->raw + func->string_table[string - 1]);
+	if (NULL == found) {
+		return NULL;
+	}
+
+	spin_lock_irqsave(&calls_lock, flags);
+	if (calls_gen == gen) {
+		slot->external = found;
+		slot->internal = NULL;
+		smp_wmb();
+		slot->gen = gen;
+	}
+	spin_unlock_irqrestore(&calls_lock, flags);
+
+	return found;
+}
+
+/* find the internal function that a function calls by a string */
+function_t *context_resolve_function(function_t *func, word string)
+{
+	call_slot_t *slot = &func->call_slots[string - 1];
+	byte *name = func->raw + func->string_table[string - 1];
+	function_t *found;
+	word gen;
+	unsigned long flags;
+
+	rcu_read_lock();
+
+	/* the slot is written under the calls lock: first the target, then its generation */
+	gen = ACCESS_ONCE(slot->gen);
+	smp_rmb();
+	found = ACCESS_ONCE(slot->internal);
+	smp_rmb();
+
+	if (NULL != found && gen == ACCESS_ONCE(calls_gen)) {
+		/* the function wasn't removed when we checked the generation, so it can't be freed before we leave the rcu section */
+		function_get(found);
+		rcu_read_unlock();
+		return found;
+	}
+
+	rcu_read_unlock();
+
+	/* the generation is taken before the lookup, so if a function is removed after it we won't keep it */
+	gen = ACCESS_ONCE(calls_gen);
+	smp_rmb();
+
+	found = context_find_function(func->cont, name);
+	if (NULL == found) {
+		if (NULL != GLOBAL_CONTEXT && func->cont != GLOBAL_CONTEXT) {
+			found = context_find_function(GLOBAL_CONTEXT, name);
+		}
+		if (NULL == found) {
+			return NULL;
+		}
+	}
+
+	spin_lock_irqsave(&calls_lock, flags);
+	if (calls_gen == gen) {
+		slot->internal = found;
+		slot->external = NULL;
+		smp_wmb();
+		slot->gen = gen;
+	}
+	spin_unlock_irqrestore(&calls_lock, flags);
+
+	return found;
+}
+
 /* copy the reply back to the user */
 int context_get_reply(context_t *cont, char *buf, word length)
 {
@@ -189,6 +539,160 @@ int context_get_reply(context_t *cont, char *buf, word length)
 	return (int)copy;
 }
 
+/* create the context's arena */
+int context_create_arena(context_t *cont, word size, byte **arena)
+{
+	byte *new_arena;
+	int err = 0;
+
+	new_arena = memory_alloc_shared(size);
+	if (NULL == new_arena) {
+		ERROR(-ERROR_MEM);
+	}
+
+	context_lock(cont);
+
+	/* a context has only one arena, because the user may have already mapped it */
+	if (NULL != cont->arena) {
+		context_unlock(cont);
+		memory_free_shared(new_arena, size);
+		ERROR(-ERROR_PARAM);
+	}
+
+	cont->arena = new_arena;
+	cont->arena_size = size;
+	*arena = new_arena;
+
+	context_unlock(cont);
+	return err;
+}
+
+/* create the context's events rings. if the global context already has them, they are shared */
+int context_create_events(context_t *cont, word ring_size, word flags, word *size)
+{
+	events_t *new_events;
+	int err = 0;
+
+	err = events_create(&new_events, ring_size, flags);
+	if (err < 0) {
+		ERROR(err);
+	}
+
+	context_lock(cont);
+
+	if (NULL != cont->events) {
+		err = (cont == GLOBAL_CONTEXT) ? 0 : -ERROR_PARAM;
+		*size = cont->events->size;
+		context_unlock(cont);
+		events_free(new_events);
+		ERROR(err);
+	}
+
+	rcu_assign_pointer(cont->events, new_events);
+	*size = new_events->size;
+
+	context_unlock(cont);
+	return err;
+}
+
+/* create a map in a context */
+int context_create_map(context_t *cont, word capacity, hashmap_t **map)
+{
+	hashmap_t *new_map;
+	word index;
+	int err = 0;
+
+	err = hashmap_create(&new_map, capacity);
+	if (err < 0) {
+		ERROR(err);
+	}
+
+	context_lock(cont);
+
+	for (index = 0; index < CONTEXT_MAX_MAPS; ++index) {
+		if (NULL == cont->maps[index]) {
+			rcu_assign_pointer(cont->maps[index], new_map);
+			*map = new_map;
+
+			context_unlock(cont);
+			return err;
+		}
+	}
+
+	/* the context has too many maps */
+	context_unlock(cont);
+	hashmap_free(new_map);
+	ERROR(-ERROR_MEM);
+}
+
+/* find a map by its handle (must be called inside an rcu read lock) */
+hashmap_t *context_find_map(context_t *cont, byte *ptr)
+{
+	hashmap_t *map;
+	word index;
+
+	for (index = 0; index < CONTEXT_MAX_MAPS; ++index) {
+		map = rcu_dereference(cont->maps[index]);
+		if ((byte *)map == ptr && NULL != map) {
+			return map;
+		}
+	}
+
+	return NULL;
+}
+
+/* delete a map by its handle */
+int context_delete_map(context_t *cont, byte *ptr)
+{
+	hashmap_t *map = NULL;
+	word index;
+
+	context_lock(cont);
+
+	for (index = 0; index < CONTEXT_MAX_MAPS; ++index) {
+		if ((byte *)cont->maps[index] == ptr && NULL != ptr) {
+			map = cont->maps[index];
+			rcu_assign_pointer(cont->maps[index], NULL);
+			break;
+		}
+	}
+
+	context_unlock(cont);
+
+	if (NULL == map) {
+		ERROR(-ERROR_PARAM);
+	}
+
+	/* wait for the functions that may still use the map */
+	synchronize_rcu();
+	hashmap_free(map);
+
+	return 0;
+}
+
+/* take the reply (and the last exception if excep isn't NULL). returns 1 if there was a reply */
+int context_take_reply(context_t *cont, kplugs_command_t *cmd, exception_t *excep)
+{
+	int has_answer;
+
+	context_lock(cont);
+
+	has_answer = cont->has_answer;
+	if (has_answer) {
+		memory_copy(cmd, &cont->cmd, sizeof(kplugs_command_t));
+		cont->has_answer = 0;
+	}
+
+	if (NULL != excep) {
+		memory_copy(excep, &cont->last_exception, sizeof(exception_t));
+		cont->last_exception.had_exception = 0;
+	}
+
+	context_unlock(cont);
+
+	return has_answer;
+}
+
 /* copy the last exception to inside or outside memory */
 int context_get_last_exception(context_t *cont, exception_t *excep)
 {
@@ -3,6 +3,8 @@
 
 #include "types.h"
 #include "env.h"
+#include "events.h"
+#include "hashmap.h"
 
 #ifndef __user
 #define __user
@@ -16,6 +18,17 @@ typedef enum {
 	KPLUGS_UNLOAD,
 	KPLUGS_UNLOAD_ANONYMOUS,
 	KPLUGS_GET_LAST_EXCEPTION,
+	KPLUGS_EXECUTE_BATCH,
+	KPLUGS_CREATE_ARENA,
+	KPLUGS_EXECUTE_HANDLE,
+	KPLUGS_GET_STATS,
+	KPLUGS_CREATE_EVENTS,
+	KPLUGS_CREATE_MAP,
+	KPLUGS_DUMP_MAP,
+	KPLUGS_DELETE_MAP,
+	KPLUGS_EXECUTE_CPUS,
+	KPLUGS_LOAD_MODULE,
+	KPLUGS_UNLOAD_MODULE,
 } kplugs_command_types_t;
 
 
@@ -44,6 +57,36 @@ typedef struct {
 } kplugs_command_t;
 
 
+/* the images are compact (in len2 of a KPLUGS_LOAD command, and in the first word of a KPLUGS_LOAD_MODULE module) */
+#define KPLUGS_LOAD_COMPACT	(1)
+
+/* the arguments of a KPLUGS_EXECUTE_BATCH command */
+typedef struct {
+	word rows;
+	word cols;
+
+	word __user *args;			/* rows * cols arguments */
+	word __user *results;		/* the return value of every row */
+	word __user *exceptions;	/* the exception of every row (0 if there was none) */
+} kplugs_batch_t;
+
+/* run the function of a KPLUGS_EXECUTE_CPUS command from an ipi (instead of a worker on every cpu) */
+#define KPLUGS_CPUS_IPI		(1)
+
+/* the arguments of a KPLUGS_EXECUTE_CPUS command */
+typedef struct {
+	word num_args;
+	word num_cpus;				/* the number of cpus in the mask and in the results */
+	word flags;
+
+	word __user *args;			/* the arguments of the function */
+	word __user *mask;			/* a bit for every cpu to run on (NULL for all the cpus) */
+	word __user *results;		/* the return value on every cpu */
+	word __user *exceptions;	/* the exception on every cpu (0 if there was none) */
+	word __user *ran;			/* 1 for every cpu that the function ran on */
+} kplugs_cpus_t;
+
+
 typedef struct {
 	byte had_exception;
 	word value;
@@ -51,17 +94,45 @@ typedef struct {
 	word pc;
 } exception_t;
 
+/* the argument of the command ioctl */
+typedef struct {
+	kplugs_command_t cmd;	/* the command, and its reply when the ioctl returns */
+	word error;				/* the error of the command (0 if it succeeded) */
+	word has_reply;			/* the command created a reply */
+	exception_t excep;		/* the exception, if the command failed because of one */
+} kplugs_ioctl_t;
+
 typedef struct {
 	list_head_t funcs;
 	list_head_t anonym;
 
+	/* the lookup tables (read with rcu, written under the lock) */
+	hash_node_t *names[CONTEXT_HASH_SIZE];		/* functions with a name by their name */
+	hash_node_t *handles[CONTEXT_HASH_SIZE];	/* all the functions by their address */
+
 	spinlock_t lock;
 
 	byte has_answer;
 	kplugs_command_t cmd;
 	exception_t last_exception;
+
+	/* a memory that is shared with the user (with mmap) */
+	byte *arena;
+	word arena_size;
+
+	/* the rings of the records that functions emit (read with rcu, mapped by the user) */
+	events_t *events;
+
+	/* the maps that functions use by their handles (read with rcu, written under the lock) */
+	hashmap_t *maps[CONTEXT_MAX_MAPS];
 } context_t;
 
+/* start the contexts - makes sure all the structures are initialized */
+void context_start(void);
+
+/* invalidate every resolved call target */
+void context_invalidate_calls(void);
+
 /* create a new context */
 int context_create(context_t **cont);
 /* delete a context */
@@ -77,6 +148,21 @@ void context_unlock(context_t *cont);
 void *context_find_function(context_t *cont, byte *name);
 /* find an anonymous function by address */
 void *context_find_anonymous(context_t *cont, byte *ptr);
+/* find a function by its address (its handle) */
+void *context_find_handle(context_t *cont, byte *ptr);
+
+/* create the context's arena */
+int context_create_arena(context_t *cont, word size, byte **arena);
+
+/* create the context's events rings (size gets the size of their memory) */
+int context_create_events(context_t *cont, word ring_size, word flags, word *size);
+
+/* create a map in a context */
+int context_create_map(context_t *cont, word capacity, hashmap_t **map);
+/* find a map by its handle (must be called inside an rcu read lock) */
+hashmap_t *context_find_map(context_t *cont, byte *ptr);
+/* delete a map by its handle */
+int context_delete_map(context_t *cont, byte *ptr);
 
 /* copy the last exception to inside or outside memory */
 int context_get_last_exception(context_t *cont, exception_t *excep);
@@ -84,6 +170,9 @@ int context_get_last_exception(context_t *cont, exception_t *excep);
 /* copy the reply back to the user */
 int context_get_reply(context_t *cont, char *buf, word length);
 
+/* take the reply (and the last exception if excep isn't NULL). returns 1 if there was a reply */
+int context_take_reply(context_t *cont, kplugs_command_t *cmd, exception_t *excep);
+
 /* create a reply */
 void context_create_reply(context_t *cont, word val, exception_t *excep);
 
@@ -10,6 +10,7 @@
 #include <linux/module.h>
 #include <linux/uaccess.h>
 #include <linux/slab.h>
+#include <linux/ktime.h>
 
 #ifdef USE_KALLSYMS
 #include <linux/kallsyms.h>
@@ -22,6 +23,7 @@ MODULE_LICENSE("GPL");
 #include <stdio.h>
 #include <malloc.h>
 #include <string.h>
+#include <time.h>
 
 /* for dlsym() */
 #define	__USE_GNU
@@ -136,6 +138,19 @@ void *find_external_function(const byte *name)
 #endif
 }
 
+/* get a monotonic time in nanoseconds */
+word time_get_ns(void)
+{
+#ifdef __KERNEL__
+	return (word)ktime_to_ns(ktime_get());
+#else
+	struct timespec now;
+
+	clock_gettime(CLOCK_MONOTONIC, &now);
+	return (word)now.tv_sec * 1000000000 + now.tv_nsec;
+#endif
+}
+
 #ifndef __KERNEL__
 
 /* the user mode version is just for testing, AND IS NOT THREAD SAFE */
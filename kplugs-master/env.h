@@ -47,12 +47,17 @@ int string_len(const char *s);
 /* find an external function by its name */
 void *find_external_function(const byte *name);
 
+/* get a monotonic time in nanoseconds */
+word time_get_ns(void);
+
 
 /* functions to print to a standard output */
 #ifdef __KERNEL__
 
 #include <linux/kernel.h>
 #include <linux/spinlock.h>
+#include <linux/seqlock.h>
+#include <linux/rcupdate.h>
 
 #define output_string(...) printk(__VA_ARGS__)
 
@@ -71,11 +76,38 @@ typedef word atomic_t;
 #define spin_lock_init(lock)
 #define spin_lock(lock)
 #define spin_unlock(lock)
+#define spin_lock_irqsave(lock, flags)			do { (flags) = 0; } while (0)
+#define spin_unlock_irqrestore(lock, flags)	do { (void)(flags); } while (0)
+
+typedef word seqcount_t;
+
+#define seqcount_init(seq)
+#define read_seqcount_begin(seq)		(*(seq))
+#define read_seqcount_retry(seq, start)	((void)(start), 0)
+#define write_seqcount_begin(seq)		do { ++(*(seq)); } while (0)
+#define write_seqcount_end(seq)			do { ++(*(seq)); } while (0)
 
 #define atomic_set(atom, val) 		do { (*(atom))=val; } while (0)
 #define atomic_inc(atom)			do { ++(*(atom)); } while (0)
 inline int atomic_dec_and_test(atomic_t *atom);
 
+#define rcu_read_lock()
+#define rcu_read_unlock()
+#define synchronize_rcu()
+#define rcu_dereference(p)			(p)
+#define rcu_assign_pointer(p, val)	do { (p) = (val); } while (0)
+
+struct rcu_head {
+	struct rcu_head *next;
+};
+
+#define call_rcu(head, func)		(func)(head)
+#define rcu_barrier()
+
+#define ACCESS_ONCE(x)				(x)
+#define smp_rmb()
+#define smp_wmb()
+
 #endif
 
 #include "memory.h"
@@ -97,6 +129,10 @@ inline int atomic_dec_and_test(atomic_t *atom);
 #define MAX(a,b) ((a) > (b) ? (a) : (b))
 #endif
 
+#ifndef MIN
+#define MIN(a,b) ((a) < (b) ? (a) : (b))
+#endif
+
 #define ERROR_PRINT(n) DEBUG_PRINT("ERROR %d: in line %d of file \"%s\"\n", n, __LINE__, __FILE__)
 
 #define ERROR(n) if (n) { \
@@ -0,0 +1,222 @@
+#include "config.h"
+#include "types.h"
+#include "env.h"
+#include "memory.h"
+#include "events.h"
+
+#ifdef __KERNEL__
+
+#include <linux/kernel.h>
+#include <linux/smp.h>
+#include <linux/irqflags.h>
+
+/* wake the readers of the events */
+static void events_wake(struct irq_work *work)
+{
+	events_t *events = LIST_TO_STRUCT(events_t, work, work);
+
+	wake_up_interruptible(&events->wait);
+}
+
+#define events_num_cpus() ((word)nr_cpu_ids)
+
+#else
+
+/* the user mode version has only one cpu */
+#define events_num_cpus() (1)
+
+#define local_irq_save(flags)		do { (flags) = 0; } while (0)
+#define local_irq_restore(flags)	do { (void)(flags); } while (0)
+#define smp_processor_id()			(0)
+#define smp_mb()
+
+#endif
+
+/* create the events rings (ring_size must be a power of two) */
+int events_create(events_t **events, word ring_size, word flags)
+{
+	events_t *new_events;
+	word num_rings = events_num_cpus();
+	int err = 0;
+
+	new_events = memory_alloc(sizeof(events_t));
+	if (NULL == new_events) {
+		ERROR(-ERROR_MEM);
+	}
+	memory_set(new_events, 0, sizeof(events_t));
+
+	new_events->num_rings = num_rings;
+	new_events->ring_size = ring_size;
+	new_events->flags = flags;
+
+	/* the info page, and then a page with the header of every ring before its data */
+	new_events->size = PAGE_SIZE + num_rings * (PAGE_SIZE + ring_size);
+	new_events->mem = memory_alloc_shared(new_events->size);
+	if (NULL == new_events->mem) {
+		ERROR_CLEAN(-ERROR_MEM);
+	}
+
+	new_events->busy = memory_alloc(num_rings * sizeof(word));
+	if (NULL == new_events->busy) {
+		ERROR_CLEAN(-ERROR_MEM);
+	}
+	memory_set(new_events->busy, 0, num_rings * sizeof(word));
+
+	new_events->info = (events_info_t *)new_events->mem;
+	new_events->info->num_rings = num_rings;
+	new_events->info->ring_size = ring_size;
+	new_events->info->flags = flags;
+
+#ifdef __KERNEL__
+	init_waitqueue_head(&new_events->wait);
+	init_irq_work(&new_events->work, events_wake);
+#endif
+
+	*events = new_events;
+	return 0;
+
+clean:
+	if (NULL != new_events->mem) {
+		memory_free_shared(new_events->mem, new_events->size);
+	}
+	memory_free(new_events);
+	return err;
+}
+
+/* delete the events rings (nobody may emit to them anymore) */
+void events_free(events_t *events)
+{
+#ifdef __KERNEL__
+	irq_work_sync(&events->work);
+#endif
+
+	memory_free_shared(events->mem, events->size);
+	memory_free(events->busy);
+	memory_free(events);
+}
+
+/* copy memory to a position in the data of a ring */
+static void events_ring_write(byte *data, word ring_size, word pos, void *src, word len)
+{
+	word offset = pos & (ring_size - 1);
+	word first = MIN(len, ring_size - offset);
+
+	memory_copy(data + offset, src, first);
+	if (len > first) {
+		memory_copy(data, ((byte *)src) + first, len - first);
+	}
+}
+
+/* write a record to the ring of the current cpu. returns 1 if it was written and 0 if it was dropped */
+int events_emit(events_t *events, byte *buf, word len)
+{
+	events_ring_t *ring;
+	byte *data;
+	unsigned long irq_flags;
+	word ring_size = events->ring_size;
+	word need = sizeof(word) + ROUNDUP(len, sizeof(word));
+	word checked = len;
+	word head;
+	word tail;
+	word start;
+	word rec;
+	word cpu;
+	int ret = 0;
+
+	if (need > ring_size) {
+		/* the record would never fit */
+		ERROR(-ERROR_PARAM);
+	}
+
+	/* the record is copied with the interrupts disabled, so it can't map outside memory */
+	if (len && (memory_check_addr_perm(buf, &checked, 0, NULL) != ADDR_INSIDE || checked < len)) {
+		ERROR(-ERROR_POINT);
+	}
+
+	local_irq_save(irq_flags);
+
+	cpu = smp_processor_id();
+	ring = EVENTS_RING(events, cpu);
+	data = EVENTS_RING_DATA(events, cpu);
+
+	if (events->busy[cpu]) {
+		/* an nmi in the middle of another record */
+		ring->lost++;
+		goto end;
+	}
+	events->busy[cpu] = 1;
+
+	/* the positions in the shared memory may have been changed by the user, so they are never trusted */
+	head = ROUNDDOWN(ring->head, sizeof(word));
+	tail = ACCESS_ONCE(ring->tail);
+
+	if (events->flags & EVENTS_OVERWRITE) {
+		start = ring->start;
+
+		/* the records that were already read don't have to be kept */
+		if (tail - start <= head - start) {
+			start = tail;
+		}
+		start = ROUNDDOWN(start, sizeof(word));
+		if (head - start > ring_size) {
+			start = head;
+		}
+
+		/* overwrite the oldest records until the new one fits */
+		while (ring_size - (head - start) < need) {
+			rec = sizeof(word) + ROUNDUP(*(word *)(data + (start & (ring_size - 1))), sizeof(word));
+			start = (rec > head - start) ? head : start + rec;
+			ring->lost++;
+		}
+
+		if (start != ring->start) {
+			/* the reader checks the start after it has copied the records, to know which of them were overwritten */
+			ring->start = start;
+			smp_wmb();
+		}
+	} else if (head - tail > ring_size || ring_size - (head - tail) < need) {
+		ring->lost++;
+		goto unbusy;
+	}
+
+	/* don't write over the records before we know that the user has finished reading them */
+	smp_mb();
+
+	events_ring_write(data, ring_size, head, &len, sizeof(word));
+	events_ring_write(data, ring_size, head + sizeof(word), buf, len);
+
+	/* the record must be written before the user can see it */
+	smp_wmb();
+	ring->head = head + need;
+
+#ifdef __KERNEL__
+	if (head == tail) {
+		/* the ring was empty, so the readers may be waiting for it */
+		irq_work_queue(&events->work);
+	}
+#endif
+
+	ret = 1;
+
+unbusy:
+	events->busy[cpu] = 0;
+end:
+	local_irq_restore(irq_flags);
+	return ret;
+}
+
+/* check if any ring has records that were not read */
+int events_pending(events_t *events)
+{
+	word index;
+	events_ring_t *ring;
+
+	for (index = 0; index < events->num_rings; ++index) {
+		ring = EVENTS_RING(events, index);
+		if (ACCESS_ONCE(ring->head) != ACCESS_ONCE(ring->tail)) {
+			return 1;
+		}
+	}
+
+	return 0;
+}
@@ -0,0 +1,73 @@
+#ifndef EVENTS_H
+#define EVENTS_H
+
+#include "types.h"
+#include "env.h"
+
+#ifdef __KERNEL__
+#include <linux/wait.h>
+#include <linux/irq_work.h>
+#endif
+
+/* the ring of every cpu overwrites its oldest records when it's full (instead of dropping the new ones) */
+#define EVENTS_OVERWRITE	(1)
+
+/* the first page of the events memory (shared with the user) */
+typedef struct {
+	word num_rings;
+	word ring_size;		/* the size of the data of a ring (a power of two) */
+	word flags;
+} events_info_t;
+
+/* the header of a ring. a page with it comes before the data of every ring, and the positions
+ * are byte counters that only grow (the offset in the data is the position modulo the ring size).
+ * a record is a word with its length and then its data, padded to a word */
+typedef struct {
+	/* written by the kernel */
+	word head;		/* where the next record will be written */
+	word start;		/* the oldest record that was not overwritten */
+	word lost;		/* the number of records that were dropped or overwritten before they were read */
+
+	byte pad[64 - 3 * sizeof(word)];	/* keep the user's position in another cache line */
+
+	/* written by the user */
+	word tail;		/* the end of the records that were read */
+} events_ring_t;
+
+typedef struct events_s {
+	byte *mem;			/* the shared memory */
+	word size;			/* the size of the shared memory */
+
+	/* our own copy of the info, because the user can change the shared one */
+	word num_rings;
+	word ring_size;
+	word flags;
+
+	events_info_t *info;
+	word *busy;			/* a ring is being written on its cpu (an emit from an nmi in the middle of another one is dropped) */
+
+#ifdef __KERNEL__
+	wait_queue_head_t wait;
+	struct irq_work work;	/* wakes the readers (emit can run where waking up directly is not allowed) */
+#endif
+} events_t;
+
+/* the header of a ring */
+#define EVENTS_RING(events, index) ((events_ring_t *)((events)->mem + PAGE_SIZE + (index) * (PAGE_SIZE + (events)->ring_size)))
+
+/* the data of a ring */
+#define EVENTS_RING_DATA(events, index) (((byte *)EVENTS_RING(events, index)) + PAGE_SIZE)
+
+/* create the events rings (ring_size must be a power of two) */
+int events_create(events_t **events, word ring_size, word flags);
+
+/* delete the events rings (nobody may emit to them anymore) */
+void events_free(events_t *events);
+
+/* write a record to the ring of the current cpu. returns 1 if it was written and 0 if it was dropped */
+int events_emit(events_t *events, byte *buf, word len);
+
+/* check if any ring has records that were not read */
+int events_pending(events_t *events);
+
+#endif
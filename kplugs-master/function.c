@@ -4,6 +4,7 @@
 #include "env.h"
 #include "stack.h"
 #include "calling.h"
+#include "vm.h"
 
 #ifdef DEBUG
 
@@ -41,6 +42,18 @@ static const char *expression_names[] = {
 		"==",
 		"<",
 		"<",
+		"",
+		"",
+		"",
+		"<<",
+		">>",
+		"!=",
+		"<=",
+		"<=",
+		">",
+		">",
+		">=",
+		">=",
 };
 
 #define DEBUG_PRINT_TABS(num) do { \
@@ -56,7 +69,7 @@ static const char *expression_names[] = {
 
 /* recursively checks if the block that starts in index is a valid block */
 #define FUNCTION_CHECK_OP(type, index) \
-err = function_check_##type(code, len, numvars, checktable, index, max_index, max_string, recur + 1, exception_var); \
+err = function_check_##type(code, len, numvars, checktable, index, max_index, max_string, recur + 1, exception_var, loops); \
 if (err < 0) { \
 	return err; \
 } \
@@ -88,7 +101,8 @@ static int function_check_expression(	bytecode_t *code,
 										word *max_index,
 										word *max_string,
 										word recur,
-										word exception_var)
+										word exception_var,
+										word loops)
 {
 	int err = 0;
 	word val1 = 0;
@@ -306,6 +320,9 @@ static int function_check_expression(	bytecode_t *code,
 			return found;
 
 		case EXP_CMP_UNSIGN:
+		case EXP_CMP_LE_UNSIGN:
+		case EXP_CMP_GT_UNSIGN:
+		case EXP_CMP_GE_UNSIGN:
 			/* we want to print extra data */
 			DEBUG_PRINT("unsigned");
 		case EXP_ADD:
@@ -313,12 +330,19 @@ static int function_check_expression(	bytecode_t *code,
 		case EXP_MUL:
 		case EXP_DIV:
 		case EXP_AND:
+		case EXP_XOR:
 		case EXP_OR:
 		case EXP_BOOL_AND:
 		case EXP_BOOL_OR:
 		case EXP_MOD:
+		case EXP_SHL:
+		case EXP_SHR:
 		case EXP_CMP_EQ:
+		case EXP_CMP_NE:
 		case EXP_CMP_SIGN:
+		case EXP_CMP_LE_SIGN:
+		case EXP_CMP_GT_SIGN:
+		case EXP_CMP_GE_SIGN:
 			DEBUG_PRINT("(");
 
 			CHECK_EXPRESSION(val1);
@@ -344,6 +368,33 @@ static int function_check_expression(	bytecode_t *code,
 
 			return found;
 
+		case EXP_MAP_LOOKUP:
+		case EXP_MAP_DELETE:
+			DEBUG_PRINT("%s(", (code[index].expression.type == EXP_MAP_LOOKUP) ? "map_lookup" : "map_delete");
+
+			CHECK_EXPRESSION(val1);
+
+			DEBUG_PRINT(", ");
+
+			CHECK_EXPRESSION(val2);
+
+			DEBUG_PRINT(")");
+
+			return found;
+
+		case EXP_EMIT:
+			DEBUG_PRINT("emit(");
+
+			CHECK_EXPRESSION(val1);
+
+			DEBUG_PRINT(", ");
+
+			CHECK_EXPRESSION(val2);
+
+			DEBUG_PRINT(")");
+
+			return found;
+
 		case EXP_ARGS:
 			if (val1 || val2) {
 				ERROR(-ERROR_PARAM);
@@ -381,7 +432,8 @@ static int function_check_flow(	bytecode_t *code,
 								word *max_index,
 								word *max_string,
 								word recur,
-								word exception_var)
+								word exception_var,
+								word loops)
 {
 	int err = 0;
 	word found = 0;
@@ -462,6 +514,13 @@ static int function_check_flow(	bytecode_t *code,
 
 				break;
 
+			case FLOW_IF_CMP:
+				/* the condition must be a compare */
+				if (	val1 >= len ||
+						code[val1].op != OP_EXPRESSION ||
+						!IS_COMPARE_EXPRESSION(code[val1].expression.type)) {
+					ERROR(-ERROR_PARAM);
+				}
 			case FLOW_IF:
 
 				DEBUG_PRINT("if ");
@@ -496,6 +555,13 @@ static int function_check_flow(	bytecode_t *code,
 
 				break;
 
+			case FLOW_WHILE_CMP:
+				/* the condition must be a compare */
+				if (	val1 >= len ||
+						code[val1].op != OP_EXPRESSION ||
+						!IS_COMPARE_EXPRESSION(code[val1].expression.type)) {
+					ERROR(-ERROR_PARAM);
+				}
 			case FLOW_WHILE:
 				if (val3) {
 					ERROR(-ERROR_PARAM);
@@ -507,10 +573,52 @@ static int function_check_flow(	bytecode_t *code,
 
 				DEBUG_PRINT(":\n");
 
+				loops++;
 				CHECK_FLOW(val2);
+				loops--;
 
 				break;
 
+			case FLOW_FOR:
+				DEBUG_PRINT("for ");
+
+				CHECK_EXPRESSION(val1);
+
+				DEBUG_PRINT(":\n");
+
+				loops++;
+				CHECK_FLOW(val2);
+				loops--;
+
+				DEBUG_PRINT_TABS(recur);
+				DEBUG_PRINT("step:\n");
+
+				CHECK_FLOW(val3);
+
+				break;
+
+
+			case FLOW_MAP_UPDATE:
+			case FLOW_MAP_ADD:
+				/* the map's handle is in a word variable */
+				if (	!val1 ||
+						val1 >= numvars ||
+						code[val1].var.type == VAR_BUF ||
+						code[val1].var.type == VAR_ARRAY) {
+					ERROR(-ERROR_VAR);
+				}
+
+				DEBUG_PRINT("%s(%s%lu, ", (code[index].flow.type == FLOW_MAP_ADD) ? "map_add" : "map_update", variable_names[code[val1].var.type], val1);
+
+				CHECK_EXPRESSION(val2);
+
+				DEBUG_PRINT(", ");
+
+				CHECK_EXPRESSION(val3);
+
+				DEBUG_PRINT(")\n");
+
+				break;
 
 			case FLOW_DYN_FREE:
 				if (val2) {
@@ -571,6 +679,21 @@ static int function_check_flow(	bytecode_t *code,
 
 				return found;
 
+			case FLOW_BREAK:
+			case FLOW_CONTINUE:
+				if (val1 || val2 || val3) {
+					ERROR(-ERROR_PARAM);
+				}
+
+				if (!loops) {
+					/* there is no loop to leave */
+					ERROR(-ERROR_OP);
+				}
+
+				DEBUG_PRINT("%s\n\n", (code[index].flow.type == FLOW_BREAK) ? "break" : "continue");
+
+				return found;
+
 			default:
 				ERROR(-ERROR_OP);
 			}
@@ -754,7 +877,7 @@ static int function_check(bytecode_t *code, word len, function_t *func)
 
 		DEBUG_PRINT("\n");
 
-		err = function_check_flow(code, codelen, index, checktable, index, &max_index, &max_string, 0, 0);
+		err = function_check_flow(code, codelen, index, checktable, index, &max_index, &max_string, 0, 0, 0);
 
 		CHECK_ERROR(err);
 
@@ -766,7 +889,7 @@ static int function_check(bytecode_t *code, word len, function_t *func)
 	/* check the strings constants */
 	func->num_opcodes = max_index;
 
-	if (max_string * sizeof(word) < max_string) {
+	if (max_string * sizeof(call_slot_t) < max_string) {
 		/* integer overflow... */
 		ERROR_CLEAN(-ERROR_PARAM);
 	}
@@ -776,6 +899,13 @@ static int function_check(bytecode_t *code, word len, function_t *func)
 		ERROR_CLEAN(-ERROR_MEM);
 	}
 
+	/* the call targets are resolved on their first use */
+	func->call_slots = memory_alloc(max_string * sizeof(call_slot_t));
+	if (NULL == func->call_slots) {
+		ERROR_CLEAN(-ERROR_MEM);
+	}
+	memory_set(func->call_slots, 0, max_string * sizeof(call_slot_t));
+
 	strings = (byte *)&code[max_index];
 	last_found = strings;
 	len -= max_index * sizeof(bytecode_t);
@@ -814,6 +944,10 @@ clean:
 			memory_free(func->string_table);
 			func->string_table = NULL;
 		}
+		if (func->call_slots) {
+			memory_free(func->call_slots);
+			func->call_slots = NULL;
+		}
 
 	}
 
@@ -866,16 +1000,32 @@ int function_create(bytecode_t *code, word len, function_t **func)
 		goto clean;
 	}
 
-	/* set the function wrapper's callback */
 	(*func)->code = code;
+
+	/* lower the bytecode to the instructions that the vm runs */
+	err = vm_lower_function(*func);
+	if (err < 0) {
+		goto clean;
+	}
+
+	/* set the function wrapper's callback */
 	memory_copy((*func)->func_code, &wrapper_start, ((word)&wrapper_end - (word)&wrapper_start));
-	if ((*func)->code[0].func.function_type == FUNC_VARIABLE_ARGUMENT) {
+	if ((*func)->code[0].func.function_type & FUNC_VARIABLE_ARGUMENT) {
 		*(word *)GET_FUNCTION_CALLBACK(*func) = (word)variable_argument_function_callback;
 	} else {
 		*(word *)GET_FUNCTION_CALLBACK(*func) = (word)standard_function_callback;
 	}
 	err = 0;
 
+#ifdef PROFILING
+	if ((*func)->code[0].func.function_type & FUNC_PROFILE) {
+		(*func)->stats = memory_alloc(FUNCTION_STATS_SIZE(*func));
+		if (NULL == (*func)->stats) {
+			ERROR_CLEAN(-ERROR_MEM);
+		}
+		memory_set((*func)->stats, 0, FUNCTION_STATS_SIZE(*func));
+	}
+#endif
 
 	if (code[0].func.name) {
 		(*func)->name = (char *)((*func)->raw) + (*func)->string_table[code[0].func.name - 1];
@@ -887,6 +1037,15 @@ clean:
 		if ((*func)->string_table) {
 			memory_free((*func)->string_table);
 		}
+		if ((*func)->call_slots) {
+			memory_free((*func)->call_slots);
+		}
+		if ((*func)->stats) {
+			memory_free((*func)->stats);
+		}
+		if ((*func)->insns) {
+			memory_free((*func)->insns);
+		}
 		memory_free_exec(*func);
 		*func = NULL;
 	}
@@ -894,6 +1053,194 @@ clean:
 	return err;
 }
 
+/* the number of operands that every flow type has in a compact image (the others are zero) */
+static const byte compact_flow_operands[FLOW_MAX] = {
+	[FLOW_ASSIGN]			= 2,
+	[FLOW_ASSIGN_OFFSET]	= 3,
+	[FLOW_IF]				= 3,
+	[FLOW_TRY]				= 2,
+	[FLOW_WHILE]			= 2,
+	[FLOW_DYN_FREE]			= 1,
+	[FLOW_BLOCKEND]			= 0,
+	[FLOW_THROW]			= 1,
+	[FLOW_RET]				= 1,
+	[FLOW_IF_CMP]			= 3,
+	[FLOW_WHILE_CMP]		= 2,
+	[FLOW_FOR]				= 3,
+	[FLOW_BREAK]			= 0,
+	[FLOW_CONTINUE]			= 0,
+	[FLOW_MAP_UPDATE]		= 3,
+	[FLOW_MAP_ADD]			= 3,
+};
+
+/* the number of operands that every expression type has in a compact image (unlisted types have two) */
+static const byte compact_expression_operands[EXP_MAX] = {
+	[EXP_WORD ... EXP_MAX - 1]	= 2,
+
+	[EXP_WORD]				= 1,
+	[EXP_VAR]				= 1,
+	[EXP_STRING]			= 1,
+	[EXP_EXCEPTION_VAR]		= 0,
+	[EXP_ADDRESSOF]			= 1,
+	[EXP_NOT]				= 1,
+	[EXP_BOOL_NOT]			= 1,
+	[EXP_CALL_END]			= 0,
+	[EXP_ARGS]				= 0,
+	[EXP_EXP]				= 1,
+};
+
+/* a signed value is kept in a compact image as its absolute value shifted left, with the sign in the low bit */
+#define COMPACT_SIGNED(value) (((value) >> 1) ^ -((value) & 1))
+
+/* read an unsigned variable-length number (7 bits in every byte, the high bit marks that another byte follows) */
+static int compact_read(byte *image, word len, word *offset, word *value)
+{
+	word shift = 0;
+	byte cur = 0;
+
+	*value = 0;
+	do {
+		if (*offset >= len || shift >= sizeof(word) * BITS_PER_BYTE) {
+			ERROR(-ERROR_PARAM);
+		}
+		cur = image[(*offset)++];
+		*value |= (word)(cur & 0x7f) << shift;
+		shift += 7;
+	} while (cur & 0x80);
+
+	return 0;
+}
+
+/* decode the records of a compact image. if code is NULL the records are only checked and skipped */
+static int compact_decode_records(byte *image, word len, word num, bytecode_t *code, word *offset)
+{
+	word values[3];
+	word index, iter, count;
+	byte op, type;
+	int err = 0;
+
+	for (index = 0; index < num; ++index) {
+		/* every record starts with the same byte as in the standard bytecode */
+		if (*offset >= len) {
+			ERROR(-ERROR_PARAM);
+		}
+		op = image[*offset] & 3;
+		type = image[*offset] >> 2;
+		++*offset;
+
+		switch (op) {
+		case OP_FLOW:
+			if (type >= FLOW_MAX) {
+				ERROR(-ERROR_OP);
+			}
+			count = compact_flow_operands[type];
+			break;
+		case OP_EXPRESSION:
+			if (type >= EXP_MAX) {
+				ERROR(-ERROR_OP);
+			}
+			count = compact_expression_operands[type];
+			break;
+		default:
+			count = 3;
+			break;
+		}
+
+		values[0] = values[1] = values[2] = 0;
+		for (iter = 0; iter < count; ++iter) {
+			err = compact_read(image, len, offset, &values[iter]);
+			if (err < 0) {
+				return err;
+			}
+		}
+
+		if ((op == OP_FUNCTION || op == OP_VARIABLE) && values[2] > 0xff) {
+			ERROR(-ERROR_PARAM);
+		}
+		if (NULL == code) {
+			continue;
+		}
+
+		switch (op) {
+		case OP_FUNCTION:
+			code[index].func.op = op;
+			code[index].func.min_args = type & 0x1f;
+			code[index].func.return_exception_value = type >> 5;
+			code[index].func.name = values[0];
+			code[index].func.error_return = COMPACT_SIGNED(values[1]);
+			code[index].func.function_type = (byte)values[2];
+			break;
+		case OP_VARIABLE:
+			code[index].var.op = op;
+			code[index].var.type = type & 0x1f;
+			code[index].var.is_arg = type >> 5;
+			code[index].var.size = values[0];
+			code[index].var.init = COMPACT_SIGNED(values[1]);
+			code[index].var.flags = (byte)values[2];
+			break;
+		case OP_FLOW:
+			code[index].flow.op = op;
+			code[index].flow.type = type;
+			code[index].flow.val1 = values[0];
+			code[index].flow.val2 = values[1];
+			code[index].flow.val3 = values[2];
+			break;
+		default:
+			code[index].expression.op = op;
+			code[index].expression.type = type;
+			code[index].expression.val1 = (type == EXP_WORD) ? COMPACT_SIGNED(values[0]) : values[0];
+			code[index].expression.val2 = values[1];
+			break;
+		}
+	}
+
+	return 0;
+}
+
+/* decode a compact image (version 1.1) to the standard bytecode.
+ * the image is the number of records, the records and then the string table as is */
+int function_decode_compact(byte *image, word len, bytecode_t **code, word *code_len)
+{
+	word offset = 0, start = 0;
+	word num = 0;
+	int err = 0;
+
+	*code = NULL;
+
+	err = compact_read(image, len, &offset, &num);
+	if (err < 0) {
+		return err;
+	}
+	/* every record takes at least one byte */
+	if (num == 0 || num > len - offset) {
+		ERROR(-ERROR_PARAM);
+	}
+
+	start = offset;
+	err = compact_decode_records(image, len, num, NULL, &offset);
+	if (err < 0) {
+		return err;
+	}
+
+	*code_len = num * sizeof(bytecode_t) + (len - offset);
+	*code = memory_alloc(*code_len);
+	if (NULL == *code) {
+		ERROR(-ERROR_MEM);
+	}
+	memory_set(*code, 0, num * sizeof(bytecode_t));
+
+	offset = start;
+	err = compact_decode_records(image, len, num, *code, &offset);
+	if (err < 0) {
+		memory_free(*code);
+		*code = NULL;
+		return err;
+	}
+	memory_copy(&(*code)[num], image + offset, len - offset);
+
+	return 0;
+}
+
 /* increasing the refcount by one */
 void function_get(function_t *func)
 {
@@ -906,6 +1253,11 @@ void function_put(function_t *func)
 	if (atomic_dec_and_test(&func->ref_count)) {
 		DEBUG_PRINT("Deleting function: %p\n", func);
 		memory_free(func->string_table);
+		memory_free(func->call_slots);
+		if (NULL != func->stats) {
+			memory_free(func->stats);
+		}
+		memory_free(func->insns);
 		memory_free(func->raw);
 		memory_free_exec(func);
 	}
@@ -65,6 +65,21 @@ typedef enum {
 	EXP_ARGS, /* the number of arguments that was received */
 	EXP_EXP, /* poitner to an expression. used in case of a function call in a function argument */
 
+	EXP_SHL,
+	EXP_SHR,
+	EXP_CMP_NE,
+	EXP_CMP_LE_UNSIGN,
+	EXP_CMP_LE_SIGN,
+	EXP_CMP_GT_UNSIGN,
+	EXP_CMP_GT_SIGN,
+	EXP_CMP_GE_UNSIGN,
+	EXP_CMP_GE_SIGN,
+
+	EXP_EMIT, /* write a record to the events rings of the function's context */
+
+	EXP_MAP_LOOKUP, /* the value of a key in a map (0 if it's not there) */
+	EXP_MAP_DELETE,
+
 	EXP_MAX,
 } expressiontypes_t;
 
@@ -83,16 +98,39 @@ typedef enum {
 	FLOW_THROW,
 	FLOW_RET,
 
+	/* "if" and "while" that get the operands of the compare expression in val1 by themselves */
+	FLOW_IF_CMP,
+	FLOW_WHILE_CMP,
+
+	/* a "while" that runs the flow block in val3 after every iteration of the block in val2 */
+	FLOW_FOR,
+
+	/* block terminators that leave the innermost loop, or start its next iteration */
+	FLOW_BREAK,
+	FLOW_CONTINUE,
+
+	/* set the value of a key in the map that the variable in val1 has, or add to it atomically */
+	FLOW_MAP_UPDATE,
+	FLOW_MAP_ADD,
+
 	FLOW_MAX,
 } flowtypes_t;
 
 
+/* check if an expression type is a compare */
+#define IS_COMPARE_EXPRESSION(type) (	(type) == EXP_CMP_EQ || \
+										(type) == EXP_CMP_UNSIGN || \
+										(type) == EXP_CMP_SIGN || \
+										((type) >= EXP_CMP_NE && (type) <= EXP_CMP_GE_SIGN))
+
+
 /* function special types */
 typedef enum {
 	FUNC_VARIABLE_ARGUMENT	= 1 << 0,
 	FUNC_EXTERNAL 			= 1 << 1,
+	FUNC_PROFILE			= 1 << 2,
 
-	FUNC_MAX = (FUNC_VARIABLE_ARGUMENT | FUNC_EXTERNAL) + 1,
+	FUNC_MAX = (FUNC_VARIABLE_ARGUMENT | FUNC_EXTERNAL | FUNC_PROFILE) + 1,
 } function_types_t;
 
 
@@ -152,11 +190,45 @@ typedef union {
 } bytecode_t;
 
 
+/* the resolved target of a call by name (valid while its generation is the current calls generation) */
+typedef struct {
+	void *external;
+	void *internal;
+	word gen;
+} call_slot_t;
+
+
+/* the profiling counters of a function (only if it was loaded with FUNC_PROFILE).
+ * they are updated without locking, so concurrent runs may lose some counts */
+typedef struct {
+	word calls;
+	word total_ns;
+	word max_ns;
+	word pc_counts[];	/* the number of times every opcode was executed */
+} function_stats_t;
+
+
+/* an instruction that the vm runs. function_create lowers every checked record to one,
+ * so the vm doesn't decode the records while it runs */
+typedef struct {
+	unsigned int handler;	/* what the vm does (see vm_handlers_t) */
+	unsigned int var_type;	/* the type of the variable that the instruction accesses */
+	word val1;
+	word val2;
+	word val3;
+	word var_size;			/* the size of the variable that the instruction accesses */
+} vm_insn_t;
+
+
 /* a function struct */
 typedef struct {
 	list_head_t list;
 	atomic_t ref_count;
 
+	hash_node_t name_node;		/* in the context's names table */
+	hash_node_t handle_node;	/* in the context's handles table */
+	struct rcu_head rcu;		/* drops the context's reference after the function was removed from it */
+
 	char *name;		/* name */
 	context_t *cont;	/* context */
 
@@ -175,6 +247,9 @@ typedef struct {
 	word total_vars_size;	/* the size of memory needed to store the all the variables (including the arguments) */
 
 	word *string_table;		/* points to the string table (the offset of every string in the string's section in the bytecode) */
+	vm_insn_t *insns;		/* the instructions that the vm runs (one for every opcode) */
+	call_slot_t *call_slots;	/* the resolved call targets (one for every string) */
+	function_stats_t *stats;	/* the profiling counters (NULL if the function isn't profiled) */
 
 	byte func_code[];		/* the function's wrapper */
 } function_t;
@@ -182,19 +257,38 @@ typedef struct {
 /* create a function */
 int function_create(bytecode_t *code, word len, function_t **func);
 
+/* decode a compact image (version 1.1) to the standard bytecode */
+int function_decode_compact(byte *image, word len, bytecode_t **code, word *code_len);
+
 /* increasing the refcount by one */
 void function_get(function_t *func);
 
 /* decreasing the refcount by one - and freeing if the refcount is zero */
 void function_put(function_t *func);
 
+/* the size of a function's profiling counters */
+#define FUNCTION_STATS_SIZE(func) (sizeof(function_stats_t) + (func)->num_opcodes * sizeof(word))
+
 
 /* defined in context.c : */
 
 /* add a function to a context */
 int context_add_function(context_t *cont, function_t *func);
 
+/* add functions to a context together. if one of the names already exists none of them is added */
+int context_add_functions(context_t *cont, function_t **funcs, word num);
+
 /* remove and delete a function from the context */
 void context_free_function(function_t *func);
 
+/* remove and delete functions from a context by their handles, together. if one of the handles
+ * is not found none of them is removed */
+int context_free_functions(context_t *cont, byte **handles, word num);
+
+/* find the external function that a function calls by a string */
+void *context_resolve_external(function_t *func, word string);
+
+/* find the internal function that a function calls by a string */
+function_t *context_resolve_function(function_t *func, word string);
+
 #endif
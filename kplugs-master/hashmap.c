@@ -0,0 +1,260 @@
+#include "config.h"
+#include "types.h"
+#include "env.h"
+#include "memory.h"
+#include "hashmap.h"
+
+#ifdef __KERNEL__
+
+#include <linux/kernel.h>
+
+#endif
+
+/* the multiplier of the fibonacci hashing */
+#define HASHMAP_GOLDEN ((sizeof(word) == 8) ? (word)0x9E3779B97F4A7C15ULL : (word)0x9E3779B9UL)
+
+/* the entries, and the room to copy the keys to when the deleted entries are removed */
+#define HASHMAP_ALLOC_SIZE(size, capacity) (sizeof(hashmap_t) + ((size) + (capacity)) * sizeof(hashmap_entry_t))
+
+/* where the keys are copied to when the deleted entries are removed */
+#define HASHMAP_SCRATCH(map) (&(map)->entries[(map)->size])
+
+#define HASHMAP_INDEX(map, key) (((key) * HASHMAP_GOLDEN) >> (map)->shift)
+
+/* create a map */
+int hashmap_create(hashmap_t **map, word capacity)
+{
+	hashmap_t *new_map;
+	word size = 2;
+	word shift = sizeof(word) * BITS_PER_BYTE - 1;
+
+	/* keep the map at most half full, so the lookups stay short */
+	while (size < capacity * 2) {
+		size <<= 1;
+		shift--;
+	}
+
+	/* the memory is zeroed, so all the entries are empty */
+	new_map = memory_alloc_shared(ROUNDUP(HASHMAP_ALLOC_SIZE(size, capacity), PAGE_SIZE));
+	if (NULL == new_map) {
+		ERROR(-ERROR_MEM);
+	}
+
+	spin_lock_init(&new_map->lock);
+	seqcount_init(&new_map->seq);
+	new_map->capacity = capacity;
+	new_map->count = 0;
+	new_map->deleted = 0;
+	new_map->size = size;
+	new_map->shift = shift;
+
+	*map = new_map;
+	return 0;
+}
+
+/* delete a map (nobody may use it anymore) */
+void hashmap_free(hashmap_t *map)
+{
+	memory_free_shared(map, ROUNDUP(HASHMAP_ALLOC_SIZE(map->size, map->capacity), PAGE_SIZE));
+}
+
+/* find the entry of a key. if free_entry isn't NULL, it gets the first entry that the key can be added to */
+static hashmap_entry_t *hashmap_find(hashmap_t *map, word key, hashmap_entry_t **free_entry)
+{
+	hashmap_entry_t *entry;
+	word index = HASHMAP_INDEX(map, key);
+	word probes;
+	word state;
+
+	for (probes = 0; probes < map->size; ++probes) {
+		entry = &map->entries[index];
+		state = ACCESS_ONCE(entry->state);
+
+		if (state == HASHMAP_USED && ACCESS_ONCE(entry->key) == key) {
+			return entry;
+		}
+
+		if (state != HASHMAP_USED && NULL != free_entry && NULL == *free_entry) {
+			*free_entry = entry;
+		}
+
+		if (state == HASHMAP_EMPTY) {
+			/* the key can't be after an empty entry */
+			break;
+		}
+
+		index = (index + 1) & (map->size - 1);
+	}
+
+	return NULL;
+}
+
+/* remove the deleted entries by adding all the keys again (the map must be locked, inside its sequence count) */
+static void hashmap_compact(hashmap_t *map)
+{
+	hashmap_entry_t *scratch = HASHMAP_SCRATCH(map);
+	word num = 0;
+	word index;
+	word iter;
+
+	for (index = 0; index < map->size; ++index) {
+		if (map->entries[index].state == HASHMAP_USED) {
+			scratch[num++] = map->entries[index];
+		}
+	}
+
+	memory_set(map->entries, 0, map->size * sizeof(hashmap_entry_t));
+
+	for (iter = 0; iter < num; ++iter) {
+		index = HASHMAP_INDEX(map, scratch[iter].key);
+		while (map->entries[index].state != HASHMAP_EMPTY) {
+			index = (index + 1) & (map->size - 1);
+		}
+		map->entries[index] = scratch[iter];
+	}
+
+	map->deleted = 0;
+}
+
+/* set the value of a key, or add to it */
+static int hashmap_set(hashmap_t *map, word key, word value, int add)
+{
+	hashmap_entry_t *entry;
+	hashmap_entry_t *free_entry = NULL;
+	unsigned long flags;
+
+	spin_lock_irqsave(&map->lock, flags);
+
+	entry = hashmap_find(map, key, &free_entry);
+	if (NULL != entry) {
+		/* a lookup sees the old value or the new one, so it doesn't have to retry */
+		ACCESS_ONCE(entry->value) = add ? entry->value + value : value;
+
+		spin_unlock_irqrestore(&map->lock, flags);
+		return 0;
+	}
+
+	if (map->count >= map->capacity) {
+		spin_unlock_irqrestore(&map->lock, flags);
+		ERROR(-ERROR_MEM);
+	}
+
+	write_seqcount_begin(&map->seq);
+
+	if (map->count + map->deleted >= map->size - map->size / 4) {
+		/* too many deleted entries would make every lookup of a missing key long */
+		hashmap_compact(map);
+
+		free_entry = NULL;
+		hashmap_find(map, key, &free_entry);
+	}
+
+	if (free_entry->state == HASHMAP_DELETED) {
+		map->deleted--;
+	}
+
+	free_entry->key = key;
+	free_entry->value = value;
+	free_entry->state = HASHMAP_USED;
+	map->count++;
+
+	write_seqcount_end(&map->seq);
+
+	spin_unlock_irqrestore(&map->lock, flags);
+	return 0;
+}
+
+/* get the value of a key. returns 1 if the key was found */
+int hashmap_lookup(hashmap_t *map, word key, word *value)
+{
+	hashmap_entry_t *entry;
+	unsigned seq;
+	int found;
+
+	do {
+		seq = read_seqcount_begin(&map->seq);
+
+		entry = hashmap_find(map, key, NULL);
+		found = (NULL != entry);
+		if (found) {
+			*value = ACCESS_ONCE(entry->value);
+		}
+	} while (read_seqcount_retry(&map->seq, seq));
+
+	return found;
+}
+
+/* set the value of a key */
+int hashmap_update(hashmap_t *map, word key, word value)
+{
+	return hashmap_set(map, key, value, 0);
+}
+
+/* add to the value of a key (a new key starts from 0) */
+int hashmap_add(hashmap_t *map, word key, word value)
+{
+	return hashmap_set(map, key, value, 1);
+}
+
+/* delete a key. returns 1 if the key was found */
+int hashmap_delete(hashmap_t *map, word key)
+{
+	hashmap_entry_t *entry;
+	unsigned long flags;
+	word next;
+
+	spin_lock_irqsave(&map->lock, flags);
+
+	entry = hashmap_find(map, key, NULL);
+	if (NULL != entry) {
+		write_seqcount_begin(&map->seq);
+
+		/* the lookups have to continue past the entry, unless no key can be after it */
+		next = ((entry - map->entries) + 1) & (map->size - 1);
+		if (map->entries[next].state == HASHMAP_EMPTY) {
+			entry->state = HASHMAP_EMPTY;
+		} else {
+			entry->state = HASHMAP_DELETED;
+			map->deleted++;
+		}
+		map->count--;
+
+		write_seqcount_end(&map->seq);
+	}
+
+	spin_unlock_irqrestore(&map->lock, flags);
+
+	return NULL != entry;
+}
+
+/* copy up to max keys and their values to keys and values. returns the number of copied keys */
+word hashmap_dump(hashmap_t *map, word *keys, word *values, word max, word flags)
+{
+	unsigned long irq_flags;
+	word index;
+	word count = 0;
+
+	spin_lock_irqsave(&map->lock, irq_flags);
+
+	for (index = 0; index < map->size && count < max; ++index) {
+		if (map->entries[index].state == HASHMAP_USED) {
+			keys[count] = map->entries[index].key;
+			values[count] = map->entries[index].value;
+			count++;
+		}
+	}
+
+	if (flags & HASHMAP_DUMP_CLEAR) {
+		write_seqcount_begin(&map->seq);
+
+		memory_set(map->entries, 0, map->size * sizeof(hashmap_entry_t));
+		map->count = 0;
+		map->deleted = 0;
+
+		write_seqcount_end(&map->seq);
+	}
+
+	spin_unlock_irqrestore(&map->lock, irq_flags);
+
+	return count;
+}
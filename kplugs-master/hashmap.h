@@ -0,0 +1,59 @@
+#ifndef HASHMAP_H
+#define HASHMAP_H
+
+#include "types.h"
+#include "env.h"
+
+/* the states of an entry */
+typedef enum {
+	HASHMAP_EMPTY,
+	HASHMAP_USED,
+	HASHMAP_DELETED,	/* a deleted entry (the lookups of the keys after it continue past it, until the deleted entries are removed) */
+} hashmap_entry_state_t;
+
+/* delete all the entries of a map after they were dumped */
+#define HASHMAP_DUMP_CLEAR	(1)
+
+typedef struct {
+	word key;
+	word value;
+	word state;
+} hashmap_entry_t;
+
+/* a map of words to words with a fixed capacity. all the entries are allocated when it's created.
+ * lookups don't lock (they retry if the entries were changed under them), and all the changes are done under the lock */
+typedef struct {
+	spinlock_t lock;
+	seqcount_t seq;	/* changed around every change of the entries that a lookup could see half done */
+
+	word capacity;	/* the maximum number of keys */
+	word count;		/* the number of keys */
+	word deleted;	/* the number of deleted entries */
+	word size;		/* the number of entries (a power of two) */
+	word shift;		/* the hash of a key is its multiplicative hash shifted by this */
+
+	hashmap_entry_t entries[];	/* and then room to copy capacity entries, when the deleted ones are removed */
+} hashmap_t;
+
+/* create a map */
+int hashmap_create(hashmap_t **map, word capacity);
+
+/* delete a map (nobody may use it anymore) */
+void hashmap_free(hashmap_t *map);
+
+/* get the value of a key. returns 1 if the key was found */
+int hashmap_lookup(hashmap_t *map, word key, word *value);
+
+/* set the value of a key */
+int hashmap_update(hashmap_t *map, word key, word value);
+
+/* add to the value of a key (a new key starts from 0) */
+int hashmap_add(hashmap_t *map, word key, word value);
+
+/* delete a key. returns 1 if the key was found */
+int hashmap_delete(hashmap_t *map, word key);
+
+/* copy up to max keys and their values to keys and values. returns the number of copied keys */
+word hashmap_dump(hashmap_t *map, word *keys, word *values, word max, word flags);
+
+#endif
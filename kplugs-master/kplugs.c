@@ -7,6 +7,14 @@
 #include <linux/device.h>
 #include <linux/cdev.h>
 #include <linux/fs.h>
+#include <linux/uaccess.h>
+#include <linux/mm.h>
+#include <linux/vmalloc.h>
+#include <linux/poll.h>
+#include <linux/smp.h>
+#include <linux/cpumask.h>
+#include <linux/cpu.h>
+#include <linux/workqueue.h>
 
 MODULE_LICENSE("GPL");
 
@@ -18,6 +26,10 @@ MODULE_LICENSE("GPL");
 
 #define DEVICE_NAME			"kplugs"
 
+#define KPLUGS_IOCTL_COMMAND	_IOWR('k', 1, kplugs_ioctl_t)
+
+#define WORD_BITS	(sizeof(word) * BITS_PER_BYTE)
+
 context_t *GLOBAL_CONTEXT = NULL;
 
 /* choose the correct errno value to return, and create an answer */
@@ -44,6 +56,385 @@ static int create_error(context_t *cont, int err)
 	}
 }
 
+/* find the function of a command: by its name in ptr1, or by its handle if len1 is 0 */
+static int find_command_function(context_t *file_cont, kplugs_command_t *cmd, function_t **func)
+{
+	byte func_name[MAX_FUNC_NAME + 1];
+	int err;
+
+	*func = NULL;
+
+	if (cmd->len1) {
+		err = memory_copy_from_outside(func_name, cmd->uptr1, cmd->len1);
+		if (err < 0) {
+			return err;
+		}
+
+		func_name[cmd->len1] = '\0';
+
+		if (!cmd->is_global) {
+			*func = context_find_function(file_cont, func_name);
+		}
+		if (NULL == *func) {
+			*func = context_find_function(GLOBAL_CONTEXT, func_name);
+		}
+	} else {
+		if (!cmd->is_global) {
+			*func = context_find_handle(file_cont, cmd->ptr1);
+		}
+		if (NULL == *func) {
+			*func = context_find_handle(GLOBAL_CONTEXT, cmd->ptr1);
+		}
+	}
+
+	if (NULL == *func) {
+		ERROR(-ERROR_UFUNC);
+	}
+	return 0;
+}
+
+/* execute a function once for every row of a batch */
+static int execute_batch(function_t *func, kplugs_batch_t *batch, word *failed)
+{
+	exception_t excep;
+	stack_t stack;
+	word *args = NULL;
+	word row, iter;
+	word ret, exception;
+	int err = 0;
+
+	if (batch->cols > func->num_maxargs || batch->cols < func->num_minargs) {
+		ERROR(-ERROR_ARGS);
+	}
+
+	err = stack_alloc(&stack, sizeof(word), CALL_STACK_SIZE);
+	if (err < 0) {
+		return err;
+	}
+
+	args = memory_alloc(MAX(batch->cols, 1) * sizeof(word));
+	if (NULL == args) {
+		ERROR_CLEAN(-ERROR_MEM);
+	}
+
+	*failed = 0;
+
+	for (row = 0; row < batch->rows; ++row) {
+		err = memory_copy_from_outside(args, batch->args + (row * batch->cols), batch->cols * sizeof(word));
+		CHECK_ERROR(err);
+
+		/* push the arguments to the stack */
+		for (iter = 0; iter < batch->cols; ++iter) {
+			if (NULL == stack_push(&stack, &args[iter])) {
+				ERROR_CLEAN(-ERROR_MEM);
+			}
+		}
+
+		ret = vm_run_function(func, &stack, &excep);
+
+		/* the vm pops all the arguments unless it failed before loading them */
+		while (!stack_pop(&stack, NULL));
+
+		exception = 0;
+		if (excep.had_exception) {
+			exception = excep.value;
+			(*failed)++;
+		}
+
+		err = memory_copy_to_outside(batch->results + row, &ret, sizeof(word));
+		CHECK_ERROR(err);
+
+		err = memory_copy_to_outside(batch->exceptions + row, &exception, sizeof(word));
+		CHECK_ERROR(err);
+
+		cond_resched();
+	}
+
+	err = 0;
+clean:
+	if (NULL != args) {
+		memory_free(args);
+	}
+	stack_free(&stack);
+	return err;
+}
+
+/* create all the functions of a module image and add them to a context together. the image is a word of flags
+ * (KPLUGS_LOAD_COMPACT), and then the size of every function's code in a word and the code, padded to a word.
+ * handles gets the address of every function */
+static int load_module(context_t *cont, byte *image, word len, word __user *handles, word max, word *count)
+{
+	function_t **funcs;
+	bytecode_t *code;
+	word code_len, size;
+	word offset = sizeof(word);
+	word num = 0;
+	word iter;
+	word handle;
+	word flags;
+	int err = 0;
+
+	if (len < sizeof(word)) {
+		ERROR(-ERROR_PARAM);
+	}
+
+	flags = *(word *)image;
+	if (flags & ~KPLUGS_LOAD_COMPACT) {
+		ERROR(-ERROR_PARAM);
+	}
+
+	funcs = memory_alloc(max * sizeof(function_t *));
+	if (NULL == funcs) {
+		ERROR(-ERROR_MEM);
+	}
+
+	while (offset < len) {
+		if (num >= max || len - offset < sizeof(word)) {
+			ERROR_CLEAN(-ERROR_PARAM);
+		}
+
+		code_len = *(word *)(image + offset);
+		offset += sizeof(word);
+		if (!code_len || code_len > len - offset) {
+			ERROR_CLEAN(-ERROR_PARAM);
+		}
+
+		if (flags & KPLUGS_LOAD_COMPACT) {
+			/* the vm runs only the standard bytecode */
+			err = function_decode_compact(image + offset, code_len, &code, &size);
+			CHECK_ERROR(err);
+		} else {
+			code = memory_alloc(code_len);
+			if (NULL == code) {
+				ERROR_CLEAN(-ERROR_MEM);
+			}
+			memory_copy(code, image + offset, code_len);
+			size = code_len;
+		}
+		offset += ROUNDUP(code_len, sizeof(word));
+
+		/* the function owns its code after it was created */
+		err = function_create(code, size, &funcs[num]);
+		if (err < 0) {
+			memory_free(code);
+			goto clean;
+		}
+		num++;
+	}
+
+	if (!num) {
+		ERROR_CLEAN(-ERROR_PARAM);
+	}
+
+	/* the handles are copied before the functions are added, so a bad buffer doesn't leave any of them loaded */
+	for (iter = 0; iter < num; ++iter) {
+		handle = (word)&funcs[iter]->func_code;
+		err = memory_copy_to_outside(handles + iter, &handle, sizeof(word));
+		CHECK_ERROR(err);
+	}
+
+	err = context_add_functions(cont, funcs, num);
+	CHECK_ERROR(err);
+
+	/* the context has the functions now */
+	*count = num;
+	num = 0;
+
+clean:
+	for (iter = 0; iter < num; ++iter) {
+		function_put(funcs[iter]);
+	}
+	memory_free(funcs);
+	return err;
+}
+
+/* a function that runs on every cpu of a mask (by execute_on_cpus) */
+typedef struct {
+	function_t *func;
+	word *args;
+	word num_args;
+
+	/* indexed by the cpu */
+	word *results;
+	word *exceptions;
+	word *ran;
+} cpus_call_t;
+
+/* the work that runs the function of a cpus call on one cpu */
+typedef struct {
+	struct work_struct work;
+	cpus_call_t *call;
+	word cpu;
+} cpus_work_t;
+
+/* run the function of a cpus call on a cpu (we run on it) */
+static void execute_on_cpu(cpus_call_t *call, word cpu)
+{
+	exception_t excep;
+	stack_t stack;
+	word iter;
+	word ret;
+
+	call->ran[cpu] = 1;
+
+	if (stack_alloc(&stack, sizeof(word), CALL_STACK_SIZE) < 0) {
+		call->exceptions[cpu] = ERROR_MEM;
+		return;
+	}
+
+	/* push the arguments to the stack */
+	for (iter = 0; iter < call->num_args; ++iter) {
+		if (NULL == stack_push(&stack, &call->args[iter])) {
+			stack_free(&stack);
+			call->exceptions[cpu] = ERROR_MEM;
+			return;
+		}
+	}
+
+	ret = vm_run_function(call->func, &stack, &excep);
+
+	stack_free(&stack);
+
+	call->results[cpu] = ret;
+	call->exceptions[cpu] = excep.had_exception ? excep.value : 0;
+}
+
+/* run the function of a cpus call in a worker that is bound to its cpu */
+static void execute_on_cpu_work(struct work_struct *work)
+{
+	cpus_work_t *cpu_work = LIST_TO_STRUCT(cpus_work_t, work, work);
+
+	execute_on_cpu(cpu_work->call, cpu_work->cpu);
+}
+
+/* run the function of a cpus call on the current cpu, from an ipi (with the interrupts disabled) */
+static void execute_on_cpu_ipi(void *info)
+{
+	execute_on_cpu((cpus_call_t *)info, smp_processor_id());
+}
+
+/* execute a function on every cpu of a mask. count gets the number of cpus that it ran on */
+static int execute_on_cpus(function_t *func, kplugs_cpus_t *cpus, word *count)
+{
+	cpus_call_t call;
+	cpumask_var_t mask;
+	cpus_work_t *works = NULL;
+	word *bits = NULL;
+	word num_cpus = MIN(cpus->num_cpus, (word)nr_cpu_ids);
+	word num_words = ROUNDUP(num_cpus, WORD_BITS) / WORD_BITS;
+	word size;
+	word cpu;
+	int err = 0;
+
+	if (cpus->num_args > func->num_maxargs || cpus->num_args < func->num_minargs) {
+		ERROR(-ERROR_ARGS);
+	}
+
+	if (!num_cpus || (cpus->flags & ~KPLUGS_CPUS_IPI)) {
+		ERROR(-ERROR_PARAM);
+	}
+
+	if (!zalloc_cpumask_var(&mask, GFP_KERNEL)) {
+		ERROR(-ERROR_MEM);
+	}
+
+	/* the arguments, and then the results, the exceptions and the cpus that ran the function */
+	size = (cpus->num_args + 3 * num_cpus) * sizeof(word);
+
+	call.func = func;
+	call.num_args = cpus->num_args;
+	call.args = memory_alloc(size);
+	if (NULL == call.args) {
+		ERROR_CLEAN(-ERROR_MEM);
+	}
+	memory_set(call.args, 0, size);
+
+	call.results = call.args + call.num_args;
+	call.exceptions = call.results + num_cpus;
+	call.ran = call.exceptions + num_cpus;
+
+	err = memory_copy_from_outside(call.args, cpus->args, call.num_args * sizeof(word));
+	CHECK_ERROR(err);
+
+	if (NULL != cpus->mask) {
+		bits = memory_alloc(num_words * sizeof(word));
+		if (NULL == bits) {
+			ERROR_CLEAN(-ERROR_MEM);
+		}
+
+		err = memory_copy_from_outside(bits, cpus->mask, num_words * sizeof(word));
+		CHECK_ERROR(err);
+	}
+
+	for (cpu = 0; cpu < num_cpus; ++cpu) {
+		if (NULL == bits || (bits[cpu / WORD_BITS] & ((word)1 << (cpu % WORD_BITS)))) {
+			cpumask_set_cpu(cpu, mask);
+		}
+	}
+
+	if (cpus->flags & KPLUGS_CPUS_IPI) {
+		/* the function runs with the interrupts disabled, so it must not sleep. the cpus that are offline are skipped,
+		 * and we wait until the function has returned on all the others */
+		on_each_cpu_mask(mask, execute_on_cpu_ipi, &call, 1);
+	} else {
+		works = memory_alloc(num_cpus * sizeof(cpus_work_t));
+		if (NULL == works) {
+			ERROR_CLEAN(-ERROR_MEM);
+		}
+
+		/* the function runs on all the cpus together, in workers that may sleep. the cpus that are offline are skipped */
+		get_online_cpus();
+
+		for (cpu = 0; cpu < num_cpus; ++cpu) {
+			if (!cpumask_test_cpu(cpu, mask) || !cpu_online(cpu)) {
+				cpumask_clear_cpu(cpu, mask);
+				continue;
+			}
+
+			INIT_WORK(&works[cpu].work, execute_on_cpu_work);
+			works[cpu].call = &call;
+			works[cpu].cpu = cpu;
+			queue_work_on(cpu, system_wq, &works[cpu].work);
+		}
+
+		for (cpu = 0; cpu < num_cpus; ++cpu) {
+			if (cpumask_test_cpu(cpu, mask)) {
+				flush_work(&works[cpu].work);
+			}
+		}
+
+		put_online_cpus();
+	}
+
+	*count = 0;
+	for (cpu = 0; cpu < num_cpus; ++cpu) {
+		*count += call.ran[cpu];
+	}
+
+	err = memory_copy_to_outside(cpus->results, call.results, num_cpus * sizeof(word));
+	CHECK_ERROR(err);
+
+	err = memory_copy_to_outside(cpus->exceptions, call.exceptions, num_cpus * sizeof(word));
+	CHECK_ERROR(err);
+
+	err = memory_copy_to_outside(cpus->ran, call.ran, num_cpus * sizeof(word));
+	CHECK_ERROR(err);
+
+	err = 0;
+clean:
+	if (NULL != works) {
+		memory_free(works);
+	}
+	if (NULL != bits) {
+		memory_free(bits);
+	}
+	if (NULL != call.args) {
+		memory_free(call.args);
+	}
+	free_cpumask_var(mask);
+	return err;
+}
+
 /* kplugs device callbacks: */
 
 /* open callback */
@@ -81,19 +472,26 @@ static ssize_t kplugs_read(struct file *filp, char *buf, size_t count, loff_t *f
 	return context_get_reply(cont, buf, count);
 }
 
-/* write callback */
-static ssize_t kplugs_write(struct file *filp, const char *buf, size_t count, loff_t *f_pos)
+/* handle a command (the reply is left in the context) */
+static ssize_t kplugs_command(context_t *file_cont, kplugs_command_t *cmd, size_t count)
 {
-	kplugs_command_t *cmd = NULL;
-	context_t *file_cont = NULL;
+	kplugs_batch_t batch;
+	kplugs_cpus_t cpus;
 	context_t *cont = NULL;
+	byte *image;
 	bytecode_t *code = NULL;
+	bytecode_t *decoded = NULL;
 	function_t *func = NULL;
 	exception_t excep;
 	stack_t stack;
 	word iter, arg;
 	word args;
+	word len;
 	byte little_endian;
+	byte *arena;
+	word size;
+	hashmap_t *map;
+	word *keys = NULL;
 	byte func_name[MAX_FUNC_NAME + 1];
 	int err = 0;
 
@@ -102,10 +500,6 @@ static ssize_t kplugs_write(struct file *filp, const char *buf, size_t count, lo
 #else
 	little_endian = 0;
 #endif
-	/* get the user's command */
-	cmd = (kplugs_command_t *)buf;
-	file_cont = (context_t *)filp->private_data;
-
 	if (count < sizeof(byte) * 3) { /* three bytes of header */
 		return create_error(file_cont, -ERROR_PARAM);
 	}
@@ -114,7 +508,7 @@ static ssize_t kplugs_write(struct file *filp, const char *buf, size_t count, lo
 		return create_error(file_cont, -ERROR_ARCH);
 	}
 
-	if (cmd->version_major != VERSION_MAJOR || cmd->version_minor != VERSION_MINOR) {
+	if (cmd->version_major != VERSION_MAJOR || cmd->version_minor > VERSION_MINOR) {
 		return create_error(file_cont, -ERROR_VERSION);
 	}
 
@@ -128,7 +522,7 @@ static ssize_t kplugs_write(struct file *filp, const char *buf, size_t count, lo
 	case KPLUGS_LOAD:
 		/* load a new function */
 
-		if (cmd->len2 != 0 || cmd->ptr2 != NULL) {
+		if ((cmd->len2 & ~KPLUGS_LOAD_COMPACT) || cmd->ptr2 != NULL) {
 			return create_error(file_cont, -ERROR_PARAM);
 		}
 
@@ -143,8 +537,20 @@ static ssize_t kplugs_write(struct file *filp, const char *buf, size_t count, lo
 			goto clean;
 		}
 
+		len = cmd->len1;
+		if (cmd->len2 & KPLUGS_LOAD_COMPACT) {
+			/* the vm runs only the standard bytecode */
+			err = function_decode_compact((byte *)code, cmd->len1, &decoded, &len);
+			memory_free(code);
+			code = decoded;
+			if (err < 0) {
+				err = create_error(file_cont, err);
+				goto clean;
+			}
+		}
+
 		/* create the function */
-		err = function_create(code, cmd->len1, &func);
+		err = function_create(code, len, &func);
 		if (err < 0) {
 			err = create_error(file_cont, err);
 			goto clean;
@@ -161,6 +567,58 @@ static ssize_t kplugs_write(struct file *filp, const char *buf, size_t count, lo
 
 		return count;
 
+	case KPLUGS_LOAD_MODULE:
+		/* load all the functions of a module together. uptr2 gets their handles, and the reply is their number */
+		if (!cmd->len1 || !cmd->len2 || (cmd->len2 % sizeof(word)) != 0) {
+			return create_error(file_cont, -ERROR_PARAM);
+		}
+
+		image = memory_alloc(cmd->len1);
+		if (NULL == image) {
+			return create_error(file_cont, -ERROR_MEM);
+		}
+
+		err = memory_copy_from_outside(image, cmd->uptr1, cmd->len1);
+		if (err >= 0) {
+			err = load_module(cont, image, cmd->len1, (word __user *)cmd->uptr2, MIN(cmd->len2 / sizeof(word), KPLUGS_MODULE_MAX), &len);
+		}
+		memory_free(image);
+		if (err < 0) {
+			return create_error(file_cont, err);
+		}
+
+		context_create_reply(file_cont, len, NULL);
+
+		return count;
+
+	case KPLUGS_UNLOAD_MODULE:
+		/* unload the functions of a module together by their handles */
+		if (NULL != cmd->uptr2 || cmd->len2 || (cmd->len1 % sizeof(word)) != 0 ||
+				cmd->len1 / sizeof(word) > KPLUGS_MODULE_MAX) {
+			return create_error(file_cont, -ERROR_PARAM);
+		}
+
+		if (!cmd->len1) {
+			/* an empty module does nothing. the user checks with it that modules are supported */
+			return count;
+		}
+
+		image = memory_alloc(cmd->len1);
+		if (NULL == image) {
+			return create_error(file_cont, -ERROR_MEM);
+		}
+
+		err = memory_copy_from_outside(image, cmd->uptr1, cmd->len1);
+		if (err >= 0) {
+			err = context_free_functions(cont, (byte **)image, cmd->len1 / sizeof(word));
+		}
+		memory_free(image);
+		if (err < 0) {
+			return create_error(file_cont, err);
+		}
+
+		return count;
+
 	case KPLUGS_UNLOAD:
 		/* unload a function with a name */
 		if (NULL != cmd->uptr2) {
@@ -222,6 +680,25 @@ static ssize_t kplugs_write(struct file *filp, const char *buf, size_t count, lo
 		goto clean;
 	break;
 
+	case KPLUGS_EXECUTE_HANDLE:
+		/* execute a function by its handle (the address that was returned when it was loaded) */
+		if (cmd->len1 || (cmd->len2 % sizeof(word)) != 0) {
+			return create_error(file_cont, -ERROR_PARAM);
+		}
+
+		/* find the function */
+		if (!cmd->is_global) {
+			func = context_find_handle(file_cont, cmd->ptr1);
+		}
+		if (NULL == func) {
+			func = context_find_handle(GLOBAL_CONTEXT, cmd->ptr1);
+			if (NULL == func) {
+				return create_error(file_cont, -ERROR_UFUNC);
+			}
+		}
+
+		goto execute_func;
+
 	case KPLUGS_EXECUTE_ANONYMOUS:
 		/* execute (and unload) an anonymous function */
 		if (cmd->len1 || (cmd->len2 % sizeof(word)) != 0) {
@@ -284,6 +761,195 @@ execute_func:
 
 		goto clean;
 
+	case KPLUGS_EXECUTE_BATCH:
+		/* execute a function (by name, or by its handle if len1 is 0) once for every row of arguments */
+		if (cmd->len1 > MAX_FUNC_NAME || cmd->len2 != sizeof(kplugs_batch_t)) {
+			return create_error(file_cont, -ERROR_PARAM);
+		}
+
+		err = find_command_function(file_cont, cmd, &func);
+		if (err < 0) {
+			return create_error(file_cont, err);
+		}
+
+		err = memory_copy_from_outside(&batch, cmd->uptr2, sizeof(kplugs_batch_t));
+		if (err < 0) {
+			err = create_error(file_cont, err);
+			goto clean;
+		}
+
+		/* the reply is the number of rows that raised an exception */
+		err = execute_batch(func, &batch, &arg);
+		if (err < 0) {
+			err = create_error(file_cont, err);
+			goto clean;
+		}
+
+		context_create_reply(file_cont, arg, NULL);
+
+		err = (int)count;
+		goto clean;
+
+	case KPLUGS_EXECUTE_CPUS:
+		/* execute a function (by name, or by its handle if len1 is 0) on every cpu of a mask */
+		if (cmd->len1 > MAX_FUNC_NAME || cmd->len2 != sizeof(kplugs_cpus_t)) {
+			return create_error(file_cont, -ERROR_PARAM);
+		}
+
+		err = find_command_function(file_cont, cmd, &func);
+		if (err < 0) {
+			return create_error(file_cont, err);
+		}
+
+		err = memory_copy_from_outside(&cpus, cmd->uptr2, sizeof(kplugs_cpus_t));
+		if (err < 0) {
+			err = create_error(file_cont, err);
+			goto clean;
+		}
+
+		/* the reply is the number of cpus that the function ran on */
+		err = execute_on_cpus(func, &cpus, &arg);
+		if (err < 0) {
+			err = create_error(file_cont, err);
+			goto clean;
+		}
+
+		context_create_reply(file_cont, arg, NULL);
+
+		err = (int)count;
+		goto clean;
+
+	case KPLUGS_CREATE_ARENA:
+		/* create an arena for this file (the user can mmap it afterwards) */
+		if (NULL != cmd->uptr1 || NULL != cmd->uptr2 || cmd->len2 || !cmd->len1 || cmd->len1 > KPLUGS_ARENA_MAX) {
+			return create_error(file_cont, -ERROR_PARAM);
+		}
+
+		err = context_create_arena(file_cont, PAGE_ALIGN(cmd->len1), &arena);
+		if (err < 0) {
+			return create_error(file_cont, err);
+		}
+
+		/* return the arena's address, so arguments in it could be passed as inside memory */
+		context_create_reply(file_cont, (word)arena, NULL);
+
+		return count;
+
+	case KPLUGS_CREATE_EVENTS:
+		/* create the events rings of the file, or of the global context (the user can mmap them afterwards) */
+		if (	NULL != cmd->uptr1 || NULL != cmd->uptr2 || (cmd->len2 & ~EVENTS_OVERWRITE) ||
+				cmd->len1 < PAGE_SIZE || cmd->len1 > KPLUGS_ARENA_MAX || (cmd->len1 & (cmd->len1 - 1))) {
+			return create_error(file_cont, -ERROR_PARAM);
+		}
+
+		err = context_create_events(cont, cmd->len1, cmd->len2, &size);
+		if (err < 0) {
+			return create_error(file_cont, err);
+		}
+
+		/* return the size of the memory that should be mapped */
+		context_create_reply(file_cont, size, NULL);
+
+		return count;
+
+	case KPLUGS_CREATE_MAP:
+		/* create a map that the functions can use by its handle */
+		if (NULL != cmd->uptr1 || NULL != cmd->uptr2 || cmd->len2 || !cmd->len1 || cmd->len1 > KPLUGS_MAP_MAX) {
+			return create_error(file_cont, -ERROR_PARAM);
+		}
+
+		err = context_create_map(cont, cmd->len1, &map);
+		if (err < 0) {
+			return create_error(file_cont, err);
+		}
+
+		context_create_reply(file_cont, (word)map, NULL);
+
+		return count;
+
+	case KPLUGS_DUMP_MAP:
+		/* copy the keys of a map to the first half of the buffer and their values to its second half (len1 has the flags) */
+		if ((cmd->len1 & ~HASHMAP_DUMP_CLEAR) || (NULL == cmd->uptr2 && cmd->len2)) {
+			return create_error(file_cont, -ERROR_PARAM);
+		}
+
+		len = MIN(cmd->len2 / (2 * sizeof(word)), KPLUGS_MAP_MAX);
+		if (len) {
+			/* the map is dumped under its lock, so the keys are copied to the user afterwards */
+			keys = memory_alloc_shared(ROUNDUP(2 * len * sizeof(word), PAGE_SIZE));
+			if (NULL == keys) {
+				return create_error(file_cont, -ERROR_MEM);
+			}
+		}
+
+		iter = 0;
+		rcu_read_lock();
+		map = context_find_map(cont, cmd->ptr1);
+		if (NULL != map) {
+			iter = hashmap_dump(map, keys, keys + len, len, cmd->len1);
+		}
+		rcu_read_unlock();
+
+		if (NULL == map) {
+			err = create_error(file_cont, -ERROR_PARAM);
+		} else {
+			err = memory_copy_to_outside(cmd->uptr2, keys, iter * sizeof(word));
+			if (err >= 0) {
+				err = memory_copy_to_outside(cmd->uptr2 + len * sizeof(word), keys + len, iter * sizeof(word));
+			}
+
+			if (err < 0) {
+				err = create_error(file_cont, err);
+			} else {
+				context_create_reply(file_cont, iter, NULL);
+				err = (int)count;
+			}
+		}
+
+		if (NULL != keys) {
+			memory_free_shared(keys, ROUNDUP(2 * len * sizeof(word), PAGE_SIZE));
+		}
+		return err;
+
+	case KPLUGS_DELETE_MAP:
+		if (NULL != cmd->uptr2 || cmd->len1 || cmd->len2) {
+			return create_error(file_cont, -ERROR_PARAM);
+		}
+
+		err = context_delete_map(cont, cmd->ptr1);
+		if (err < 0) {
+			return create_error(file_cont, err);
+		}
+
+		return count;
+
+	case KPLUGS_GET_STATS:
+		/* copy the profiling counters of a function (by name, or by its handle if len1 is 0) */
+		if (cmd->len1 > MAX_FUNC_NAME) {
+			return create_error(file_cont, -ERROR_PARAM);
+		}
+
+		err = find_command_function(file_cont, cmd, &func);
+		if (err < 0) {
+			return create_error(file_cont, err);
+		}
+
+		if (NULL == func->stats) {
+			ERROR_CLEAN(create_error(file_cont, -ERROR_PARAM));
+		}
+
+		/* copy as much as the user asked for, and reply the number of opcodes so the user would know the whole size */
+		err = memory_copy_to_outside(cmd->uptr2, func->stats, MIN(cmd->len2, FUNCTION_STATS_SIZE(func)));
+		if (err < 0) {
+			err = create_error(file_cont, err);
+			goto clean;
+		}
+
+		context_create_reply(file_cont, func->num_opcodes, NULL);
+
+		err = (int)count;
+		goto clean;
+
 	case KPLUGS_GET_LAST_EXCEPTION:
 		if (NULL != cmd->uptr2 || cmd->len1 < sizeof(exception_t) || cmd->len2) {
 			ERROR(create_error(file_cont, -ERROR_PARAM));
@@ -308,6 +974,106 @@ clean:
 	return err;
 }
 
+/* write callback */
+static ssize_t kplugs_write(struct file *filp, const char *buf, size_t count, loff_t *f_pos)
+{
+	return kplugs_command((context_t *)filp->private_data, (kplugs_command_t *)buf, count);
+}
+
+/* ioctl callback: handle a command and return its reply in place */
+static long kplugs_ioctl(struct file *filp, unsigned int num, unsigned long param)
+{
+	context_t *file_cont = (context_t *)filp->private_data;
+	kplugs_ioctl_t __user *user_io = (kplugs_ioctl_t __user *)param;
+	kplugs_ioctl_t io;
+	ssize_t err;
+
+	if (num != KPLUGS_IOCTL_COMMAND) {
+		return -ENOTTY;
+	}
+
+	memory_set(&io, 0, sizeof(kplugs_ioctl_t));
+	if (copy_from_user(&io.cmd, &user_io->cmd, sizeof(kplugs_command_t))) {
+		return -EFAULT;
+	}
+
+	err = kplugs_command(file_cont, &io.cmd, sizeof(kplugs_command_t));
+
+	/* the error value (or the exception's value) is in the reply, and if the command failed
+	 * we take the last exception as well so the user won't need another command to get it */
+	io.error = (err < 0) ? -err : 0;
+	io.has_reply = context_take_reply(file_cont, &io.cmd, (err < 0) ? &io.excep : NULL);
+
+	if (copy_to_user(user_io, &io, sizeof(kplugs_ioctl_t))) {
+		return -EFAULT;
+	}
+
+	return 0;
+}
+
+/* map the events rings of a context */
+static int kplugs_mmap_events(context_t *cont, struct vm_area_struct *vma)
+{
+	events_t *events;
+
+	context_lock(cont);
+	events = cont->events;
+	context_unlock(cont);
+
+	/* the events can be freed only when the context is freed, and it can't happen while it's being mapped */
+	if (NULL == events || vma->vm_end - vma->vm_start > events->size) {
+		return -EINVAL;
+	}
+
+	return remap_vmalloc_range(vma, events->mem, 0);
+}
+
+/* mmap callback: map the file's arena or the events rings */
+static int kplugs_mmap(struct file *filp, struct vm_area_struct *vma)
+{
+	context_t *cont = (context_t *)filp->private_data;
+	byte *arena;
+	word arena_size;
+
+	if (vma->vm_pgoff == KPLUGS_EVENTS_OFFSET / PAGE_SIZE) {
+		return kplugs_mmap_events(cont, vma);
+	}
+	if (vma->vm_pgoff == KPLUGS_GLOBAL_EVENTS_OFFSET / PAGE_SIZE) {
+		return kplugs_mmap_events(GLOBAL_CONTEXT, vma);
+	}
+
+	context_lock(cont);
+	arena = cont->arena;
+	arena_size = cont->arena_size;
+	context_unlock(cont);
+
+	if (NULL == arena || vma->vm_pgoff || vma->vm_end - vma->vm_start > arena_size) {
+		return -EINVAL;
+	}
+
+	return remap_vmalloc_range(vma, arena, 0);
+}
+
+/* wait for the events rings of a context */
+static unsigned int kplugs_poll_events(struct file *filp, events_t *events, poll_table *wait)
+{
+	if (NULL == events) {
+		return 0;
+	}
+
+	poll_wait(filp, &events->wait, wait);
+	return events_pending(events) ? (POLLIN | POLLRDNORM) : 0;
+}
+
+/* poll callback: the file is readable when its events rings (or the global ones) have records that were not read */
+static unsigned int kplugs_poll(struct file *filp, poll_table *wait)
+{
+	context_t *cont = (context_t *)filp->private_data;
+
+	return	kplugs_poll_events(filp, ACCESS_ONCE(cont->events), wait) |
+			kplugs_poll_events(filp, ACCESS_ONCE(GLOBAL_CONTEXT->events), wait);
+}
+
 /* the device operations */
 static struct file_operations kplugs_ops =
 {
@@ -316,6 +1082,23 @@ static struct file_operations kplugs_ops =
 		.release = kplugs_release,
 		.read = kplugs_read,
 		.write = kplugs_write,
+		.unlocked_ioctl = kplugs_ioctl,
+		.mmap = kplugs_mmap,
+		.poll = kplugs_poll,
+};
+
+/* a module that goes away may have functions that we resolved */
+static int kplugs_module_notify(struct notifier_block *nb, unsigned long action, void *data)
+{
+	if (action == MODULE_STATE_GOING) {
+		context_invalidate_calls();
+	}
+	return NOTIFY_OK;
+}
+
+static struct notifier_block kplugs_module_nb =
+{
+		.notifier_call = kplugs_module_notify,
 };
 
 static dev_t kplugs_devno = 0;
@@ -329,6 +1112,7 @@ static int __init kplugs_init(void)
 	struct device *device = NULL;
 
 	memory_start();
+	context_start();
 
 	err = context_create(&GLOBAL_CONTEXT);
 	if (err < 0) {
@@ -362,9 +1146,16 @@ static int __init kplugs_init(void)
 		ERROR_CLEAN(create_error(NULL, err));
 	}
 
+	err = register_module_notifier(&kplugs_module_nb);
+	if (err < 0) {
+		output_string("Couldn't register a module notifier.\n");
+		ERROR_CLEAN(create_error(NULL, err));
+	}
+
 	device = device_create(kplugs_class, NULL, kplugs_devno, NULL, DEVICE_NAME);
 	if (device == NULL) {
 		output_string("Couldn't create the device.\n");
+		unregister_module_notifier(&kplugs_module_nb);
 		ERROR_CLEAN(-ENOMEM);
 	}
 
@@ -391,10 +1182,14 @@ clean:
 static void __exit kplugs_exit(void)
 {
 	device_destroy(kplugs_class, kplugs_devno);
+	unregister_module_notifier(&kplugs_module_nb);
 	cdev_del(kplugs_cdev);
 	class_destroy(kplugs_class);
 	unregister_chrdev_region(kplugs_devno, 1);
 	context_free(GLOBAL_CONTEXT);
+
+	/* the functions that were unloaded may still wait for their references to be dropped */
+	rcu_barrier();
 	memory_stop();
 }
 
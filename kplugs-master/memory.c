@@ -10,6 +10,7 @@
 #include <linux/mm.h>
 #include <linux/highmem.h>
 #include <linux/slab.h>
+#include <linux/vmalloc.h>
 
 MODULE_LICENSE("GPL");
 
@@ -601,6 +602,33 @@ void memory_free_exec(void *mem)
 	}
 }
 
+/* allocate a zeroed memory that can be mapped to the user */
+void *memory_alloc_shared(word size)
+{
+	void *ret;
+
+#ifdef __KERNEL__
+	ret = vmalloc_user(size);
+#else
+	ret = mmap(NULL, size, PROT_READ | PROT_WRITE, MAP_ANONYMOUS | MAP_SHARED, -1, 0);
+	if ((sword)ret == -1) {
+		ret = NULL;
+	}
+#endif
+
+	return ret;
+}
+
+/* free a shared memory */
+void memory_free_shared(void *mem, word size)
+{
+#ifdef __KERNEL__
+	vfree(mem);
+#else
+	munmap(mem, size);
+#endif
+}
+
 
 /* start memory - makes sure all the structures are initialized */
 void memory_start(void)
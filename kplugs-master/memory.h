@@ -37,6 +37,11 @@ void *memory_alloc_exec(word size);
 /* free an executable buffer */
 void memory_free_exec(void *mem);
 
+/* allocate a zeroed memory that can be mapped to the user */
+void *memory_alloc_shared(word size);
+/* free a shared memory */
+void memory_free_shared(void *mem, word size);
+
 
 /* start memory - makes sure all the structures are initialized */
 void memory_start(void);
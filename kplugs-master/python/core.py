@@ -5,9 +5,23 @@ from _ast import *
 import struct
 import ctypes
 import os
+import threading
+import array
+import fcntl
+import errno
+import mmap
+import select
+import bisect
+import hashlib
+import marshal
+import tempfile
+import time
+import json
 
 WORD_SIZE = struct.calcsize("P")
+WORD_MASK = (1 << (WORD_SIZE * 8)) - 1
 VERSION   = (1, 0)
+COMPACT_VERSION = (1, 1) # the first version that loads compact images (they are marked with Plug.LOAD_COMPACT)
 
 # the kplugs main class
 class Plug(object):
@@ -20,6 +34,34 @@ class Plug(object):
 	KPLUGS_UNLOAD = 4
 	KPLUGS_UNLOAD_ANONYMOUS = 5
 	KPLUGS_GET_LAST_EXCEPTION = 6
+	KPLUGS_EXECUTE_BATCH = 7
+	KPLUGS_CREATE_ARENA = 8
+	KPLUGS_EXECUTE_HANDLE = 9
+	KPLUGS_GET_STATS = 10
+	KPLUGS_CREATE_EVENTS = 11
+	KPLUGS_CREATE_MAP = 12
+	KPLUGS_DUMP_MAP = 13
+	KPLUGS_DELETE_MAP = 14
+	KPLUGS_EXECUTE_CPUS = 15
+	KPLUGS_LOAD_MODULE = 16
+	KPLUGS_UNLOAD_MODULE = 17
+
+	# the maximum number of functions in a module
+	MODULE_MAX = 0x1000
+
+	# run the function of on_cpus from an ipi
+	CPUS_IPI = 1
+
+	# the images of a load command (in len2) or of a load module command (in the first word of the module) are compact
+	LOAD_COMPACT = 1
+
+	# the mmap offsets of the events rings of a file and of the global events rings
+	EVENTS_OFFSET = 0x10000000
+	GLOBAL_EVENTS_OFFSET = 0x20000000
+
+	# the command ioctl: _IOWR('k', 1, kplugs_ioctl_t)
+	IOCTL_WORDS = 11
+	KPLUGS_IOCTL_COMMAND = (3 << 30) | ((IOCTL_WORDS * WORD_SIZE) << 16) | (ord('k') << 8) | 1
 
 	ERROR_TABLE = [
 	"",
@@ -43,23 +85,76 @@ class Plug(object):
 	"Unsupported version",
 	"Not a dynamic memory",
 	]
+	ERROR_PARAM = 5
+	ERROR_UFUNC = 15
+	ERROR_VERSION = 18
 
 	
-	def __init__(self, glob = False):
+	def __init__(self, glob = False, cache = None):
 		self.fd = os.open('/dev/kplugs', os.O_RDWR)
 		self.funcs = []
 		self.glob = glob
+		self.cache = cache
 		self.last_exception = []
-
-	def _exec_cmd(self, op, len1, len2, val1, val2):
+		self._lock = threading.Lock()
+		self.use_ioctl = True
+		self.compact = True # load compact images until the kernel doesn't support them
+		self.modules = None # load and unload the functions of a compilation together if the kernel supports it (None until we check)
+		self.handles = None # execute functions by their handles if the kernel supports it (None until we check)
+		self.last_error = 0
+		self.arena = None
+		self.events = None
+		self.maps = []
+		self.last_report = None # the CompileReport of the last compilation (even if it has failed)
+
+	def _exec_cmd(self, op, len1, len2, val1, val2, version = VERSION):
+		# a command is a write and a read of its reply, so threads that share a plug must not interleave them
+		with self._lock:
+			return self._send_cmd(op, len1, len2, val1, val2, version)
+
+	def _raise_error(self, exc):
+		self.last_error = exc
+		if exc >= len(Plug.ERROR_TABLE):
+			raise Exception("Error: 0x%x" % exc)
+		raise Exception(Plug.ERROR_TABLE[exc])
+
+	# send a command and get its reply with a single ioctl. returns None if the ioctl isn't supported
+	def _ioctl_cmd(self, header, len1, len2, val1, val2):
+		io = array.array('L', [header, len1, len2, val1, val2] + [0] * (Plug.IOCTL_WORDS - 5))
+		try:
+			fcntl.ioctl(self.fd, Plug.KPLUGS_IOCTL_COMMAND, io, True)
+		except IOError, e:
+			if e.errno != errno.ENOTTY and e.errno != errno.EINVAL:
+				raise
+			# an old kplugs without the ioctl interface
+			self.use_ioctl = False
+			return None
+
+		reply, error, has_reply, excep = io[:5], io[5], io[6], io[7:]
+		if error:
+			exc = reply[3]
+			if (excep[0] & 0xff) and excep[1] == exc:
+				self.last_exception = tuple(excep[2:])
+			self._raise_error(exc)
+
+		if not has_reply:
+			return (None, )
+		return (reply[3], )
+
+	def _send_cmd(self, op, len1, len2, val1, val2, version = VERSION):
 		# supports only little endian version.
-		header = WORD_SIZE + (1 << 7) + (VERSION[0] << 8) + (VERSION[1] << 16) + (op << 24)
+		header = WORD_SIZE + (1 << 7) + (version[0] << 8) + (version[1] << 16) + (op << 24)
+		if self.use_ioctl:
+			ret = self._ioctl_cmd(header, len1, len2, val1, val2)
+			if ret is not None:
+				return ret[0]
+
 		try:
 			os.write(self.fd, struct.pack("PPPPP", header, len1, len2, val1, val2))
 		except:
 			exc = struct.unpack("P", os.read(self.fd, WORD_SIZE * 5)[WORD_SIZE * 3:WORD_SIZE * 4])[0]
 
-			if op == Plug.KPLUGS_EXECUTE or op == Plug.KPLUGS_EXECUTE_ANONYMOUS:
+			if op == Plug.KPLUGS_EXECUTE or op == Plug.KPLUGS_EXECUTE_ANONYMOUS or op == Plug.KPLUGS_EXECUTE_HANDLE:
 				try:
 					# try to get the exception parameters
 					excep = ctypes.c_buffer('\0' * (WORD_SIZE * 4))
@@ -67,14 +162,12 @@ class Plug(object):
 					os.write(self.fd, struct.pack("PPPPP", Plug.KPLUGS_GET_LAST_EXCEPTION, WORD_SIZE * 4, 0, ctypes.addressof(excep), 0))
 					excep = struct.unpack("PPPP", excep.raw[:WORD_SIZE * 4])
 					if exc == excep[1]:
-						self.last_exception = excep[2:]
+						self.last_exception = tuple(excep[2:])
 				except:
 					# probably we didn't fail because an exception
 					pass
 
-			if exc >= len(Plug.ERROR_TABLE):
-				raise Exception("Error: 0x%x" % exc)
-			raise Exception(Plug.ERROR_TABLE[exc])
+			self._raise_error(exc)
 		ret = os.read(self.fd, WORD_SIZE * 5)
 		if len(ret) == 0:
 			return
@@ -86,27 +179,200 @@ class Plug(object):
 		else:
 			op = Plug.KPLUGS_LOAD
 
-		compiled = func.to_bytes(unhandled_return, function_type)
-		buf = ctypes.c_buffer(compiled)
-
 		# send the command (will throw an exception if it fails)
-		func.addr = self._exec_cmd(op, len(compiled), 0, ctypes.addressof(buf), 0)
+		start = time.time()
+		try:
+			addr = None
+			if self.compact:
+				self.last_error = 0
+				compiled = func.to_compact_bytes(unhandled_return, function_type)
+				buf = ctypes.c_buffer(compiled)
+				try:
+					addr = self._exec_cmd(op, len(compiled), Plug.LOAD_COMPACT, ctypes.addressof(buf), 0, COMPACT_VERSION)
+				except:
+					if self.last_error != Plug.ERROR_VERSION:
+						raise
+					# an old kplugs that supports only the standard bytecode
+					self.compact = False
+
+			if addr is None:
+				compiled = func.to_bytes(unhandled_return, function_type)
+				buf = ctypes.c_buffer(compiled)
+				addr = self._exec_cmd(op, len(compiled), 0, ctypes.addressof(buf), 0)
+		finally:
+			func.times["load"] = time.time() - start
+		func.addr = addr
+		func.info["image_size"] = len(compiled)
 
 		func.plug = self
 		self.funcs.append(func)
 
-	def compile(self, code, unhandled_return = None, function_type = 0):
+	# the image of a module: a word of flags (LOAD_COMPACT), and then the size of every function's image in a word and the image,
+	# padded to a word
+	@staticmethod
+	def _module_image(images, flags):
+		return struct.pack("P", flags) + ''.join([struct.pack("P", len(image)) + image + '\0' * (-len(image) % WORD_SIZE) for image in images])
+
+	# send the images of functions with a load module command. handles gets their addresses. returns the images
+	def _send_module(self, op, funcs, handles, unhandled_return, function_type):
+		if self.compact:
+			self.last_error = 0
+			images = [func.to_compact_bytes(unhandled_return, function_type) for func in funcs]
+			module = ctypes.c_buffer(Plug._module_image(images, Plug.LOAD_COMPACT))
+			try:
+				# send the command (will throw an exception if it fails)
+				self._exec_cmd(op, len(module) - 1, len(handles) * WORD_SIZE, ctypes.addressof(module), handles.buffer_info()[0], COMPACT_VERSION)
+				return images
+			except:
+				if self.last_error != Plug.ERROR_VERSION:
+					raise
+				# an old kplugs that supports only the standard bytecode
+				self.compact = False
+
+		self.last_error = 0
+		images = [func.to_bytes(unhandled_return, function_type) for func in funcs]
+		module = ctypes.c_buffer(Plug._module_image(images, 0))
+
+		# send the command (will throw an exception if it fails)
+		self._exec_cmd(op, len(module) - 1, len(handles) * WORD_SIZE, ctypes.addressof(module), handles.buffer_info()[0])
+		return images
+
+	# check once if the kernel supports modules, by unloading an empty module (an old kplugs doesn't know the command)
+	def _has_modules(self):
+		if self.modules is None:
+			self.last_error = 0
+			try:
+				self._exec_cmd(Plug.KPLUGS_UNLOAD_MODULE, 0, 0, 0, 0)
+				self.modules = True
+			except:
+				if self.last_error != Plug.ERROR_PARAM:
+					raise
+				self.modules = False
+		return self.modules
+
+	# check once if the kernel executes functions by their handles, by executing the handle 0
+	# (there is no such function, and an old kplugs doesn't know the command)
+	def _has_handles(self):
+		if self.handles is None:
+			self.last_error = 0
+			try:
+				self._exec_cmd(Plug.KPLUGS_EXECUTE_HANDLE, 0, 0, 0, 0)
+				self.handles = True
+			except:
+				if self.last_error == Plug.ERROR_UFUNC:
+					self.handles = True
+				elif self.last_error == Plug.ERROR_PARAM:
+					self.handles = False
+				else:
+					raise
+		return self.handles
+
+	# load functions as one module with a single command. the kernel verifies all of them and adds them together,
+	# so either all of them are loaded or none of them
+	def load_module(self, funcs, unhandled_return = None, function_type = 0):
+		if len(funcs) > Plug.MODULE_MAX:
+			raise Exception("A module can't have more than %d functions" % (Plug.MODULE_MAX, ))
+
+		if len(funcs) == 0:
+			return
+		if not self._has_modules():
+			# an old kplugs without modules
+			for func in funcs:
+				self.load(func, unhandled_return, function_type)
+			return
+
+		if self.glob:
+			op = Plug.KPLUGS_LOAD_MODULE | (1 << 7) # add the global flag
+		else:
+			op = Plug.KPLUGS_LOAD_MODULE
+
+		handles = array.array('L', [0]) * len(funcs)
+
+		# send the command (will throw an exception if it fails, and then none of the functions was loaded)
+		start = time.time()
+		try:
+			images = self._send_module(op, funcs, handles, unhandled_return, function_type)
+		finally:
+			for func in funcs:
+				func.times["load"] = (time.time() - start) / len(funcs)
+
+		for func, addr, image in zip(funcs, handles, images):
+			func.addr = addr
+			func.info["image_size"] = len(image)
+
+			func.plug = self
+			self.funcs.append(func)
+
+	# compile and load code. if report is True a CompileReport is returned with the functions
+	def compile(self, code, unhandled_return = None, function_type = 0, report = False):
+		compile_report = CompileReport()
+		try:
+			funcs = self._compile(code, unhandled_return, function_type, compile_report)
+		finally:
+			# fstring functions are compiled while compiling, so the outer compilation should be the last one to set it
+			self.last_report = compile_report.finish()
+
+		if report:
+			return funcs, compile_report
+		return funcs
+
+	def _compile(self, code, unhandled_return, function_type, report):
+		if self.cache is not None:
+			entry = self.cache.get(code, unhandled_return, function_type)
+			if entry is not None:
+				report.cached = True
+				return self._load_cached(entry, unhandled_return, function_type, report)
+
 		# create a visitor and compile
 		visitor = compiler_visitor(self)
-		p = ast.parse(code)
-		visitor.visit(p)
+		with report.phase("parse"):
+			p = ast.parse(code)
+		with report.phase("visitor"):
+			visitor.visit(p)
+
+		# load all the functions together
+		try:
+			self.load_module(visitor.functions, unhandled_return, function_type)
+		finally:
+			for func in visitor.functions:
+				report.add_function(func)
 
-		# load all the functions
-		for func in visitor.functions:
-			self.load(func, unhandled_return, function_type)
+		if self.cache is not None:
+			self.cache.put(code, unhandled_return, function_type, visitor.functions)
 
 		return filter(lambda i:not i.static, visitor.functions)
 
+	# load the functions of a compile cache entry
+	def _load_cached(self, entry, unhandled_return, function_type, report):
+		functions = []
+		for name, anonymous, static, max_args, min_args, compiled, fstring_relocs, info in entry:
+			func = Function(name)
+			func.anonymous = anonymous
+			func.static = static
+			func.max_args = max_args
+			func.min_args = min_args
+			func.fstring_relocs = fstring_relocs
+			func.info = info
+
+			# the fstring functions are loaded again, so their new addresses must be set in the image
+			compiled = bytearray(compiled)
+			for offset, num_args in fstring_relocs:
+				special = "fstring%d" % num_args
+				if not special in func.special_funcs:
+					func.special_funcs[special] = self.compile(fstring_source(num_args))[0]
+				struct.pack_into("P", compiled, offset, func.special_funcs[special].addr)
+			func.compiled[(unhandled_return, function_type)] = str(compiled)
+			functions.append(func)
+
+		# load all the functions together
+		try:
+			self.load_module(functions, unhandled_return, function_type)
+		finally:
+			for func in functions:
+				report.add_function(func)
+
+		return filter(lambda i:not i.static, functions)
+
 	def unload(self, func):
 		for f in func.special_funcs.keys():
 			func.special_funcs[f].unload()
@@ -130,12 +396,48 @@ class Plug(object):
 		self._exec_cmd(op, length, 0, ptr, 0)
 		self.funcs.remove(func)
 
+	# unload functions and the functions that they use with a single command (or one for every MODULE_MAX functions).
+	# the kernel removes all the functions of a command together, or none of them if one of them is not loaded
+	def unload_module(self, funcs):
+		funcs = list(funcs)
+		for func in funcs:
+			for special in func.special_funcs.values():
+				if not special in funcs:
+					funcs.append(special)
+			func.special_funcs = {}
+
+		if not self._has_modules():
+			# an old kplugs without modules
+			for func in funcs:
+				self.unload(func)
+			return
+
+		if self.glob:
+			op = Plug.KPLUGS_UNLOAD_MODULE | (1 << 7) # add the global flag
+		else:
+			op = Plug.KPLUGS_UNLOAD_MODULE
+
+		for first in xrange(0, len(funcs), Plug.MODULE_MAX):
+			part = funcs[first:first + Plug.MODULE_MAX]
+			handles = array.array('L', [func.addr for func in part])
+
+			# send the command (will throw an exception if it fails)
+			self._exec_cmd(op, len(handles) * WORD_SIZE, 0, handles.buffer_info()[0], 0)
+			for func in part:
+				self.funcs.remove(func)
+
 
 	def __call__(self, func, *args):
 		if not func in self.funcs:
 			raise Exception("This function doesn't belongs to this plug")
 
-		if func.anonymous:
+		if self._has_handles():
+			# execute by the function's handle, so the kernel doesn't have to look for its name
+			op = Plug.KPLUGS_EXECUTE_HANDLE
+			length = 0
+			ptr = func.addr
+		elif func.anonymous:
+			# an old kplugs without handles
 			op = Plug.KPLUGS_EXECUTE_ANONYMOUS
 			length = 0
 			ptr = func.addr
@@ -147,25 +449,205 @@ class Plug(object):
 
 		new_args = []
 		bufs = []
-		for arg in args:
-			add = arg
-			if isinstance(arg, str):
-				bufs.append(ctypes.c_buffer(arg))
-				add = ctypes.addressof(bufs[-1])
-			new_args.append(add)
-		args_buf = ctypes.c_buffer(struct.pack("P" * len(new_args), *new_args))
+		allocs = []
+		try:
+			for arg in args:
+				add = arg
+				if isinstance(arg, KMap):
+					add = arg.addr
+				elif isinstance(arg, str):
+					add = None
+					if self.arena is not None:
+						# strings in the arena are inside memory, so the kernel doesn't have to map them
+						add = self.arena.alloc(len(arg) + 1, False)
+						if add is not None:
+							allocs.append(add)
+							self.arena.write(add, arg + '\0')
+					if add is None:
+						bufs.append(ctypes.c_buffer(arg))
+						add = ctypes.addressof(bufs[-1])
+				new_args.append(add)
+			args_buf = ctypes.c_buffer(struct.pack("P" * len(new_args), *new_args))
+
+			# send the command (will throw an exception if it fails)
+			return self._exec_cmd(op, length, len(args) * WORD_SIZE, ptr, ctypes.addressof(args_buf))
+		finally:
+			for addr in allocs:
+				self.arena.free(addr)
+
+	# get the profiling counters of a function that was loaded with Function.FUNC_PROFILE
+	# (only a kplugs that was built with PROFILING, like the debug build, has them)
+	def stats(self, func):
+		if not func in self.funcs:
+			raise Exception("This function doesn't belongs to this plug")
+
+		while True:
+			data = array.array('L', [0]) * (FunctionStats.HEADER + getattr(func, "num_opcodes", 0))
+
+			# send the command (will throw an exception if it fails)
+			num_opcodes = self._exec_cmd(Plug.KPLUGS_GET_STATS, 0, len(data) * WORD_SIZE, func.addr, data.buffer_info()[0])
+			func.num_opcodes = num_opcodes
+			if len(data) >= FunctionStats.HEADER + num_opcodes:
+				return FunctionStats(data)
+
+	# create a memory that is shared with the kernel. addresses allocated from it can be passed to functions
+	# (as strings, buffers or results) without the kernel mapping the user's memory on every call
+	def map_arena(self, size = 0x100000):
+		if self.arena is not None:
+			raise Exception("This plug already has an arena")
+
+		size = (size + mmap.PAGESIZE - 1) & ~(mmap.PAGESIZE - 1)
+
+		# send the command (will throw an exception if it fails)
+		addr = self._exec_cmd(Plug.KPLUGS_CREATE_ARENA, size, 0, 0, 0)
+		self.arena = Arena(self.fd, addr, size)
+		return self.arena
+
+	# create the rings that functions write records to with emit(buf, length) - one ring of ring_size bytes for every cpu.
+	# a full ring drops the new records, or overwrites its oldest ones if overwrite is True.
+	# the functions of a global plug emit to the global rings, that are shared by all the global plugs
+	def open_events(self, ring_size = 0x10000, overwrite = False):
+		if self.events is not None:
+			raise Exception("This plug already has events")
+		if ring_size < mmap.PAGESIZE or ring_size & (ring_size - 1):
+			raise Exception("The size of a ring must be a power of two, and at least a page")
+
+		op = Plug.KPLUGS_CREATE_EVENTS
+		offset = Plug.EVENTS_OFFSET
+		if self.glob:
+			op |= (1 << 7) # add the global flag
+			offset = Plug.GLOBAL_EVENTS_OFFSET
+
+		# send the command (will throw an exception if it fails)
+		size = self._exec_cmd(op, ring_size, EventStream.OVERWRITE if overwrite else 0, 0, 0)
+		self.events = EventStream(self.fd, size, offset)
+		return self.events
+
+	# create a map of words to words with a fixed capacity, that functions get as an argument and use with
+	# map_lookup, map_update, map_add and map_delete
+	def create_map(self, capacity):
+		if capacity <= 0:
+			raise Exception("The capacity of a map must be positive")
+
+		op = Plug.KPLUGS_CREATE_MAP
+		if self.glob:
+			op |= (1 << 7) # add the global flag
+
+		# send the command (will throw an exception if it fails)
+		addr = self._exec_cmd(op, capacity, 0, 0, 0)
+		kmap = KMap(self, addr, capacity)
+		self.maps.append(kmap)
+		return kmap
+
+	# execute a function on every cpu of a mask (a number with a bit for every cpu, a list of cpus, or None for all of them),
+	# in a single command. the function runs in a kernel worker on every cpu (all of them together), or from an ipi with
+	# the interrupts disabled if ipi = True is given (then it must not sleep or run for long). either way it can't reach
+	# the memory of this process, so a string argument is copied to the arena. returns a list of the results and a list
+	# of the exceptions (0 if the cpu didn't raise one), indexed by the cpu. both are None for the cpus that the function
+	# didn't run on
+	def on_cpus(self, func, mask, *args, **kwargs):
+		if not func in self.funcs:
+			raise Exception("This function doesn't belongs to this plug")
+
+		ipi = kwargs.pop("ipi", False)
+		if kwargs:
+			raise Exception("Unknown arguments: %s" % (', '.join(kwargs.keys()), ))
+
+		num_cpus = possible_cpus()
+		bits = array.array('L', [0]) * ((num_cpus + WORD_SIZE * 8 - 1) / (WORD_SIZE * 8))
+		mask_addr = 0
+		if mask is not None:
+			if isinstance(mask, (int, long)):
+				mask = [cpu for cpu in xrange(num_cpus) if mask & (1 << cpu)]
+			for cpu in mask:
+				if cpu < 0 or cpu >= num_cpus:
+					raise Exception("There is no cpu %d" % (cpu, ))
+				bits[cpu / (WORD_SIZE * 8)] |= 1 << (cpu % (WORD_SIZE * 8))
+			mask_addr = bits.buffer_info()[0]
+
+		results = array.array('L', [0]) * num_cpus
+		exceptions = array.array('L', [0]) * num_cpus
+		ran = array.array('L', [0]) * num_cpus
+
+		new_args = []
+		allocs = []
+		try:
+			for arg in args:
+				add = arg
+				if isinstance(arg, KMap):
+					add = arg.addr
+				elif isinstance(arg, str):
+					add = None
+					if self.arena is not None:
+						add = self.arena.alloc(len(arg) + 1, False)
+					if add is None:
+						raise Exception("A string can be passed to a function on other cpus only through an arena")
+					allocs.append(add)
+					self.arena.write(add, arg + '\0')
+				new_args.append(add)
+			args_buf = ctypes.c_buffer(struct.pack("P" * len(new_args), *new_args))
+
+			cpus = ctypes.c_buffer(struct.pack("PPPPPPPP", len(new_args), num_cpus, Plug.CPUS_IPI if ipi else 0, ctypes.addressof(args_buf),
+						mask_addr, results.buffer_info()[0], exceptions.buffer_info()[0], ran.buffer_info()[0]))
+
+			# send the command (will throw an exception if it fails)
+			self._exec_cmd(Plug.KPLUGS_EXECUTE_CPUS, 0, WORD_SIZE * 8, func.addr, ctypes.addressof(cpus))
+		finally:
+			for addr in allocs:
+				self.arena.free(addr)
+
+		return ([results[cpu] if ran[cpu] else None for cpu in xrange(num_cpus)],
+			[exceptions[cpu] if ran[cpu] else None for cpu in xrange(num_cpus)])
+
+	# execute a function once for every row of a matrix of arguments, in a single command.
+	# args is an array('L'), a 2d numpy array of words or any other buffer of words.
+	# returns an array of the results and an array of the exceptions (0 if the row didn't raise one)
+	def map(self, func, args, cols = None):
+		if not func in self.funcs:
+			raise Exception("This function doesn't belongs to this plug")
+
+		if cols is None:
+			shape = getattr(args, "shape", None)
+			if shape is not None and len(shape) == 2:
+				cols = shape[1]
+			else:
+				cols = func.max_args
+		if cols <= 0:
+			raise Exception("Cannot map a function without arguments")
+
+		args_buf = buffer_of(args)
+		size = ctypes.sizeof(args_buf)
+		if size % (cols * WORD_SIZE) != 0:
+			raise Exception("The arguments are not rows of %d words" % cols)
+		rows = size / (cols * WORD_SIZE)
+
+		results = array.array('L', [0]) * rows
+		exceptions = array.array('L', [0]) * rows
+		if rows == 0:
+			return results, exceptions
+
+		batch = ctypes.c_buffer(struct.pack("PPPPP", rows, cols, ctypes.addressof(args_buf), results.buffer_info()[0], exceptions.buffer_info()[0]))
 
 		# send the command (will throw an exception if it fails)
-		return self._exec_cmd(op, length, len(args) * WORD_SIZE, ptr, ctypes.addressof(args_buf))
+		self._exec_cmd(Plug.KPLUGS_EXECUTE_BATCH, 0, WORD_SIZE * 5, func.addr, ctypes.addressof(batch))
+		return results, exceptions
 
 	# you MUST call this member if the plug is global or the functions will never be freed!
 	def close(self):
 		if self.glob:
-			while len(self.funcs) != 0:
-				self.unload(self.funcs[0])
+			self.unload_module(self.funcs)
+			while len(self.maps) != 0:
+				self.maps[0].delete()
 
 		# we don't need to unload functions if it's not global because closing the file will do it for us
 		self.funcs = []
+		self.maps = []
+		if self.arena is not None:
+			self.arena.close()
+			self.arena = None
+		if self.events is not None:
+			self.events.close()
+			self.events = None
 		if self.fd >= 0:
 			os.close(self.fd)
 			self.fd = -1
@@ -173,8 +655,458 @@ class Plug(object):
 
 
 
+# the profiling counters of a function (returned by Plug.stats)
+class FunctionStats(object):
+
+	HEADER = 3 # calls, total_ns, max_ns
+
+	def __init__(self, data):
+		self.calls = data[0]
+		self.total_ns = data[1]
+		self.max_ns = data[2]
+
+		# the number of times every opcode (by its pc) was executed
+		self.pc_counts = data[FunctionStats.HEADER:]
+
+	# the (pc, count) of the most executed opcodes
+	def hottest(self, count = 10):
+		counts = self.pc_counts
+		return sorted([(pc, counts[pc]) for pc in xrange(len(counts)) if counts[pc]], key = lambda i:i[1], reverse = True)[:count]
+
+	def __repr__(self):
+		return "<FunctionStats calls=%d total_ns=%d max_ns=%d>" % (self.calls, self.total_ns, self.max_ns)
+
+
+# the phase times and the sizes of the functions of a compilation (returned by Plug.compile)
+class CompileReport(object):
+
+	MAX_STACK_FRAME = 0x200 # the kernel's limit of a function's variables size
+
+	def __init__(self):
+		self.start = time.time()
+		self.total = 0
+		self.cached = False
+		self.phases = {"parse" : 0, "visitor" : 0, "optimize" : 0, "order_blocks" : 0, "translate" : 0, "load" : 0}
+		self.functions = []
+
+	# measure the time of a phase
+	def phase(self, name):
+		return _ReportPhase(self, name)
+
+	def add_function(self, func):
+		record = {	"name" : func.name,
+				"anonymous" : func.anonymous,
+				"static" : func.static }
+		record.update(func.info)
+		record["frame_overflow"] = record.get("frame_size", 0) > CompileReport.MAX_STACK_FRAME
+		record.update(func.times)
+		for name, value in func.times.iteritems():
+			self.phases[name] += value
+		self.functions.append(record)
+
+	def finish(self):
+		self.total = time.time() - self.start
+		return self
+
+	# a line for the compilation and a line for every function
+	def to_json_lines(self):
+		lines = [json.dumps(dict(self.phases, type = "compile", total = self.total, cached = self.cached, num_functions = len(self.functions)), sort_keys = True)]
+		for record in self.functions:
+			lines.append(json.dumps(dict(record, type = "function"), sort_keys = True))
+		return '\n'.join(lines) + '\n'
+
+	def write(self, f):
+		f.write(self.to_json_lines())
+
+	def __repr__(self):
+		return "<CompileReport total=%f functions=%d>" % (self.total, len(self.functions))
+
+
+class _ReportPhase(object):
+
+	def __init__(self, report, name):
+		self.report = report
+		self.name = name
+
+	def __enter__(self):
+		self.start = time.time()
+
+	def __exit__(self, *args):
+		self.report.phases[self.name] += time.time() - self.start
+		return False
+
+
+# a persistent cache of compiled functions, that can be shared by processes.
+# every entry holds the functions of one Plug.compile call, by a hash of everything their images depend on
+class CompileCache(object):
+
+	# change it whenever the compiler's output changes
+	FORMAT_VERSION = 7
+
+	def __init__(self, path = None, max_size = 0x4000000):
+		if path is None:
+			path = os.path.join(os.path.expanduser("~"), ".cache", "kplugs")
+		if not os.path.isdir(path):
+			try:
+				os.makedirs(path)
+			except OSError:
+				# maybe another process created it
+				if not os.path.isdir(path):
+					raise
+
+		self.path = path
+		self.max_size = max_size
+		self.hits = 0
+		self.misses = 0
+		self.stores = 0
+		self.evictions = 0
+		self._lock = threading.Lock()
+
+	def _entry_path(self, code, unhandled_return, function_type):
+		if isinstance(code, unicode):
+			code = code.encode("utf-8")
+		digest = hashlib.sha1(repr((CompileCache.FORMAT_VERSION, WORD_SIZE, VERSION, marshal.version, unhandled_return, function_type)))
+		digest.update(code)
+		return os.path.join(self.path, digest.hexdigest() + ".kpc")
+
+	def _count(self, name):
+		with self._lock:
+			setattr(self, name, getattr(self, name) + 1)
+
+	# get the entry of a compilation (None if it's not in the cache)
+	def get(self, code, unhandled_return = None, function_type = 0):
+		path = self._entry_path(code, unhandled_return, function_type)
+		try:
+			with open(path, "rb") as f:
+				entry = marshal.loads(f.read())
+
+			# the eviction removes the entries that were not used for the longest time
+			os.utime(path, None)
+		except (IOError, OSError):
+			self._count("misses")
+			return None
+		except (EOFError, ValueError, TypeError):
+			# a corrupted entry
+			self._remove(path)
+			self._count("misses")
+			return None
+
+		self._count("hits")
+		return entry
+
+	# store the compiled functions of a compilation
+	def put(self, code, unhandled_return, function_type, functions):
+		entry = []
+		for func in functions:
+			compiled = func.to_bytes(unhandled_return, function_type)
+			entry.append((func.name, func.anonymous, func.static, func.max_args, func.min_args, compiled, func.fstring_relocs, func.info))
+
+		# write to a temporary file and rename it, so other processes will never see a partial entry
+		fd, temp = tempfile.mkstemp(prefix = ".tmp", dir = self.path)
+		try:
+			with os.fdopen(fd, "wb") as f:
+				f.write(marshal.dumps(entry))
+			os.rename(temp, self._entry_path(code, unhandled_return, function_type))
+		except:
+			self._remove(temp)
+			raise
+
+		self._count("stores")
+		self._evict()
+
+	def _remove(self, path):
+		try:
+			os.unlink(path)
+			return True
+		except OSError:
+			return False
+
+	def _entries(self):
+		entries = []
+		for name in os.listdir(self.path):
+			if not name.endswith(".kpc"):
+				continue
+			path = os.path.join(self.path, name)
+			try:
+				st = os.stat(path)
+			except OSError:
+				continue
+			entries.append((st.st_mtime, st.st_size, path))
+		return entries
+
+	# remove the least recently used entries until the cache is small enough
+	def _evict(self):
+		entries = self._entries()
+		size = sum(i[1] for i in entries)
+		if size <= self.max_size:
+			return
+
+		entries.sort()
+		for mtime, length, path in entries:
+			if size <= self.max_size:
+				break
+			if self._remove(path):
+				self._count("evictions")
+			size -= length
+
+	def clear(self):
+		for mtime, length, path in self._entries():
+			self._remove(path)
+
+	def stats(self):
+		entries = self._entries()
+		with self._lock:
+			return {	"hits" : self.hits,
+					"misses" : self.misses,
+					"stores" : self.stores,
+					"evictions" : self.evictions,
+					"entries" : len(entries),
+					"size" : sum(i[1] for i in entries),
+					"max_size" : self.max_size }
+
+
+# a memory that is shared with the kernel (created by Plug.map_arena).
+# the allocations are the kernel's addresses of the memory, so a function gets them as inside memory
+class Arena(object):
+
+	ALIGN = 0x10
+
+	def __init__(self, fd, addr, size):
+		self.addr = addr
+		self.size = size
+		self.map = mmap.mmap(fd, size)
+		self.data = (ctypes.c_char * size).from_buffer(self.map)
+		self.user_addr = ctypes.addressof(self.data)
+
+		self.free_list = [(0, size)] # sorted (offset, size) tuples
+		self.allocated = {}
+		self._lock = threading.Lock()
+
+	# allocate memory from the arena. returns its kernel address
+	def alloc(self, size, throw = True):
+		size = max((size + Arena.ALIGN - 1) & ~(Arena.ALIGN - 1), Arena.ALIGN)
+
+		with self._lock:
+			# first fit
+			for i in xrange(len(self.free_list)):
+				offset, length = self.free_list[i]
+				if length >= size:
+					if length == size:
+						del self.free_list[i]
+					else:
+						self.free_list[i] = (offset + size, length - size)
+					self.allocated[offset] = size
+					return self.addr + offset
+
+		if throw:
+			raise Exception("No more memory in the arena")
+		return None
+
+	def free(self, addr):
+		offset = self._offset(addr)
+
+		with self._lock:
+			if not offset in self.allocated:
+				raise Exception("This memory was not allocated from the arena")
+			size = self.allocated.pop(offset)
+
+			# insert the memory back and merge it with its neighbours
+			i = bisect.bisect(self.free_list, (offset, size))
+			if i < len(self.free_list) and self.free_list[i][0] == offset + size:
+				size += self.free_list.pop(i)[1]
+			if i > 0 and sum(self.free_list[i - 1]) == offset:
+				offset, prev_size = self.free_list.pop(i - 1)
+				size += prev_size
+				i -= 1
+			self.free_list.insert(i, (offset, size))
+
+	def _offset(self, addr, length = 0):
+		offset = addr - self.addr
+		if offset < 0 or offset + length > self.size:
+			raise Exception("The address is not in the arena")
+		return offset
+
+	# the user's address of a kernel address in the arena
+	def user_address(self, addr):
+		return self.user_addr + self._offset(addr)
+
+	def read(self, addr, length):
+		offset = self._offset(addr, length)
+		return self.map[offset:offset + length]
+
+	def write(self, addr, data):
+		offset = self._offset(addr, len(data))
+		self.map[offset:offset + len(data)] = data
+
+	def close(self):
+		self.data = None
+		self.map.close()
+
+
+# the events rings of a plug (created by Plug.open_events). every cpu has its own ring that functions write records to
+# with emit(buf, length), and the records are read from the memory of the rings without any command
+class EventStream(object):
+
+	OVERWRITE = 1 # a full ring overwrites its oldest records
+
+	# the offsets of the fields of a ring's header
+	RING_HEAD = 0
+	RING_START = WORD_SIZE
+	RING_LOST = 2 * WORD_SIZE
+	RING_TAIL = 64
+
+	def __init__(self, fd, size, offset):
+		self.fd = fd
+		self.size = size
+		self.map = mmap.mmap(fd, size, offset = offset)
+		self.num_rings, self.ring_size, self.flags = struct.unpack_from("PPP", self.map, 0)
+		self._poll = select.poll()
+		self._poll.register(fd, select.POLLIN)
+		self._lock = threading.Lock()
+
+	def _ring(self, index):
+		return mmap.PAGESIZE + index * (mmap.PAGESIZE + self.ring_size)
+
+	# read the records of a ring that were not read yet
+	def _read_ring(self, index, records):
+		ring = self._ring(index)
+		data = ring + mmap.PAGESIZE
+		head, start = struct.unpack_from("PP", self.map, ring + EventStream.RING_HEAD)
+		tail = struct.unpack_from("P", self.map, ring + EventStream.RING_TAIL)[0]
+
+		overwrite = self.flags & EventStream.OVERWRITE
+		if overwrite and (start - tail) & WORD_MASK < (head - tail) & WORD_MASK:
+			# the records before the start were overwritten (and counted as lost)
+			tail = start
+		length = (head - tail) & WORD_MASK
+		if length == 0 or length > self.ring_size:
+			return
+
+		offset = tail & (self.ring_size - 1)
+		first = min(length, self.ring_size - offset)
+		chunk = self.map[data + offset : data + offset + first] + self.map[data : data + length - first]
+
+		if overwrite:
+			# the kernel may have overwritten some of the records while we were copying them
+			start = struct.unpack_from("P", self.map, ring + EventStream.RING_START)[0]
+			skip = (start - tail) & WORD_MASK
+			if skip <= length:
+				chunk = chunk[skip:]
+
+		i = 0
+		while i + WORD_SIZE <= len(chunk):
+			size = struct.unpack_from("P", chunk, i)[0]
+			if i + WORD_SIZE + size > len(chunk):
+				break
+			records.append(chunk[i + WORD_SIZE : i + WORD_SIZE + size])
+			i += WORD_SIZE + ((size + WORD_SIZE - 1) & ~(WORD_SIZE - 1))
+
+		# let the kernel write over the records
+		struct.pack_into("P", self.map, ring + EventStream.RING_TAIL, head)
+
+	# read all the records that were not read yet (the records of every cpu are in the order they were written)
+	def read(self):
+		records = []
+		with self._lock:
+			for index in xrange(self.num_rings):
+				self._read_ring(index, records)
+		return records
+
+	# the number of records that were dropped or overwritten before they were read, on every cpu
+	def lost_per_cpu(self):
+		return [struct.unpack_from("P", self.map, self._ring(index) + EventStream.RING_LOST)[0] for index in xrange(self.num_rings)]
+
+	@property
+	def lost(self):
+		return sum(self.lost_per_cpu())
+
+	# the stream can be waited for with select, poll or epoll, it's readable when there are records to read
+	def fileno(self):
+		return self.fd
+
+	# wait until there are records to read (timeout is in seconds). returns False if the timeout has passed
+	def wait(self, timeout = None):
+		return len(self._poll.poll(None if timeout is None else int(timeout * 1000))) != 0
+
+	# yield batches of records as they are written. stops if no record was written for timeout seconds
+	def batches(self, timeout = None):
+		while True:
+			records = self.read()
+			if records:
+				yield records
+			elif not self.wait(timeout):
+				return
+
+	def __iter__(self):
+		return self.batches()
+
+	def close(self):
+		self.map.close()
+
+
+# a map of words to words in the kernel (created by Plug.create_map). it's passed to functions as an argument
+class KMap(object):
+
+	DUMP_CLEAR = 1 # delete all the keys after they were copied
+
+	def __init__(self, plug, addr, capacity):
+		self.plug = plug
+		self.addr = addr
+		self.capacity = capacity
+
+	def _op(self, op):
+		if self.plug.glob:
+			op |= (1 << 7) # add the global flag
+		return op
+
+	# copy all the keys and their values with one command. returns an array of the keys and an array of their values
+	def dump(self, clear = False):
+		data = array.array('L', [0]) * (2 * self.capacity)
+
+		# send the command (will throw an exception if it fails)
+		count = self.plug._exec_cmd(self._op(Plug.KPLUGS_DUMP_MAP), KMap.DUMP_CLEAR if clear else 0, len(data) * WORD_SIZE, self.addr, data.buffer_info()[0])
+		return data[:count], data[self.capacity:self.capacity + count]
+
+	# the keys and their values as a dictionary
+	def items(self, clear = False):
+		keys, values = self.dump(clear)
+		return dict(zip(keys, values))
+
+	# delete all the keys
+	def clear(self):
+		self.plug._exec_cmd(self._op(Plug.KPLUGS_DUMP_MAP), KMap.DUMP_CLEAR, 0, self.addr, 0)
+
+	def delete(self):
+		self.plug._exec_cmd(self._op(Plug.KPLUGS_DELETE_MAP), 0, 0, self.addr, 0)
+		self.plug.maps.remove(self)
+
+
+# the number of cpus that the kernel can have (the highest possible cpu + 1)
+def possible_cpus():
+	try:
+		with open("/sys/devices/system/cpu/possible") as f:
+			return int(f.read().strip().split(",")[-1].split("-")[-1]) + 1
+	except (IOError, ValueError):
+		return os.sysconf("SC_NPROCESSORS_CONF")
+
+# get a ctypes array that shares the memory of a buffer (or a copy of it if the buffer is read only)
+def buffer_of(obj):
+	try:
+		size = len(buffer(obj))
+	except TypeError:
+		obj = memoryview(obj).tobytes()
+		size = len(obj)
+
+	try:
+		return (ctypes.c_char * size).from_buffer(obj)
+	except TypeError:
+		buf = (ctypes.c_char * size)()
+		ctypes.memmove(buf, str(buffer(obj)), size)
+		return buf
+
+
 RESERVED_PREFIX =	["KERNEL"]
-RESERVED_NAMES = 	["VARIABLE_ARGUMENT", "ANONYMOUS", "STATIC", "ADDRESSOF", "word", "buffer", "array", "pointer", "new", "delete"]
+RESERVED_NAMES = 	["VARIABLE_ARGUMENT", "ANONYMOUS", "STATIC", "INLINE", "ADDRESSOF", "UNSIGNED", "emit", "map_lookup", "map_update", "map_add", "map_delete", "word", "buffer", "array", "pointer", "new", "delete"]
 RESERVED_FUNCTIONS = 	["_"]
 
 # validate name
@@ -185,6 +1117,24 @@ def validate_name(name):
 	if name in RESERVED_NAMES or name in RESERVED_FUNCTIONS:
 		raise Exception("Illegal function name: '%s'" % (name, ))
 
+# get the signed value of a word
+def signed_word(value):
+	if value & (1 << (WORD_SIZE * 8 - 1)):
+		return value - (1 << (WORD_SIZE * 8))
+	return value
+
+# add a number to a compact image (7 bits in every byte, the high bit marks that another byte follows)
+def compact_number(out, value):
+	while value >= 0x80:
+		out.append((value & 0x7f) | 0x80)
+		value >>= 7
+	out.append(value)
+
+# a signed value is kept in a compact image as its absolute value shifted left, with the sign in the low bit
+def compact_signed(value):
+	value = signed_word(value)
+	return ((value << 1) ^ (value >> (WORD_SIZE * 8 - 1))) & WORD_MASK
+
 # a Function class
 # you should not use it directly but through the Plug class
 class Function(object):
@@ -214,6 +1164,16 @@ class Function(object):
 	FLOW_THROW = 7
 	FLOW_RET = 8
 
+	FLOW_IF_CMP = 9
+	FLOW_WHILE_CMP = 10
+
+	FLOW_FOR = 11
+	FLOW_BREAK = 12
+	FLOW_CONTINUE = 13
+
+	FLOW_MAP_UPDATE = 14
+	FLOW_MAP_ADD = 15
+
 	# Expressions:
 	EXP_WORD = 0
 	EXP_VAR = 1
@@ -245,9 +1205,152 @@ class Function(object):
 	EXP_DYN_ALLOC = 25
 	EXP_ARGS = 26
 	EXP_EXP = 27
+	EXP_SHL = 28
+	EXP_SHR = 29
+	EXP_CMP_NE = 30
+	EXP_CMP_LE_UNSIGN = 31
+	EXP_CMP_LE_SIGN = 32
+	EXP_CMP_GT_UNSIGN = 33
+	EXP_CMP_GT_SIGN = 34
+	EXP_CMP_GE_UNSIGN = 35
+	EXP_CMP_GE_SIGN = 36
+	EXP_EMIT = 37
+	EXP_MAP_LOOKUP = 38
+	EXP_MAP_DELETE = 39
 
 	FUNC_VARIABLE_ARGUMENT = 1
 	FUNC_EXTERNAL = 2
+	FUNC_PROFILE = 4 # load with this function type to collect FunctionStats
+
+	# one bytecode record
+	RECORD = struct.Struct("PPPP")
+
+	# the number of operands that flows and expressions have in a compact image (the others must be zero)
+	COMPACT_FLOW_OPERANDS =	{
+				FLOW_ASSIGN : 2,
+				FLOW_ASSIGN_OFFSET : 3,
+				FLOW_IF : 3,
+				FLOW_TRY : 2,
+				FLOW_WHILE : 2,
+				FLOW_DYN_FREE : 1,
+				FLOW_BLOCKEND : 0,
+				FLOW_THROW : 1,
+				FLOW_RET : 1,
+				FLOW_IF_CMP : 3,
+				FLOW_WHILE_CMP : 2,
+				FLOW_FOR : 3,
+				FLOW_BREAK : 0,
+				FLOW_CONTINUE : 0,
+				FLOW_MAP_UPDATE : 3,
+				FLOW_MAP_ADD : 3,
+				}
+	COMPACT_EXP_OPERANDS =	{ # the other expressions have two
+				EXP_WORD : 1,
+				EXP_VAR : 1,
+				EXP_STRING : 1,
+				EXP_EXCEPTION_VAR : 0,
+				EXP_ADDRESSOF : 1,
+				EXP_NOT : 1,
+				EXP_BOOL_NOT : 1,
+				EXP_CALL_END : 0,
+				EXP_ARGS : 0,
+				EXP_EXP : 1,
+				}
+
+	# the types of the values that are blocks of their own
+	BLOCK_TYPES = (list, dict)
+
+	# constant folding (the same as the vm calculates it. None if it must be left for the vm)
+	FOLD_BINARY =	{
+				EXP_ADD : lambda a, b: a + b,
+				EXP_SUB : lambda a, b: a - b,
+				EXP_MUL : lambda a, b: a * b,
+				EXP_DIV : lambda a, b: a / b if b else None, # throws an exception
+				EXP_MOD : lambda a, b: a % b if b else None,
+				EXP_AND : lambda a, b: a & b,
+				EXP_XOR : lambda a, b: a ^ b,
+				EXP_OR : lambda a, b: a | b,
+				EXP_BOOL_AND : lambda a, b: int(bool(a and b)),
+				EXP_BOOL_OR : lambda a, b: a if a else int(bool(b)), # the vm returns the first operand if it's true
+				EXP_CMP_EQ : lambda a, b: int(a == b),
+				EXP_CMP_UNSIGN : lambda a, b: int(a < b),
+				EXP_CMP_SIGN : lambda a, b: int(signed_word(a) < signed_word(b)),
+				EXP_SHL : lambda a, b: a << b if b < WORD_SIZE * 8 else 0,
+				EXP_SHR : lambda a, b: a >> b if b < WORD_SIZE * 8 else 0,
+				EXP_CMP_NE : lambda a, b: int(a != b),
+				EXP_CMP_LE_UNSIGN : lambda a, b: int(a <= b),
+				EXP_CMP_LE_SIGN : lambda a, b: int(signed_word(a) <= signed_word(b)),
+				EXP_CMP_GT_UNSIGN : lambda a, b: int(a > b),
+				EXP_CMP_GT_SIGN : lambda a, b: int(signed_word(a) > signed_word(b)),
+				EXP_CMP_GE_UNSIGN : lambda a, b: int(a >= b),
+				EXP_CMP_GE_SIGN : lambda a, b: int(signed_word(a) >= signed_word(b)),
+			}
+
+	FOLD_UNARY =	{
+				EXP_NOT : lambda a: ~a,
+				EXP_BOOL_NOT : lambda a: int(not a),
+			}
+
+	CMP_EXPS = (EXP_CMP_EQ, EXP_CMP_NE, EXP_CMP_UNSIGN, EXP_CMP_SIGN, EXP_CMP_LE_UNSIGN, EXP_CMP_LE_SIGN, EXP_CMP_GT_UNSIGN, EXP_CMP_GT_SIGN, EXP_CMP_GE_UNSIGN, EXP_CMP_GE_SIGN)
+
+	# expressions that their value is always 0 or 1 (not EXP_BOOL_OR, that returns its first operand if it's true)
+	BOOL_EXPS = CMP_EXPS + (EXP_BOOL_AND, EXP_BOOL_NOT)
+
+	# expressions that can't throw an exception or change anything (if their operands can't)
+	LEAF_EXPS = (EXP_WORD, EXP_VAR, EXP_STRING, EXP_EXCEPTION_VAR, EXP_ARGS)
+	PURE_EXPS = (EXP_ADD, EXP_SUB, EXP_MUL, EXP_AND, EXP_XOR, EXP_OR, EXP_SHL, EXP_SHR, EXP_BOOL_AND, EXP_BOOL_OR, EXP_NOT, EXP_BOOL_NOT) + CMP_EXPS
+
+	# the fields of the flows that are expressions, and the fields that are flow blocks
+	FLOW_EXPS =	{
+				FLOW_ASSIGN : ("val2", ),
+				FLOW_ASSIGN_OFFSET : ("val2", "val3"),
+				FLOW_IF : ("val1", ),
+				FLOW_WHILE : ("val1", ),
+				FLOW_IF_CMP : ("val1", ),
+				FLOW_WHILE_CMP : ("val1", ),
+				FLOW_FOR : ("val1", ),
+				FLOW_DYN_FREE : ("val1", ),
+				FLOW_MAP_UPDATE : ("val2", "val3"),
+				FLOW_MAP_ADD : ("val2", "val3"),
+				FLOW_THROW : ("val1", ),
+				FLOW_RET : ("val1", ),
+			}
+	FLOW_BLOCKS =	{
+				FLOW_IF : ("val2", "val3"),
+				FLOW_TRY : ("val1", "val2"),
+				FLOW_WHILE : ("val2", ),
+				FLOW_IF_CMP : ("val2", "val3"),
+				FLOW_WHILE_CMP : ("val2", ),
+				FLOW_FOR : ("val2", "val3"),
+			}
+
+	# the flows that use the map in the variable in val1
+	MAP_FLOWS = (FLOW_MAP_UPDATE, FLOW_MAP_ADD)
+
+	# the flows and the expressions that has the id of a variable in val1
+	VAR_FLOWS = (FLOW_ASSIGN, FLOW_ASSIGN_OFFSET) + MAP_FLOWS
+	VAR_EXPS = (EXP_VAR, EXP_ADDRESSOF, EXP_BUF_OFFSET)
+
+	# the expressions that has the index of a string in val1
+	STRING_EXPS = (EXP_STRING, EXP_CALL_STRING)
+
+	# the fields of the expressions that are expressions (a number in them is the id of a variable)
+	EXP_OPERANDS =	dict(	[(i, ("val1", "val2")) for i in FOLD_BINARY] +
+				[(i, ("val1", )) for i in FOLD_UNARY] + [
+				(EXP_DEREF, ("val1", )),
+				(EXP_BUF_OFFSET, ("val2", )),
+				(EXP_CALL_PTR, ("val1", )),
+				(EXP_DYN_ALLOC, ("val1", )),
+				(EXP_EMIT, ("val1", "val2")),
+				(EXP_MAP_LOOKUP, ("val1", "val2")),
+				(EXP_MAP_DELETE, ("val1", "val2")),
+				(EXP_EXP, ("val1", ))])
+
+	# the flows that evaluate their expressions once, before they do anything else
+	SHARE_FLOWS = (FLOW_ASSIGN, FLOW_ASSIGN_OFFSET, FLOW_IF, FLOW_IF_CMP, FLOW_DYN_FREE, FLOW_THROW, FLOW_RET) + MAP_FLOWS
+
+	# expressions that can be computed once if they are repeated in a flow
+	SHARED_EXPS = PURE_EXPS + (EXP_DIV, EXP_MOD, EXP_DEREF, EXP_BUF_OFFSET)
 
 	# expression operation types:
 
@@ -259,6 +1362,39 @@ class Function(object):
 				BitAnd : EXP_AND,
 				BitOr : EXP_OR,
 				Mod : EXP_MOD,
+				BitXor : EXP_XOR,
+				LShift : EXP_SHL,
+				RShift : EXP_SHR,
+			}
+
+	# compare operation types: (signed, unsigned)
+	CMPOP =		{
+				Eq : (EXP_CMP_EQ, EXP_CMP_EQ),
+				NotEq : (EXP_CMP_NE, EXP_CMP_NE),
+				Lt : (EXP_CMP_SIGN, EXP_CMP_UNSIGN),
+				LtE : (EXP_CMP_LE_SIGN, EXP_CMP_LE_UNSIGN),
+				Gt : (EXP_CMP_GT_SIGN, EXP_CMP_GT_UNSIGN),
+				GtE : (EXP_CMP_GE_SIGN, EXP_CMP_GE_UNSIGN),
+			}
+
+	# the compare that is the opposite of every compare
+	INVERSE_CMP =	{
+				EXP_CMP_EQ : EXP_CMP_NE,
+				EXP_CMP_NE : EXP_CMP_EQ,
+				EXP_CMP_SIGN : EXP_CMP_GE_SIGN,
+				EXP_CMP_GE_SIGN : EXP_CMP_SIGN,
+				EXP_CMP_UNSIGN : EXP_CMP_GE_UNSIGN,
+				EXP_CMP_GE_UNSIGN : EXP_CMP_UNSIGN,
+				EXP_CMP_LE_SIGN : EXP_CMP_GT_SIGN,
+				EXP_CMP_GT_SIGN : EXP_CMP_LE_SIGN,
+				EXP_CMP_LE_UNSIGN : EXP_CMP_GT_UNSIGN,
+				EXP_CMP_GT_UNSIGN : EXP_CMP_LE_UNSIGN,
+			}
+
+	# the flows that has a fused form that compares by itself
+	CMP_FLOWS =	{
+				FLOW_IF : FLOW_IF_CMP,
+				FLOW_WHILE : FLOW_WHILE_CMP,
 			}
 
 	UNARYOP =	{
@@ -289,9 +1425,15 @@ class Function(object):
 		self.vars = [] # the order is importand here
 		self.args = [] # the order is importand here
 		self.string_table = [] # the order is importand here
+		self.string_index = {}
+		self.compiled = {} # to_bytes results by (unhandled_return, function_type)
+		self.fstring_relocs = [] # (offset, number of arguments) of every fstring function's address in the image
+		self.info = {} # the sizes of the image (see CompileReport)
+		self.times = {} # the time of every phase of the last compilation (see CompileReport)
 		self.anonymous = False
 		self.static = False
 		self.special_funcs = {}
+		self._loop_exits = [] # what is alive after the loops that the liveness analysis is in, and at their next iterations
 
 	# get a function type opcode
 	def _get_func(self, 	args,
@@ -326,7 +1468,7 @@ class Function(object):
 				"val3" : val3 }
 
 	# get an expression type opcode
-	def _get_exp(self, typ, val1 = 0, val2 = 0, force = False):
+	def _get_exp(self, typ, val1 = 0, val2 = 0, force = False, fstring = None):
 		if typ == Function.EXP_VAR:
 			val1 = self._get_var_id(val1)
 			if val1["type"] == Function.VAR_ARRAY or val1["type"] == Function.VAR_BUF:
@@ -334,10 +1476,14 @@ class Function(object):
 			val1 = val1["id"]
 			if not force:
 				return val1
-		return {	"op" : Function.OP_EXPRESSION, 
+		ret = {	"op" : Function.OP_EXPRESSION, 
 				"type" : typ,
 				"val1" : val1,
 				"val2" : val2 }
+		if fstring is not None:
+			# val1 is the address of a fstring function
+			ret["fstring"] = fstring
+		return ret
 
 	# get the id of a variable
 	def _get_var_id(self, var_name, size = WORD_SIZE, create = False, typ = VAR_WORD, init = 0, flags = 0):
@@ -355,68 +1501,575 @@ class Function(object):
 			self.all_vars[var_name] = {"id":self.all_vars[var_name]["id"], "type":typ, "size":size, "init":init, "flags":flags}
 		return self.all_vars[var_name]
 
-	# arrange the blocks and set offsets values where it is needed
+	# arrange the blocks and set offsets values where it is needed.
+	# the blocks are placed in pre-order, every block right after the blocks that were placed before it
 	def _order_blocks(self, block):
-		this_block = []
-		self.all_blocks.append(this_block)
-
-		if type(block) == dict:
-			# this is an expression bloc
-			self.end += 1
-			to_add = {}
-			for i in block.keys():
-				j = block[i]
-				if type(block[i]) == list or type(block[i]) == dict:
-					j = self.end # this block will be located in offset self.end
-					self._order_blocks(block[i])
-				to_add[i] = j
-			this_block.append(to_add)
-
-		elif type(block) == list:
-			# this is a flow block
-			self.end += len(block)
-			for cmd in block:
-				to_add = {}
-				for i in cmd.keys():
-					j = cmd[i]
-					if type(cmd[i]) == list or type(cmd[i]) == dict:
-						j = self.end # this block will be located in offset self.end
-						self._order_blocks(cmd[i])
-					to_add[i] = j
+		# (block, record that points to it, the key in the record)
+		pending = [(block, None, None)]
+
+		while pending:
+			block, parent, key = pending.pop()
+			if parent is not None:
+				parent[key] = self.end # this block will be located in offset self.end
+
+			this_block = []
+			self.all_blocks.append(this_block)
+
+			if type(block) == dict:
+				# this is an expression bloc
+				self.end += 1
+				cmds = [block]
+			elif type(block) == list:
+				# this is a flow block
+				self.end += len(block)
+				cmds = block
+			else:
+				# we should never get here!
+				raise Exception("order_blocks unexpected behavior")
+
+			children = []
+			for cmd in cmds:
+				to_add = cmd
+				for i, j in cmd.iteritems():
+					if type(j) in Function.BLOCK_TYPES:
+						if to_add is cmd:
+							# the offsets are set in a copy, so the function's code is left untouched
+							to_add = dict(cmd)
+						children.append((j, to_add, i))
 				this_block.append(to_add)
+
+			# the first child should be placed first
+			children.reverse()
+			pending += children
+
+	# optimize a flow block: fold constants, simplify identities and prune the branches of constant tests.
+	# the function's code is left untouched, every changed record is a new one
+	def _optimize_flow(self, block):
+		ret = []
+		for flow in block:
+			new_flow = dict(flow)
+			for key in ("val1", "val2", "val3"):
+				value = flow[key]
+				if type(value) == list and value[0]["op"] == Function.OP_FLOW:
+					new_flow[key] = self._optimize_flow(value)
+				elif type(value) in Function.BLOCK_TYPES:
+					new_flow[key] = self._optimize_exp(value)
+			flow = new_flow
+
+			if flow["type"] == Function.FLOW_IF or flow["type"] == Function.FLOW_WHILE or flow["type"] == Function.FLOW_FOR:
+				test = self._const_value(flow["val1"])
+				if test is not None:
+					if flow["type"] != Function.FLOW_IF:
+						if not test:
+							# the loop never runs
+							continue
+					else:
+						branch = flow["val2"] if test else flow["val3"]
+						if branch[-1]["type"] == Function.FLOW_BLOCKEND:
+							ret += branch[:-1]
+							continue
+
+						# the branch returns or throws, so the rest of the block can never be reached
+						return ret + branch
+
+				elif flow["type"] in Function.CMP_FLOWS and type(flow["val1"]) == dict and flow["val1"]["type"] in Function.CMP_EXPS:
+					# the flow can compare the operands by itself
+					flow["type"] = Function.CMP_FLOWS[flow["type"]]
+
+			ret.append(flow)
+		return ret
+
+	# optimize an expression (returns a new one if it was changed)
+	def _optimize_exp(self, exp):
+		if type(exp) == list:
+			# a call: every argument must stay a record of its own
+			return [self._exp_record(self._optimize_exp(i)) for i in exp]
+		if type(exp) != dict:
+			# a variable
+			return exp
+
+		new_exp = None
+		for key, value in exp.iteritems():
+			if type(value) in Function.BLOCK_TYPES:
+				if new_exp is None:
+					new_exp = dict(exp)
+				new_exp[key] = self._optimize_exp(value)
+		if new_exp is not None:
+			exp = new_exp
+
+		if exp["type"] in Function.FOLD_BINARY:
+			return self._simplify_binary(exp)
+		if exp["type"] in Function.FOLD_UNARY:
+			return self._simplify_unary(exp)
+		return exp
+
+	def _simplify_binary(self, exp):
+		typ = exp["type"]
+		left = exp["val1"]
+		right = exp["val2"]
+		a = self._const_value(left)
+		b = self._const_value(right)
+
+		if a is not None and b is not None:
+			value = Function.FOLD_BINARY[typ](a, b)
+			if value is None:
+				return exp
+			return self._get_exp(Function.EXP_WORD, value & WORD_MASK)
+
+		# the right side is never evaluated
+		if typ == Function.EXP_BOOL_AND and a == 0:
+			return self._get_exp(Function.EXP_WORD, 0)
+		if typ == Function.EXP_BOOL_OR and a:
+			return left
+
+		# identities
+		if b == 0 and typ in (Function.EXP_ADD, Function.EXP_SUB, Function.EXP_OR, Function.EXP_XOR, Function.EXP_SHL, Function.EXP_SHR):
+			return left
+		if a == 0 and typ in (Function.EXP_ADD, Function.EXP_OR, Function.EXP_XOR):
+			return right
+		if b == 1 and typ in (Function.EXP_MUL, Function.EXP_DIV):
+			return left
+		if a == 1 and typ == Function.EXP_MUL:
+			return right
+		if typ in (Function.EXP_MUL, Function.EXP_AND):
+			if (a == 0 and self._is_pure(right)) or (b == 0 and self._is_pure(left)):
+				return self._get_exp(Function.EXP_WORD, 0)
+		return exp
+
+	def _simplify_unary(self, exp):
+		typ = exp["type"]
+		operand = exp["val1"]
+		a = self._const_value(operand)
+
+		if a is not None:
+			return self._get_exp(Function.EXP_WORD, Function.FOLD_UNARY[typ](a) & WORD_MASK)
+
+		# not (a < b) is (a >= b)
+		if typ == Function.EXP_BOOL_NOT and type(operand) == dict and operand["type"] in Function.INVERSE_CMP:
+			ret = dict(operand)
+			ret["type"] = Function.INVERSE_CMP[operand["type"]]
+			return ret
+
+		# ~~x and !!x (if x is already 0 or 1)
+		if type(operand) == dict and operand["type"] == typ:
+			inner = operand["val1"]
+			if typ == Function.EXP_NOT or (type(inner) == dict and inner["type"] in Function.BOOL_EXPS):
+				return inner
+		return exp
+
+	# the value of a constant expression (None if it's not a constant)
+	def _const_value(self, exp):
+		if type(exp) == dict and exp["type"] == Function.EXP_WORD:
+			return exp["val1"] & WORD_MASK
+		return None
+
+	# check if an expression can be removed without changing anything
+	def _is_pure(self, exp):
+		if type(exp) != dict:
+			# a variable (or a call)
+			return type(exp) != list
+		if exp["type"] in Function.LEAF_EXPS:
+			return True
+		if not exp["type"] in Function.PURE_EXPS:
+			return False
+		if exp["type"] in Function.FOLD_UNARY:
+			return self._is_pure(exp["val1"])
+		return self._is_pure(exp["val1"]) and self._is_pure(exp["val2"])
+
+	# make an expression a record of its own (a variable or a call can't be an argument of a call)
+	def _exp_record(self, exp):
+		if type(exp) == list:
+			return self._get_exp(Function.EXP_EXP, exp)
+		if type(exp) != dict:
+			return {	"op" : Function.OP_EXPRESSION,
+					"type" : Function.EXP_VAR,
+					"val1" : exp,
+					"val2" : 0 }
+		return exp
+
+	# compute the expressions that are repeated in a flow once, in temporary variables.
+	# the function's code is left untouched, every changed record is a new one
+	def _share_exps(self, block, addressed):
+		ret = []
+		for flow in block:
+			flow = dict(flow)
+			for key in Function.FLOW_BLOCKS.get(flow["type"], ()):
+				flow[key] = self._share_exps(flow[key], addressed)
+			if flow["type"] in Function.SHARE_FLOWS:
+				ret += self._share_flow(flow, [0], addressed)
+			else:
+				ret.append(flow)
+		return ret
+
+	# returns the flows that compute the shared expressions of a flow and then the flow itself.
+	# temps is the number of temporary variables that are already used
+	def _share_flow(self, flow, temps, addressed):
+		prefix = []
+		while True:
+			counts = {}
+			calls = []
+			for exp in self._flow_exps(flow):
+				self._count_exps(exp, counts, False, calls)
+
+			# the biggest expressions first (their repeated parts are shared with them)
+			candidates = []
+			for key, (number, unconditional, exp) in counts.iteritems():
+				size = self._exp_size(exp)
+				reads = self._reads_memory(exp, addressed)
+				if number < 2 or (not reads and (number - 1) * size <= number + 1):
+					# not worth a variable
+					continue
+				if reads and calls:
+					# a call can change what the expression reads
+					continue
+				if self._can_throw(exp) and unconditional != number:
+					# the expression may not be evaluated at all
+					continue
+				candidates.append((size, key, exp))
+			candidates.sort(reverse = True)
+
+			for size, key, exp in candidates:
+				# an exception must be thrown by the same expression as before
+				if self._can_throw(exp) and [i for i in self._flow_exps(self._replace_flow_exp(flow, key, 0)) if self._can_throw(i)]:
+					continue
+
+				var_id = self._get_var_id(".sharedvar%d" % (temps[0], ), create = True)["id"]
+				temps[0] += 1
+				prefix += self._share_flow(self._get_flow(Function.FLOW_ASSIGN, var_id, exp), temps, addressed)
+				flow = self._replace_flow_exp(flow, key, var_id)
+				break
+			else:
+				return prefix + [flow]
+
+	# the expressions of a flow that can be shared
+	def _flow_exps(self, flow):
+		if flow["type"] == Function.FLOW_IF_CMP:
+			# the flow reads the operands of the compare by itself
+			return [flow["val1"]["val1"], flow["val1"]["val2"]]
+		return [flow[key] for key in Function.FLOW_EXPS[flow["type"]]]
+
+	def _replace_flow_exp(self, flow, key, var_id):
+		flow = dict(flow)
+		if flow["type"] == Function.FLOW_IF_CMP:
+			flow["val1"] = dict(flow["val1"])
+			for operand in ("val1", "val2"):
+				flow["val1"][operand] = self._replace_exp(flow["val1"][operand], key, var_id)
+		else:
+			for operand in Function.FLOW_EXPS[flow["type"]]:
+				flow[operand] = self._replace_exp(flow[operand], key, var_id)
+		return flow
+
+	# count the expressions that can be shared by their keys: key -> [number, unconditional number, expression].
+	# calls gets every call in the expression
+	def _count_exps(self, exp, counts, conditional, calls):
+		if type(exp) == list:
+			calls.append(exp)
+			for i in exp:
+				self._count_exps(i, counts, conditional, calls)
+			return
+		if type(exp) != dict:
+			return
+
+		typ = exp["type"]
+		if typ in (Function.EXP_DYN_ALLOC, Function.EXP_EMIT):
+			calls.append(exp)
+		for key in Function.EXP_OPERANDS.get(typ, ()):
+			# the right side of "and" and "or" is not always evaluated
+			self._count_exps(exp[key], counts, conditional or (key == "val2" and typ in (Function.EXP_BOOL_AND, Function.EXP_BOOL_OR)), calls)
+
+		if typ in Function.SHARED_EXPS:
+			key = self._exp_key(exp)
+			if key is not None:
+				entry = counts.setdefault(key, [0, 0, exp])
+				entry[0] += 1
+				if not conditional:
+					entry[1] += 1
+
+	# a key that is the same for equal expressions (None if the expression can't be shared)
+	def _exp_key(self, exp):
+		if type(exp) != dict:
+			# a variable (or a call)
+			if type(exp) == list:
+				return None
+			return exp
+		typ = exp["type"]
+		if not typ in Function.LEAF_EXPS and not typ in Function.SHARED_EXPS and typ != Function.EXP_ADDRESSOF:
+			return None
+
+		key = [typ]
+		operands = Function.EXP_OPERANDS.get(typ, ())
+		for field in ("val1", "val2"):
+			if field in operands:
+				value = self._exp_key(exp[field])
+				if value is None:
+					return None
+				key.append(value)
+			else:
+				key.append(exp[field])
+		return tuple(key)
+
+	def _replace_exp(self, exp, key, var_id):
+		if type(exp) == list:
+			# the arguments of a call must be records
+			return [self._exp_record(self._replace_exp(i, key, var_id)) for i in exp]
+		if type(exp) != dict:
+			return exp
+		if exp["type"] in Function.SHARED_EXPS and self._exp_key(exp) == key:
+			return var_id
+
+		new_exp = dict(exp)
+		for field in Function.EXP_OPERANDS.get(exp["type"], ()):
+			new_exp[field] = self._replace_exp(exp[field], key, var_id)
+		return new_exp
+
+	# the number of opcodes that the vm runs for an expression
+	def _exp_size(self, exp):
+		if type(exp) == list:
+			return sum([self._exp_size(i) for i in exp])
+		if type(exp) != dict:
+			return 1
+		return 1 + sum([self._exp_size(exp[key]) for key in Function.EXP_OPERANDS.get(exp["type"], ())])
+
+	# the number of records of a flow block
+	def _code_size(self, block):
+		size = 0
+		for flow in block:
+			size += 1
+			for key in Function.FLOW_EXPS.get(flow["type"], ()):
+				size += self._exp_size(flow[key])
+			for key in Function.FLOW_BLOCKS.get(flow["type"], ()):
+				size += self._code_size(flow[key])
+		return size
+
+	# check if an expression reads memory or a variable that may be changed through its address
+	def _reads_memory(self, exp, addressed):
+		if type(exp) != dict:
+			return exp in addressed
+		if exp["type"] in (Function.EXP_DEREF, Function.EXP_BUF_OFFSET):
+			return True
+		if exp["type"] == Function.EXP_VAR and exp["val1"] in addressed:
+			return True
+		for key in Function.EXP_OPERANDS.get(exp["type"], ()):
+			if self._reads_memory(exp[key], addressed):
+				return True
+		return False
+
+	# check if an expression may throw an exception
+	def _can_throw(self, exp):
+		if type(exp) == list:
+			return True
+		if type(exp) != dict:
+			return False
+		typ = exp["type"]
+		if typ in (Function.EXP_DEREF, Function.EXP_BUF_OFFSET, Function.EXP_DYN_ALLOC, Function.EXP_EMIT, Function.EXP_MAP_LOOKUP, Function.EXP_MAP_DELETE, Function.EXP_CALL_STRING, Function.EXP_CALL_PTR):
+			return True
+		if typ in (Function.EXP_DIV, Function.EXP_MOD) and not self._const_value(exp["val2"]):
+			return True
+		for key in Function.EXP_OPERANDS.get(typ, ()):
+			if self._can_throw(exp[key]):
+				return True
+		return False
+
+	# share the slots of local words and pointers that are never alive at the same time.
+	# returns the code with the new ids and the names of the local variables that are left
+	def _pack_vars(self, final):
+		edges = {}
+		self._loop_live = {}
+		entry = self._live_block(final, set(), set(), edges)
+		self._loop_live = None
+
+		addressed = set()
+		self._addressed_vars(final, addressed)
+
+		# only variables that are always set before they are used can share a slot
+		candidates = []
+		for name in self.vars:
+			var = self.all_vars[name]
+			if 	var["type"] in (Function.VAR_WORD, Function.VAR_POINTER, Function.VAR_UNDEF) and \
+				var["init"] == 0 and var["flags"] == 0 and \
+				not var["id"] in entry and not var["id"] in addressed:
+				candidates.append(name)
+
+		# greedy coloring by the order of the variables
+		slots = [] # (the variable that holds the slot, the ids of the variables in it)
+		owner = {}
+		for name in candidates:
+			var = self.all_vars[name]
+			conflicts = edges.get(var["id"], ())
+			for slot_name, members in slots:
+				if self.all_vars[slot_name]["type"] == var["type"] and not members.intersection(conflicts):
+					members.add(var["id"])
+					owner[name] = slot_name
+					break
+			else:
+				slots.append((name, set([var["id"]])))
+
+		if not owner:
+			return final, self.vars
+
+		# set the new ids
+		local_vars = []
+		ids = {}
+		for name in self.vars:
+			if name in owner:
+				continue
+			local_vars.append(name)
+			ids[self.all_vars[name]["id"]] = len(self.args) + len(local_vars)
+		for name in owner:
+			ids[self.all_vars[name]["id"]] = ids[self.all_vars[owner[name]]["id"]]
+
+		return self._rename_block(final, ids), local_vars
+
+	# the variables that are alive at the start of a block (by their ids).
+	# live_out is what is alive when the block ends, extra is what is alive in every point (because of an exception handler).
+	# if edges is not None, every assigned variable is connected to the variables that are alive after it
+	def _live_block(self, block, live_out, extra, edges):
+		live = set()
+		for flow in reversed(block):
+			typ = flow["type"]
+			if typ == Function.FLOW_BLOCKEND:
+				live = set(live_out)
+			elif typ == Function.FLOW_RET or typ == Function.FLOW_THROW:
+				live = set()
+			elif typ == Function.FLOW_BREAK:
+				live = set(self._loop_exits[-1][0])
+			elif typ == Function.FLOW_CONTINUE:
+				live = set(self._loop_exits[-1][1])
+			elif typ == Function.FLOW_ASSIGN:
+				if edges is not None:
+					for var_id in live | extra:
+						if var_id != flow["val1"]:
+							edges.setdefault(var_id, set()).add(flow["val1"])
+							edges.setdefault(flow["val1"], set()).add(var_id)
+				live.discard(flow["val1"])
+			elif typ == Function.FLOW_ASSIGN_OFFSET or typ in Function.MAP_FLOWS:
+				live.add(flow["val1"])
+			elif typ == Function.FLOW_IF or typ == Function.FLOW_IF_CMP:
+				live = self._live_block(flow["val2"], live, extra, edges) | self._live_block(flow["val3"], live, extra, edges)
+			elif typ == Function.FLOW_TRY:
+				# an exception can jump to the handler from any point of the body
+				handler = self._live_block(flow["val2"], live, extra, edges)
+				live = self._live_block(flow["val1"], live, extra | handler, edges) | handler
+			elif typ == Function.FLOW_WHILE or typ == Function.FLOW_WHILE_CMP or typ == Function.FLOW_FOR:
+				head = self._loop_live.get(id(flow), set())
+				while True:
+					new_head = self._live_loop_body(flow, head, live, extra, None) | live
+					self._exp_vars(flow["val1"], new_head)
+					if new_head <= head:
+						break
+					head |= new_head
+				self._loop_live[id(flow)] = head
+				if edges is not None:
+					self._live_loop_body(flow, head, live, extra, edges)
+				live = set(head)
+
+			# the expressions are evaluated before the flow is done
+			for key in Function.FLOW_EXPS.get(typ, ()):
+				self._exp_vars(flow[key], live)
+			live |= extra
+		return live
+
+	# the variables that are alive at the start of a loop's body (head is what is alive before the test, live_out after the loop)
+	def _live_loop_body(self, flow, head, live_out, extra, edges):
+		step = head
+		if flow["type"] == Function.FLOW_FOR:
+			step = self._live_block(flow["val3"], head, extra, edges)
+
+		self._loop_exits.append((live_out, step))
+		live = self._live_block(flow["val2"], step, extra, edges)
+		self._loop_exits.pop()
+		return live
+
+	# add the ids of the variables that an expression uses
+	def _exp_vars(self, exp, out):
+		if type(exp) == list:
+			for i in exp:
+				self._exp_vars(i, out)
+		elif type(exp) == dict:
+			if exp["type"] in Function.VAR_EXPS:
+				out.add(exp["val1"])
+			for key in Function.EXP_OPERANDS.get(exp["type"], ()):
+				self._exp_vars(exp[key], out)
 		else:
-			# we should never get here!
-			raise Exception("order_blocks unexpected behavior")
+			out.add(exp)
+
+	# find the variables that their address is taken
+	def _addressed_vars(self, exp, out):
+		if type(exp) == list:
+			for i in exp:
+				self._addressed_vars(i, out)
+		elif type(exp) == dict:
+			if exp["op"] == Function.OP_EXPRESSION and exp["type"] == Function.EXP_ADDRESSOF:
+				out.add(exp["val1"])
+			for value in exp.itervalues():
+				if type(value) in Function.BLOCK_TYPES:
+					self._addressed_vars(value, out)
+
+	# give the variables new ids. if strings is not None, it returns the new index of every string
+	def _rename_block(self, block, ids, strings = None):
+		ret = []
+		for flow in block:
+			flow = dict(flow)
+			if flow["type"] in Function.VAR_FLOWS:
+				flow["val1"] = ids.get(flow["val1"], flow["val1"])
+			for key in Function.FLOW_EXPS.get(flow["type"], ()):
+				flow[key] = self._rename_exp(flow[key], ids, strings)
+			for key in Function.FLOW_BLOCKS.get(flow["type"], ()):
+				flow[key] = self._rename_block(flow[key], ids, strings)
+			ret.append(flow)
+		return ret
+
+	def _rename_exp(self, exp, ids, strings = None):
+		if type(exp) == list:
+			return [self._rename_exp(i, ids, strings) for i in exp]
+		if type(exp) != dict:
+			return ids.get(exp, exp)
+
+		exp = dict(exp)
+		if exp["type"] in Function.VAR_EXPS:
+			exp["val1"] = ids.get(exp["val1"], exp["val1"])
+		elif strings is not None and exp["type"] in Function.STRING_EXPS:
+			exp["val1"] = strings(exp["val1"])
+		for key in Function.EXP_OPERANDS.get(exp["type"], ()):
+			exp[key] = self._rename_exp(exp[key], ids, strings)
+		return exp
 
 	# translate the arranged blocks to bytes
 	def _translate(self):
-		ret = ""
+		record = Function.RECORD
+		ret = bytearray(record.size * len(self.all_blocks))
+		offset = 0
+		self.fstring_relocs = []
 		for block in self.all_blocks:
-			if block["op"] == Function.OP_FUNCTION:
-				ret += struct.pack("PPPP",	block["op"] | (block["min_args"] << 2) | (block["return_exception_value"] << 7),
+			op = block["op"]
+			if op == Function.OP_FUNCTION:
+				record.pack_into(ret, offset,	op | (block["min_args"] << 2) | (block["return_exception_value"] << 7),
 								block["name"],
 								block["error_return"],
 								block["function_type"])
-			elif block["op"] == Function.OP_VARIABLE:
-				ret += struct.pack("PPPP",	block["op"] | (block["type"] << 2) | (block["is_arg"] << 7),
+			elif op == Function.OP_VARIABLE:
+				record.pack_into(ret, offset,	op | (block["type"] << 2) | (block["is_arg"] << 7),
 								block["size"],
 								block["init"],
 								block["flags"])
-			elif block["op"] == Function.OP_FLOW:
-				ret += struct.pack("PPPP",	block["op"] | (block["type"] << 2),
+			elif op == Function.OP_FLOW:
+				record.pack_into(ret, offset,	op | (block["type"] << 2),
 								block["val1"],
 								block["val2"],
 								block["val3"])
 
-			elif block["op"] == Function.OP_EXPRESSION:
-				ret += struct.pack("PPPP",	block["op"] | (block["type"] << 2),
+			elif op == Function.OP_EXPRESSION:
+				record.pack_into(ret, offset,	op | (block["type"] << 2),
 								block["val1"],
 								block["val2"],
 								0)
+				if "fstring" in block:
+					self.fstring_relocs.append((offset + WORD_SIZE, block["fstring"]))
 			else:
 				# we should never get here!
 				raise Exception("Unknown block type")
-		return ret
+			offset += record.size
+		return str(ret)
 
 	# generate the string table
 	def _generate_string_table(self):
@@ -429,15 +2082,20 @@ class Function(object):
 		if len(string) > 0 and string[-1] == '\0':
 			string = string[:-1]
 
-		if self.string_table.count(string) == 0:
+		if string not in self.string_index:
 			self.string_table.append(string)
-		return self.string_table.index(string) + 1
+			self.string_index[string] = len(self.string_table)
+		return self.string_index[string]
 
 
 	# generate bytes from a compiled function
 	def to_bytes(self, unhandled_return = None, function_type = 0):
 		# if unahdnled_return stays None the default return value (if an exception occured) will be the exception value
 
+		key = (unhandled_return, function_type)
+		if key in self.compiled:
+			return self.compiled[key]
+
 		if unhandled_return == None:
 			ret_exc = 1
 			ret_value = 0
@@ -451,35 +2109,92 @@ class Function(object):
 		if not self.anonymous:
 			name = self._get_string_value(self.name)
 
+		start = time.time()
+		final = self._optimize_flow(self.final)
+		addressed = set()
+		self._addressed_vars(final, addressed)
+		final = self._share_exps(final, addressed)
+		final, local_vars = self._pack_vars(final)
+		self.times["optimize"] = time.time() - start
+
 		# add the function opcode and the variables opcodes
 		self.all_blocks = [[self._get_func(len(self.args), name, ret_exc, ret_value, self.function_type | function_type)]]
-		for i in xrange(len(self.all_vars)):
+		variables = self.args + local_vars
+		for i in xrange(len(variables)):
 			if i < self.max_args:
 				is_arg = 1
-				typ = self.all_vars[self.args[i]]["type"]
-				size = self.all_vars[self.args[i]]["size"]
-				init = self.all_vars[self.args[i]]["init"]
-				flags = self.all_vars[self.args[i]]["flags"]
 			else:
 				is_arg = 0
-				typ = self.all_vars[self.vars[i - len(self.args)]]["type"]
-				size = self.all_vars[self.vars[i - len(self.args)]]["size"]
-				init = self.all_vars[self.vars[i - len(self.args)]]["init"]
-				flags = self.all_vars[self.vars[i - len(self.args)]]["flags"]
-			self.all_blocks.append([self._get_var(typ, is_arg = is_arg, size = size, init = init, flags = flags)])
+			var = self.all_vars[variables[i]]
+			self.all_blocks.append([self._get_var(var["type"], is_arg = is_arg, size = var["size"], init = var["init"], flags = var["flags"])])
 
 		# arrange the blocks in the right order
+		start = time.time()
 		self.end = len(self.all_blocks)
-		self._order_blocks(self.final)
+		self._order_blocks(final)
 		
 		# flatten everything
 		all_blocks = []
 		for block in self.all_blocks:
 			all_blocks += block
 		self.all_blocks = all_blocks
+		self.times["order_blocks"] = time.time() - start
+
+		start = time.time()
+		code = self._translate()
+		strings = self._generate_string_table()
+		self.times["translate"] = time.time() - start
+
+		self.info = {	"bytecode_size" : len(code),
+				"string_table_size" : len(strings),
+				"num_vars" : len(variables),
+				"frame_size" : self._frame_size(variables) }
 
 		# return the bytes
-		return self._translate() + self._generate_string_table()
+		self.compiled[key] = code + strings
+		return self.compiled[key]
+
+	# generate a compact image (version 1.1) from a compiled function.
+	# it has the number of records, every record as its first byte and its operands as varints, and then the string table
+	def to_compact_bytes(self, unhandled_return = None, function_type = 0):
+		compiled = self.to_bytes(unhandled_return, function_type)
+		record = Function.RECORD
+		code_size = self.info["bytecode_size"]
+
+		ret = bytearray()
+		compact_number(ret, code_size / record.size)
+		for offset in xrange(0, code_size, record.size):
+			header, val1, val2, val3 = record.unpack_from(compiled, offset)
+			op = header & 3
+			typ = header >> 2
+			if op == Function.OP_FUNCTION or op == Function.OP_VARIABLE:
+				values = [val1, compact_signed(val2), val3]
+			elif op == Function.OP_FLOW:
+				values = [val1, val2, val3][:Function.COMPACT_FLOW_OPERANDS[typ]]
+			else:
+				if typ == Function.EXP_WORD:
+					val1 = compact_signed(val1)
+				values = [val1, val2][:Function.COMPACT_EXP_OPERANDS.get(typ, 2)]
+
+			if [val1, val2, val3][len(values):].count(0) != 3 - len(values):
+				raise Exception("A record can't be compacted")
+			ret.append(header)
+			for value in values:
+				compact_number(ret, value)
+
+		return str(ret) + compiled[code_size:]
+
+	# the size of the function's variables on the stack (the same as the kernel calculates it)
+	def _frame_size(self, variables):
+		size = 0
+		for name in variables:
+			var = self.all_vars[name]
+			if name in self.args or not var["type"] in (Function.VAR_BUF, Function.VAR_ARRAY):
+				size += WORD_SIZE
+			else:
+				# round up
+				size += WORD_SIZE + ((var["size"] + WORD_SIZE - 1) & ~(WORD_SIZE - 1))
+		return size
 
 	def unload(self):
 		self.plug.unload(self)
@@ -487,11 +2202,44 @@ class Function(object):
 	def __call__(self, *args):
 		return self.plug(self, *args)
 
+	def map(self, args, cols = None):
+		return self.plug.map(self, args, cols)
+
+	def on_each_cpu(self, *args, **kwargs):
+		return self.plug.on_cpus(self, None, *args, **kwargs)
+
+	def on_cpus(self, mask, *args, **kwargs):
+		return self.plug.on_cpus(self, mask, *args, **kwargs)
+
+	def stats(self):
+		return self.plug.stats(self)
+
+
+# the source of the anonymous function that formats a string with num_args arguments
+def fstring_source(num_args):
+	args = ', '.join(["arg%d" % (i, ) for i in xrange(num_args)])
+	return r'''
+VARIABLE_ARGUMENT("KERNEL_snprintf")
+
+ANONYMOUS("fstring_function")
+ERROR_PARAM = 5
+
+def fstring_function(%s):
+	length = KERNEL_snprintf(0, 0, %s)
+	buf = new(length + 1)
+	if KERNEL_snprintf(buf, length + 1, %s) != length:
+		raise ERROR_PARAM
+	return buf
+''' % (args, args, args)
+
 
 # the ast visitor class
 # create the compiled function(s) class(es)
 class compiler_visitor(ast.NodeVisitor):
 
+	# the biggest static function (in records) that is inlined without an INLINE directive
+	INLINE_MAX_SIZE = 32
+
 	def __init__(self, plug):
 		ast.NodeVisitor.__init__(self)
 		self.in_function = False
@@ -502,8 +2250,12 @@ class compiler_visitor(ast.NodeVisitor):
 		self.variable_argument_funcs = []
 		self.anonymous_funcs = []
 		self.static_funcs = []
+		self.inline_funcs = []
 		self.consts = {}
 		self._last_temp_var = 0
+		self._free_temp_vars = []
+		self._inlined = 0
+		self._loops = 0 # the number of loops that the current statement is in
 		self.plug = plug
 
 	# add a flow opcode in the current frame
@@ -632,29 +2384,36 @@ class compiler_visitor(ast.NodeVisitor):
 		else:
 			raise Exception("Unsupported assign type")
 
+	# create a flow that changes a map. the flow gets the map from a variable, so any other map is put in a temporary one
+	def _map_flow(self, typ, kmap, key, value):
+		if type(kmap) == Name and not self.consts.has_key(kmap.id):
+			var = self.func._get_var_id(kmap.id)
+			if var["type"] == Function.VAR_BUF or var["type"] == Function.VAR_ARRAY:
+				raise Exception("A buffer or an array cannot be a map")
+			self._create_flow(typ, var["id"], self.visit(key), self.visit(value))
+			return
+
+		temp = self._get_temp_var()
+		self._one_assign(temp, kmap)
+		self._create_flow(typ, self.func._get_var_id(temp)["id"], self.visit(key), self.visit(value))
+		self._release_temp_var(temp)
+
 	# create a temporary variable - the name of the variable is not a python valid name, so there can be no conflicts
 	def _get_temp_var(self):
+		if self._free_temp_vars:
+			return self._free_temp_vars.pop()
 		ret = '.tempvar%d' % (self._last_temp_var, )
 		self._last_temp_var += 1
 		return ret
 
+	# a temporary variable that is not used anymore can be used again by the next statements
+	def _release_temp_var(self, name):
+		self._free_temp_vars.append(name)
+
 	def _create_fstring_function(self, num_args):
 		if self.func.special_funcs.has_key("fstring%d" % num_args):
 			return self.func.special_funcs["fstring%d" % num_args]
-		args = ', '.join(["arg%d" % (i, ) for i in xrange(num_args)])
-		ret = self.plug.compile(r'''
-VARIABLE_ARGUMENT("KERNEL_snprintf")
-
-ANONYMOUS("fstring_function")
-ERROR_PARAM = 5
-
-def fstring_function(%s):
-	length = KERNEL_snprintf(0, 0, %s)
-	buf = new(length + 1)
-	if KERNEL_snprintf(buf, length + 1, %s) != length:
-		raise ERROR_PARAM
-	return buf
-''' % (args, args, args))[0]
+		ret = self.plug.compile(fstring_source(num_args))[0]
 		self.func.special_funcs["fstring%d" % num_args] = ret
 		return ret
 
@@ -666,6 +2425,186 @@ def fstring_function(%s):
 	def visit_Module(self, node):
 		for obj in node.body:
 			self.visit(obj)
+		self._inline_functions()
+
+	# replace the calls to small static functions (and to the functions in INLINE directives) with their code.
+	# only a call that is the whole value of an assignment, an expression or a return is inlined
+	def _inline_functions(self):
+		funcs = {}
+		for func in self.functions:
+			if not func.anonymous and (func.static or func.name in self.inline_funcs):
+				funcs[func.name] = func
+		if not funcs:
+			return
+
+		done = {} # id of a function -> False while its calls are inlined, True after it
+		for func in self.functions:
+			if not id(func) in done:
+				self._inline_function(func, funcs, done)
+
+	def _inline_function(self, func, funcs, done):
+		done[id(func)] = False
+		func.final = self._inline_block(func, func.final, funcs, done)
+		done[id(func)] = True
+
+	def _inline_block(self, func, block, funcs, done):
+		ret = []
+		for flow in block:
+			flow = dict(flow)
+			for key in Function.FLOW_BLOCKS.get(flow["type"], ()):
+				flow[key] = self._inline_block(func, flow[key], funcs, done)
+
+			if flow["type"] == Function.FLOW_ASSIGN or flow["type"] == Function.FLOW_RET:
+				code = self._inline_call(func, flow, funcs, done)
+				if code is not None:
+					ret += code
+					continue
+			ret.append(flow)
+		return ret
+
+	# the function that a call should be replaced with (None if it can't be inlined)
+	def _inline_target(self, func, call, funcs, done):
+		if type(call) != list or call[0]["type"] != Function.EXP_CALL_STRING or call[0]["val2"] != 0:
+			return None
+		name = func.string_table[call[0]["val1"] - 1]
+		callee = funcs.get(name)
+		if callee is None or done.get(id(callee)) is False:
+			# a recursive call
+			return None
+		if not id(callee) in done:
+			self._inline_function(callee, funcs, done)
+
+		num_args = len(call) - 2
+		if callee.function_type & Function.FUNC_VARIABLE_ARGUMENT or num_args < callee.min_args or num_args > callee.max_args:
+			return None
+		if not name in self.inline_funcs and callee._code_size(callee.final) > compiler_visitor.INLINE_MAX_SIZE:
+			return None
+
+		# every call has new local variables, so buffers and arrays (and variables with flags) must stay in their own frame
+		for var_name in callee.vars:
+			var = callee.all_vars[var_name]
+			if not var["type"] in (Function.VAR_WORD, Function.VAR_POINTER, Function.VAR_UNDEF) or var["flags"]:
+				return None
+		if not self._inline_code_allowed(callee.final):
+			return None
+		return callee
+
+	# fstring functions and the number of arguments belong to the frame of the function
+	def _inline_code_allowed(self, exp):
+		if type(exp) == list:
+			for i in exp:
+				if not self._inline_code_allowed(i):
+					return False
+		elif type(exp) == dict:
+			if "fstring" in exp or (exp["op"] == Function.OP_EXPRESSION and exp["type"] == Function.EXP_ARGS):
+				return False
+			for value in exp.itervalues():
+				if type(value) in Function.BLOCK_TYPES and not self._inline_code_allowed(value):
+					return False
+		return True
+
+	# the flows that replace an assignment or a return of a call (None if the call can't be inlined)
+	def _inline_call(self, func, flow, funcs, done):
+		if flow["type"] == Function.FLOW_RET:
+			call = flow["val1"]
+		else:
+			call = flow["val2"]
+		callee = self._inline_target(func, call, funcs, done)
+		if callee is None:
+			return None
+
+		body = callee.final
+		if flow["type"] == Function.FLOW_ASSIGN:
+			# the returns of the callee set the variable, and the rest of the callee's code is moved to their other branches.
+			# 0 is never the id of a variable, so it's given the variable's id with the other variables
+			body = self._inline_returns(callee, body, 0, False)
+			if body is None:
+				return None
+
+		# the variables of the callee get new names
+		prefix = ".inline%d." % (self._inlined, )
+		self._inlined += 1
+		ids = {0 : flow["val1"]}
+		for name in callee.args + callee.vars:
+			var = callee.all_vars[name]
+			typ = var["type"]
+			if typ == Function.VAR_UNDEF:
+				typ = Function.VAR_WORD
+			ids[var["id"]] = func._get_var_id(prefix + name, create = True, typ = typ)["id"]
+
+		# the arguments are evaluated first, like they are before a call
+		args = []
+		args_values = call[1:-1]
+		for i in xrange(len(callee.args)):
+			var = callee.all_vars[callee.args[i]]
+			if i < len(args_values):
+				value = args_values[i]
+				if type(value) == dict and value["type"] == Function.EXP_EXP:
+					value = value["val1"]
+			else:
+				value = func._get_exp(Function.EXP_WORD, var["init"])
+			args.append(func._get_flow(Function.FLOW_ASSIGN, ids[var["id"]], value))
+		code = self._inline_block(func, args, funcs, done)
+
+		# a new frame initializes the local variables
+		callee._loop_live = {}
+		entry = callee._live_block(body, set(), set(), None)
+		callee._loop_live = None
+		callee._addressed_vars(body, entry)
+		for name in callee.vars:
+			var = callee.all_vars[name]
+			if var["id"] in entry or var["init"]:
+				code.append(func._get_flow(Function.FLOW_ASSIGN, ids[var["id"]], func._get_exp(Function.EXP_WORD, var["init"])))
+
+		strings = lambda index: func._get_string_value(callee.string_table[index - 1])
+		return code + callee._rename_block(body, ids, strings)
+
+	# replace the returns of a block with assignments to a variable.
+	# a return that isn't at the end of the code must be in an "if", and the code after the "if" is moved to the branches that don't return
+	def _inline_returns(self, func, block, var_id, nested):
+		ret = []
+		for i in xrange(len(block)):
+			flow = block[i]
+			if flow["type"] == Function.FLOW_RET:
+				ret.append(func._get_flow(Function.FLOW_ASSIGN, var_id, flow["val1"]))
+				if nested:
+					ret.append(func._get_flow(Function.FLOW_BLOCKEND))
+				return ret
+
+			if self._has_return(flow):
+				if flow["type"] != Function.FLOW_IF and flow["type"] != Function.FLOW_IF_CMP:
+					# there is no way to leave a loop or a try in the middle
+					return None
+
+				rest = block[i + 1:]
+				flow = dict(flow)
+				falls = 0
+				for key in ("val2", "val3"):
+					branch = flow[key]
+					if branch[-1]["type"] == Function.FLOW_BLOCKEND:
+						falls += 1
+						branch = branch[:-1] + rest
+					flow[key] = self._inline_returns(func, branch, var_id, True)
+					if flow[key] is None:
+						return None
+				if falls > 1 and len(rest) > 1:
+					# the rest of the code would be copied
+					return None
+				ret.append(flow)
+				if nested:
+					ret.append(func._get_flow(Function.FLOW_BLOCKEND))
+				return ret
+			ret.append(flow)
+		return ret
+
+	def _has_return(self, flow):
+		if flow["type"] == Function.FLOW_RET:
+			return True
+		for key in Function.FLOW_BLOCKS.get(flow["type"], ()):
+			for i in flow[key]:
+				if self._has_return(i):
+					return True
+		return False
 
 	def visit_FunctionDef(self, node):
 		if self.in_function:
@@ -675,6 +2614,7 @@ def fstring_function(%s):
 		self.func = Function(node.name)
 		self.functions.append(self.func)
 		self.in_function = True
+		self._free_temp_vars = []
 
 		# set flags
 		self.func.function_type = 0
@@ -766,6 +2706,8 @@ def fstring_function(%s):
 				self._one_assign(temp_vars[-1], node.value.elts[el])
 			for el in xrange(len(target.elts)):
 				self._one_assign(target.elts[el], self.func._get_exp(Function.EXP_VAR, temp_vars[el]), True)
+			for var in temp_vars:
+				self._release_temp_var(var)
 		else:
 			# one simple assignment
 			self._one_assign(target, node.value)
@@ -818,6 +2760,12 @@ def fstring_function(%s):
 				type(node.value.args[0]) == Str:
 				self.static_funcs.append(node.value.args[0].s)
 				return
+			elif	type(node.value) == Call and \
+				node.value.func.id == "INLINE" and \
+				len(node.value.args) == 1 and \
+				type(node.value.args[0]) == Str:
+				self.inline_funcs.append(node.value.args[0].s)
+				return
 			raise Exception("All expressions must be in a function")
 		else:
 			if type(node.value) == Call and type(node.value.func) == Name and node.value.func.id in Function.VARNAMES:
@@ -912,16 +2860,99 @@ def fstring_function(%s):
 		test = self.visit(node.test)
 
 		# parse the "while" flow
+		body = self._loop_body(node.body)
+
+		self._create_flow(Function.FLOW_WHILE, test, body)
+
+	# a counted loop over range([start, ]stop[, step]).
+	# the loop steps a hidden counter, and every iteration assigns it to the target first (like python, changing
+	# the target in the body doesn't change the iterations, and an empty loop doesn't change the target).
+	# the arguments of range are evaluated once, before the loop
+	def visit_For(self, node):
+		if not self.in_function:
+			raise Exception("All expressions must be in a function")
+
+		if 	type(node.target) != Name or type(node.iter) != Call or type(node.iter.func) != Name or \
+			node.iter.func.id != "range" or len(node.iter.args) == 0 or len(node.iter.args) > 3 or \
+			node.iter.keywords or node.iter.starargs or node.iter.kwargs or node.orelse:
+			raise Exception("Unsupported for structure")
+
+		# the arguments that aren't constants are copied to temporary variables (by their order)
+		temp_vars = []
+		values = []
+		for arg in node.iter.args:
+			value = self.func._optimize_exp(self.visit(arg))
+			if self.func._const_value(value) is None:
+				temp_vars.append(self._get_temp_var())
+				self._one_assign(temp_vars[-1], value, True)
+				value = self.func._get_exp(Function.EXP_VAR, temp_vars[-1])
+			values.append(value)
+
+		if len(values) == 1:
+			values.insert(0, self.func._get_exp(Function.EXP_WORD, 0))
+		if len(values) == 2:
+			values.append(self.func._get_exp(Function.EXP_WORD, 1))
+		start, stop, step = values
+
+		counter_var = self._get_temp_var()
+		self._one_assign(counter_var, start, True)
+		counter = self.func._get_var_id(counter_var)["id"]
+
+		step_value = self.func._const_value(step)
+		if step_value is None:
+			# the direction is known only when the loop runs
+			test = self.func._get_exp(Function.EXP_BOOL_OR,
+						self.func._get_exp(Function.EXP_BOOL_AND,
+							self.func._get_exp(Function.EXP_CMP_GT_SIGN, step, self.func._get_exp(Function.EXP_WORD, 0)),
+							self.func._get_exp(Function.EXP_CMP_SIGN, counter, stop)),
+						self.func._get_exp(Function.EXP_BOOL_AND,
+							self.func._get_exp(Function.EXP_CMP_SIGN, step, self.func._get_exp(Function.EXP_WORD, 0)),
+							self.func._get_exp(Function.EXP_CMP_GT_SIGN, counter, stop)))
+		elif signed_word(step_value) > 0:
+			test = self.func._get_exp(Function.EXP_CMP_SIGN, counter, stop)
+		elif signed_word(step_value) < 0:
+			test = self.func._get_exp(Function.EXP_CMP_GT_SIGN, counter, stop)
+		else:
+			raise Exception("The step of range must not be zero")
+
+		body = self._loop_body(node.body, node.target, counter)
+		step_block = [	self.func._get_flow(Function.FLOW_ASSIGN, counter, self.func._get_exp(Function.EXP_ADD, counter, step)),
+				self.func._get_flow(Function.FLOW_BLOCKEND)]
+
+		self._create_flow(Function.FLOW_FOR, test, body, step_block)
+
+		self._release_temp_var(counter_var)
+		for var in temp_vars:
+			self._release_temp_var(var)
+
+	# parse the body of a loop (it may have "break" and "continue"). a target is assigned a value before the statements
+	def _loop_body(self, statements, target = None, value = None):
+		self._loops += 1
 		self._flow_new()
-		for obj in node.body:
+		if target is not None:
+			self._one_assign(target, value, True)
+		for obj in statements:
 			self.visit(obj)
 			if self.block_stoped:
 				break
 		body = self._flow_ret()
+		self._loops -= 1
+		return body
 
-		self._create_flow(Function.FLOW_WHILE, test, body)
+	def visit_Break(self, node):
+		if not self._loops:
+			raise Exception("'break' outside a loop")
+		self._create_flow(Function.FLOW_BREAK)
+		self.block_stoped = True
 
-	def visit_Compare(self, node):
+	def visit_Continue(self, node):
+		if not self._loops:
+			raise Exception("'continue' outside a loop")
+		self._create_flow(Function.FLOW_CONTINUE)
+		self.block_stoped = True
+
+	# comparisons are signed, unless they are wrapped with UNSIGNED()
+	def visit_Compare(self, node, unsigned = False):
 		if not self.in_function:
 			raise Exception("All expressions must be in a function")
 
@@ -929,21 +2960,15 @@ def fstring_function(%s):
 
 		if len(node.ops) != 1 or len(node.comparators) != 1:
 			raise Exception("Unsupported compare structure")
+		if not type(node.ops[0]) in Function.CMPOP:
+			raise Exception("Unknown operation: %s" % (str(type(node.ops[0])), ))
+
 		comparators = self.visit(node.comparators[0])
-		if type(node.ops[0]) == Lt:
-			return self.func._get_exp(Function.EXP_CMP_SIGN, left, comparators)
-		if type(node.ops[0]) == LtE:
-			invers = self.func._get_exp(Function.EXP_CMP_SIGN, comparators, left)
-			return self.func._get_exp(Function.EXP_BOOL_NOT, invers)
-		if type(node.ops[0]) == Gt:
-			return self.func._get_exp(Function.EXP_CMP_SIGN, comparators, left)
-		if type(node.ops[0]) == Eq:
-			return self.func._get_exp(Function.EXP_CMP_EQ, left, comparators)
-		if type(node.ops[0]) == NotEq:
-			value = self.func._get_exp(Function.EXP_CMP_EQ, left, comparators)
-			return self.func._get_exp(Function.EXP_BOOL_NOT, value)
-
-		raise Exception("Unknown operation: %s" % (str(type(node.ops[0])), ))
+		if unsigned:
+			typ = Function.CMPOP[type(node.ops[0])][1]
+		else:
+			typ = Function.CMPOP[type(node.ops[0])][0]
+		return self.func._get_exp(typ, left, comparators)
 
 
 	def visit_Name(self, node):
@@ -985,7 +3010,7 @@ def fstring_function(%s):
 
 				new_args .append(arg)
 
-			ret = [self.func._get_exp(Function.EXP_CALL_PTR, self.func._get_exp(Function.EXP_WORD, self._create_fstring_function(len(args) + 1).addr))]
+			ret = [self.func._get_exp(Function.EXP_CALL_PTR, self.func._get_exp(Function.EXP_WORD, self._create_fstring_function(len(args) + 1).addr, fstring = len(args) + 1))]
 			ret.append(self.visit(node.left))
 			ret += new_args
 			ret.append(self.func._get_exp(Function.EXP_CALL_END))
@@ -1036,6 +3061,11 @@ def fstring_function(%s):
 			flags = 0
 			reverse = False
 
+			if name == "UNSIGNED":
+				if len(node.args) != 1 or type(node.args[0]) != Compare:
+					raise Exception("Error using macro %s" % (name, ))
+				return self.visit_Compare(node.args[0], unsigned = True)
+
 			if name == "ADDRESSOF" or name == "DEREF":
 				if len(node.args) != 1:
 					raise Exception("Error using macro %s" % (name, ))
@@ -1077,6 +3107,27 @@ def fstring_function(%s):
 					self._create_flow(Function.FLOW_DYN_FREE, self.visit(node.args[0]))
 					return self.func._get_exp(Function.EXP_WORD, 0) # return 0
 
+			elif name == "map_lookup" or name == "map_delete":
+				# the value of a key (0 if it's not in the map), or delete a key (returns 1 if it was in the map)
+				if len(node.args) != 2:
+					raise Exception("Bad syntax of %s" % (name, ))
+				typ = Function.EXP_MAP_LOOKUP if name == "map_lookup" else Function.EXP_MAP_DELETE
+				return self.func._get_exp(typ, self.visit(node.args[0]), self.visit(node.args[1]))
+
+			elif name == "map_update" or name == "map_add":
+				# set the value of a key, or add to it atomically
+				if len(node.args) != 3:
+					raise Exception("Bad syntax of %s" % (name, ))
+				typ = Function.FLOW_MAP_UPDATE if name == "map_update" else Function.FLOW_MAP_ADD
+				self._map_flow(typ, node.args[0], node.args[1], node.args[2])
+				return self.func._get_exp(Function.EXP_WORD, 0) # return 0
+
+			elif name == "emit":
+				# write a record to the events rings. returns 1 if it was written and 0 if it was dropped
+				if len(node.args) != 2:
+					raise Exception("Bad syntax of emit")
+				return self.func._get_exp(Function.EXP_EMIT, self.visit(node.args[0]), self.visit(node.args[1]))
+
 			if name.startswith("KERNEL_"):
 				# this is the macro for using external functions
 				reverse = True
@@ -1156,6 +3207,7 @@ def fstring_function(%s):
 			_create_printk(formt, extra)
 			if var:
 				self._create_flow(Function.FLOW_DYN_FREE, self.func._get_var_id(var)["id"])
+				self._release_temp_var(var)
 
 		if node.nl:
 			_create_printk("\n")
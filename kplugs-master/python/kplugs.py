@@ -3,6 +3,9 @@
 from core import Plug, Function, WORD_SIZE
 import ctypes
 import struct
+import threading
+import Queue
+from collections import OrderedDict
 
 # we want it to be global because we don't want hooks callbacks to be freed under our feet in case that the module was not closed correctly
 KPLUGS_OBJECTS = []
@@ -12,6 +15,49 @@ KPROBE_STRUCT_ADDR    = 5 * WORD_SIZE
 KPROBE_STRUCT_SYMBOL  = 6 * WORD_SIZE
 KPROBE_STRUCT_HANDLER = 8 * WORD_SIZE
 
+# copy a vector of (dst, src, length) descriptors inside the kernel. the error of every copy is written to errors (one byte for each descriptor)
+MEMORY_COPY_MANY = '''
+ANONYMOUS("memory_copy_many")
+
+def memory_copy_many(descs, count, errors, dst_pid, src_pid):
+	pointer(descs)
+	pointer(errors)
+	pointer(desc)
+	failed = 0
+	i = 0
+	while i < count:
+		desc = descs + i * %d
+		err = KERNEL_safe_memory_copy(DEREF(desc), DEREF(desc + %d), DEREF(desc + %d), 0, 0, dst_pid, src_pid)
+		if err:
+			errors[i] = 0 - err
+			failed += 1
+		i += 1
+	return failed
+''' % (3 * WORD_SIZE, WORD_SIZE, 2 * WORD_SIZE)
+
+# the Py_buffer of the new buffer protocol, to get the memory of objects that don't have the old one (like memoryview)
+class _PyBuffer(ctypes.Structure):
+	_fields_ = [	("buf", ctypes.c_void_p),
+			("obj", ctypes.c_void_p),
+			("len", ctypes.c_ssize_t),
+			("itemsize", ctypes.c_ssize_t),
+			("readonly", ctypes.c_int),
+			("ndim", ctypes.c_int),
+			("format", ctypes.c_char_p),
+			("shape", ctypes.c_void_p),
+			("strides", ctypes.c_void_p),
+			("suboffsets", ctypes.c_void_p),
+			("smalltable", ctypes.c_ssize_t * 2),
+			("internal", ctypes.c_void_p)]
+
+PyBUF_CONTIG = 0x9 # PyBUF_ND | PyBUF_WRITABLE
+
+_PyObject_GetBuffer = ctypes.pythonapi.PyObject_GetBuffer
+_PyObject_GetBuffer.argtypes = [ctypes.py_object, ctypes.POINTER(_PyBuffer), ctypes.c_int]
+_PyBuffer_Release = ctypes.pythonapi.PyBuffer_Release
+_PyBuffer_Release.argtypes = [ctypes.POINTER(_PyBuffer)]
+_PyBuffer_Release.restype = None
+
 
 # unload kplugs - it's important unload the library or the computer may crash if you use hooks!
 def release_kplugs():
@@ -22,18 +68,48 @@ def release_kplugs():
 
 
 class Caller(object):
-	def __init__(self, variable_argument = False):
+	# the default number of caller stubs that are kept loaded
+	CACHE_SIZE = 64
+
+	# the type of a word argument (see prepare)
+	WORD = None
+
+	def __init__(self, variable_argument = False, cache_size = CACHE_SIZE):
+		if cache_size < 1:
+			raise Exception("The cache size must be at least 1")
+
 		self._va = variable_argument
 		self.plug = Plug()
 		self.random_names = {}
-		
-	def _get_func(self, name, types):
+
+		# loaded stubs by signature, the least recently used is first
+		self._stubs = OrderedDict()
+		self.cache_size = cache_size
+		self.hits = 0
+		self.misses = 0
+		self._lock = threading.Lock()
+
+	# the type of a string argument (see prepare) - the size is rounded up so strings with similar lengths share a stub
+	@staticmethod
+	def buffer(size):
+		rounded = 0x10
+		while rounded < size:
+			rounded <<= 1
+		return rounded
+
+	def _compile_func(self, name, types):
 		add = ''
 		if self._va:
 			add = 'VARIABLE_ARGUMENT("KERNEL_%s")' % (name, )
 
 		args = ', '.join(["arg%d" % (i, ) for i in xrange(len(types))])
-		decl = '\n\t'.join([types[i] % ("arg%d" % (i, ), ) for i in xrange(len(types))])
+		decl = []
+		for i in xrange(len(types)):
+			if types[i] == Caller.WORD:
+				decl.append("word(arg%d)" % (i, ))
+			else:
+				decl.append("buffer(arg%d, %d)" % (i, types[i]))
+		decl = '\n\t'.join(decl)
 
 		func = '''
 ANONYMOUS("caller_func")
@@ -51,35 +127,81 @@ def caller_func(ret, %s):
 
 		return self.plug.compile(func)[0]
 
-	def _put_func(self, func):
-		func.unload()
+	# get a loaded stub for a signature (compile it if it's not in the cache)
+	def _get_func(self, name, types):
+		key = (name, tuple(types), self._va)
+
+		func = self._stubs.pop(key, None)
+		if func is None:
+			self.misses += 1
+			func = self._compile_func(name, types)
+		else:
+			self.hits += 1
+
+		# (re)insert it as the most recently used stub
+		self._stubs[key] = func
+
+		while len(self._stubs) > self.cache_size:
+			self._stubs.popitem(last = False)[1].unload()
+
+		return func
+
+	def _call(self, name, types, args):
+		if len(types) != len(args):
+			raise Exception("Wrong number of arguments")
+
+		ret = ctypes.c_buffer('\0'*WORD_SIZE)
+		new_args = []
+		bufs = []
+		for i in xrange(len(args)):
+			if types[i] == Caller.WORD:
+				new_args.append(args[i])
+			else:
+				if not isinstance(args[i], str) or len(args[i]) >= types[i]:
+					raise Exception("Argument %d is not a string shorter than %d bytes" % (i, types[i]))
+				buf = ctypes.c_buffer(args[i], types[i])
+				new_args.append(ctypes.addressof(buf))
+				bufs.append(buf)
+
+		with self._lock:
+			err = self._get_func(name, types)(ctypes.addressof(ret), *new_args)
+		if err:
+			if err >= len(Plug.ERROR_TABLE):
+				raise Exception("Error: 0x%x" % err)
+			raise Exception(Plug.ERROR_TABLE[err])
+		return struct.unpack("P", ret.raw[:WORD_SIZE])[0]
+
+	# return a callable for a kernel function with a fixed signature.
+	# types has one element for every argument: Caller.WORD or Caller.buffer(size) for strings
+	def prepare(self, name, types):
+		if not isinstance(name, str):
+			raise Exception("Not a string")
+
+		types = tuple(types)
+
+		def caller(*args):
+			return self._call(name, types, args)
+
+		return caller
+
+	# unload all the cached stubs
+	def flush(self):
+		with self._lock:
+			while len(self._stubs) != 0:
+				self._stubs.popitem()[1].unload()
 
 	def __getitem__(self, n):
 		if not isinstance(n, str):
 			raise Exception("Not a string")
 
 		def caller(*args):
-			ret = ctypes.c_buffer('\0'*WORD_SIZE)
-			new_args = []
 			types = []
-			bufs = []
 			for arg in args:
 				if isinstance(arg, str):
-					buf = ctypes.c_buffer(arg + '\0')
-					types.append('buffer(%%s, %d)' % (len(arg) + 1, ))
-					new_args.append(ctypes.addressof(buf))
-					bufs.append(buf)
+					types.append(Caller.buffer(len(arg) + 1))
 				else:
-					types.append('word(%s)')
-					new_args.append(arg)
-			func = self._get_func(n, types)
-			err = func(ctypes.addressof(ret), *new_args)
-			self._put_func(func)
-			if err:
-				if err >= len(Plug.ERROR_TABLE):
-					raise Exception("Error: 0x%x" % err)
-				raise Exception(Plug.ERROR_TABLE[err])
-			return struct.unpack("P", ret.raw[:WORD_SIZE])[0]
+					types.append(Caller.WORD)
+			return self._call(n, types, args)
 
 		return caller
 
@@ -88,6 +210,9 @@ def caller_func(ret, %s):
 class Mem(object):
 	BLOCK_SIZE = 0x1000
 
+	# the default size of one copy from the kernel
+	TRANSFER_SIZE = 0x100000
+
 	# allocate a kernel buffer
 	def alloc(self, size, gfp = 0, dont_free = False):
 		ret = self._caller["__kmalloc"](size, gfp)
@@ -105,16 +230,101 @@ class Mem(object):
 		self._allocs.remove(ptr)
 		self._caller["kfree"](ptr)
 
-	def __init__(self, default_pid = 0):
+	def __init__(self, default_pid = 0, transfer_size = TRANSFER_SIZE):
 		global KPLUGS_OBJECTS
 
 		self._pid = default_pid
 		self._allocs = []
 		self._caller = Caller()
+		self._safe_memory_copy = self._caller.prepare("safe_memory_copy", [Caller.WORD] * 7)
+		self.transfer_size = transfer_size
+		self._copy_many_func = None
 		KPLUGS_OBJECTS.append(self)
 
+	# copy length bytes from addr to a local address, transfer_size bytes at a time
+	def _read(self, dst, addr, length, pid):
+		for i in xrange(0, length, self.transfer_size):
+			l = min(self.transfer_size, length - i)
+			err = self._safe_memory_copy(dst + i, addr + i, l, 0, 0, 0, pid)
+			if err:
+				raise Exception("Couldn't read memory")
+
+	# fill a writable buffer (a bytearray for example) with the memory at addr
+	def readinto(self, addr, buf, pid = None, length = None):
+		if pid is None:
+			pid = self._pid
+		if length is None:
+			length = len(buf)
+
+		try:
+			dst = (ctypes.c_char * len(buf)).from_buffer(buf)
+		except TypeError:
+			# not an old style writable buffer (a memoryview for example), so we get its memory with the new buffer protocol
+			view = _PyBuffer()
+			_PyObject_GetBuffer(buf, ctypes.byref(view), PyBUF_CONTIG)
+			try:
+				if length > view.len:
+					raise Exception("The length is bigger than the buffer")
+				self._read(view.buf, addr, length, pid)
+			finally:
+				_PyBuffer_Release(ctypes.byref(view))
+			return length
+
+		if length > len(buf):
+			raise Exception("The length is bigger than the buffer")
+
+		self._read(ctypes.addressof(dst), addr, length, pid)
+		return length
+
+	# read the memory from start to stop, chunk bytes at a time.
+	# the next chunk is read by a background thread while the current one is used, so every chunk is only valid until the next one is requested
+	def iter_chunks(self, start, stop, chunk = None, pid = None):
+		if chunk is None:
+			chunk = self.transfer_size
+		if pid is None:
+			pid = self._pid
+
+		free = Queue.Queue()
+		ready = Queue.Queue()
+		done = threading.Event()
+		for i in xrange(2):
+			free.put(bytearray(chunk))
+
+		def prefetch():
+			offset = 0
+			try:
+				while offset < stop - start:
+					buf = free.get()
+					if buf is None or done.is_set():
+						return
+					length = min(chunk, stop - start - offset)
+					self.readinto(start + offset, buf, pid, length)
+					ready.put((buf, length, None))
+					offset += length
+			except Exception, e:
+				ready.put((None, 0, e))
+				return
+			ready.put((None, 0, None))
+
+		thread = threading.Thread(target = prefetch)
+		thread.daemon = True
+		thread.start()
+
+		try:
+			while True:
+				buf, length, err = ready.get()
+				if err is not None:
+					raise err
+				if buf is None:
+					break
+				yield memoryview(buf)[:length]
+				free.put(buf)
+		finally:
+			done.set()
+			free.put(None)
+			thread.join()
+
 	def __getitem__(self, n):
-		buf = ctypes.c_buffer('\0'*Mem.BLOCK_SIZE)
 		if isinstance(n, int) or isinstance(n, long):
 			start = n
 			stop = n + 1
@@ -130,19 +340,9 @@ class Mem(object):
 			if not pid:
 				pid = self._pid
 
-		ret = ""
-		l = Mem.BLOCK_SIZE
-
-		# copy the from memory block by block
-		for i in xrange(0, stop - start, Mem.BLOCK_SIZE):
-			if (stop - start - i) < l:
-				l = stop - start - i
-			err = self._caller["safe_memory_copy"](ctypes.addressof(buf), i + start, l, 0, 0, 0, pid)
-			if err:
-				raise Exception("Couldn't read memory")
-			ret += buf.raw[:l]
-
-		return ret
+		buf = bytearray(stop - start)
+		self.readinto(start, buf, pid)
+		return str(buf)
 
 	def __setitem__(self, n, b):
 
@@ -176,6 +376,60 @@ class Mem(object):
 		if err:
 			raise Exception("Couldn't write memory")
 
+	# do all the copies in one call to the kernel. returns the error of every copy
+	def _copy_many(self, descs, dst_pid, src_pid):
+		if len(descs) == 0:
+			return bytearray()
+
+		if self._copy_many_func is None:
+			self._copy_many_func = self._caller.plug.compile(MEMORY_COPY_MANY)[0]
+
+		flat = []
+		for desc in descs:
+			flat += desc
+		descs_buf = ctypes.c_buffer(struct.pack("P" * len(flat), *flat))
+		errors = ctypes.c_buffer(len(descs))
+
+		self._copy_many_func(ctypes.addressof(descs_buf), len(descs), ctypes.addressof(errors), dst_pid, src_pid)
+		return bytearray(errors.raw[:len(descs)])
+
+	# read many (addr, length) ranges at once.
+	# returns the data of all the ranges one after the other, and the error of every range (0 if it was read)
+	def read_many(self, ranges, pid = None):
+		if pid is None:
+			pid = self._pid
+
+		data = bytearray(sum([length for addr, length in ranges]))
+		base = ctypes.addressof((ctypes.c_char * len(data)).from_buffer(data))
+
+		descs = []
+		offset = 0
+		for addr, length in ranges:
+			descs.append((base + offset, addr, length))
+			offset += length
+
+		return data, self._copy_many(descs, 0, pid)
+
+	# write many (addr, string) pairs at once. returns the error of every write (0 if it was written)
+	def write_many(self, writes, pid = None):
+		if pid is None:
+			pid = self._pid
+
+		for addr, b in writes:
+			if type(b) != str:
+				raise Exception("You can only set the memory to strings")
+
+		buf = ctypes.c_buffer(''.join([b for addr, b in writes]))
+		base = ctypes.addressof(buf)
+
+		descs = []
+		offset = 0
+		for addr, b in writes:
+			descs.append((addr, base + offset, len(b)))
+			offset += len(b)
+
+		return self._copy_many(descs, pid, 0)
+
 	def release(self):
 		global KPLUGS_OBJECTS
 
@@ -200,24 +454,49 @@ class Hook(object):
 		KPLUGS_OBJECTS.remove(self._mem)
 
 	def hook(self, where, func):
-		if self._hooks.has_key(func.addr):
-			raise Exception("This function is already a callback of this class")
-
-		# create a kprobe struct
-		kp = self._mem.alloc(KPROBE_STRUCT_MAXSIZE)
-		if isinstance(where, str):
-			sym = self._mem.alloc(len(where) + 1)
-			self._mem[sym] = where + '\0'
-			self._mem[kp + KPROBE_STRUCT_SYMBOL : kp + KPROBE_STRUCT_SYMBOL + WORD_SIZE] = sym
-		else:
-			self._mem[kp + KPROBE_STRUCT_ADDR : kp + KPROBE_STRUCT_ADDR + WORD_SIZE] = where
-		self._mem[kp + KPROBE_STRUCT_HANDLER : kp + KPROBE_STRUCT_HANDLER + WORD_SIZE] = func.addr
+		self.hook_many([(where, func)])
+
+	# hook many (where, func) pairs at once: every kprobe struct is built in one kernel buffer and they are registered with one call
+	def hook_many(self, hooks):
+		if len(hooks) == 0:
+			return
+
+		addrs = set()
+		for where, func in hooks:
+			if self._hooks.has_key(func.addr) or func.addr in addrs:
+				raise Exception("This function is already a callback of this class")
+			addrs.add(func.addr)
+
+		# the kprobe structs, then an array of pointers to them, and then the symbols
+		count = len(hooks)
+		array_offset = count * KPROBE_STRUCT_MAXSIZE
+		symbols_offset = array_offset + count * WORD_SIZE
+		size = symbols_offset + sum([len(where) + 1 for where, func in hooks if isinstance(where, str)])
+
+		base = self._mem.alloc(size)
+		buf = bytearray(size)
+		sym = base + symbols_offset
+		for i in xrange(count):
+			where, func = hooks[i]
+			offset = i * KPROBE_STRUCT_MAXSIZE
+			if isinstance(where, str):
+				struct.pack_into("P", buf, offset + KPROBE_STRUCT_SYMBOL, sym)
+				buf[sym - base : sym - base + len(where)] = where
+				sym += len(where) + 1
+			else:
+				struct.pack_into("P", buf, offset + KPROBE_STRUCT_ADDR, where)
+			struct.pack_into("P", buf, offset + KPROBE_STRUCT_HANDLER, func.addr)
+			struct.pack_into("P", buf, array_offset + i * WORD_SIZE, base + offset)
+		self._mem[base] = str(buf)
 
-		# register the kprobe hook
-		err = self._caller["register_kprobe"](kp)
+		# register the kprobe hooks (if one of them fails, the kernel unregisters the others)
+		err = self._caller["register_kprobes"](base + array_offset, count)
 		if err:
-			raise Exception("register_kprobe failed")
-		self._hooks[func.addr] = kp
+			self._mem.free(base)
+			raise Exception("register_kprobes failed")
+
+		for i in xrange(count):
+			self._hooks[hooks[i][1].addr] = base + i * KPROBE_STRUCT_MAXSIZE
 
 
 	def unhook(self, func):
@@ -232,15 +511,24 @@ class Hook(object):
 
 		# unregister the kprobe hook
 		self._caller["unregister_kprobe"](kp)
-			
+
+	# unregister all the hooks with one call, so the kernel waits for the running handlers only once
+	def unhook_all(self):
+		if len(self._hooks) == 0:
+			return
+
+		kps = self._hooks.values()
+		array = self._mem.alloc(len(kps) * WORD_SIZE)
+		self._mem[array] = struct.pack("P" * len(kps), *kps)
+		self._caller["unregister_kprobes"](array, len(kps))
+		self._mem.free(array)
+		self._hooks = {}
 
 
 	def release(self):
 		global KPLUGS_OBJECTS
 
-		for i in self._hooks.keys():
-			self.unhook(i)
-		self._hooks = {}
+		self.unhook_all()
 		self._mem.release()
 		if KPLUGS_OBJECTS.count(self):
 			KPLUGS_OBJECTS.remove(self)
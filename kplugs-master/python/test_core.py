@@ -0,0 +1,382 @@
+#!/usr/bin/python
+
+import os
+import ast
+import unittest
+import itertools
+import collections
+
+from core import Function, Plug, compiler_visitor, signed_word, WORD_MASK
+
+
+# evaluate an expression the same way as the vm (variables are their ids in vars, and the caught exception is "exception")
+def vm_eval(exp, vars):
+	if type(exp) != dict:
+		return vars[exp]
+	typ = exp["type"]
+	if typ == Function.EXP_WORD:
+		return exp["val1"] & WORD_MASK
+	if typ == Function.EXP_EXCEPTION_VAR:
+		return vars["exception"]
+	if typ in Function.FOLD_UNARY:
+		return Function.FOLD_UNARY[typ](vm_eval(exp["val1"], vars)) & WORD_MASK
+
+	# the vm evaluates val1 first, and stops if it decides the result
+	a = vm_eval(exp["val1"], vars)
+	if typ == Function.EXP_BOOL_OR and a:
+		return a
+	if typ == Function.EXP_BOOL_AND and not a:
+		return a
+	b = vm_eval(exp["val2"], vars)
+	if typ == Function.EXP_BOOL_OR:
+		return int(bool(a or b))
+	if typ == Function.EXP_BOOL_AND:
+		return int(bool(a and b))
+	return Function.FOLD_BINARY[typ](a, b) & WORD_MASK
+
+
+class LoopBreak(Exception):
+	pass
+
+class LoopContinue(Exception):
+	pass
+
+class FunctionReturn(Exception):
+	pass
+
+class FunctionException(Exception):
+	pass
+
+# run a block of flows the same way as the vm (only the flows of the loop tests)
+def vm_run_block(block, vars):
+	for flow in block:
+		typ = flow["type"]
+		if typ == Function.FLOW_ASSIGN:
+			vars[flow["val1"]] = vm_eval(flow["val2"], vars)
+		elif typ in (Function.FLOW_IF, Function.FLOW_IF_CMP):
+			vm_run_block(flow["val2"] if vm_eval(flow["val1"], vars) else flow["val3"], vars)
+		elif typ in (Function.FLOW_WHILE, Function.FLOW_WHILE_CMP, Function.FLOW_FOR):
+			while vm_eval(flow["val1"], vars):
+				try:
+					vm_run_block(flow["val2"], vars)
+				except LoopBreak:
+					break
+				except LoopContinue:
+					pass
+				if typ == Function.FLOW_FOR:
+					vm_run_block(flow["val3"], vars)
+		elif typ == Function.FLOW_TRY:
+			try:
+				vm_run_block(flow["val1"], vars)
+			except FunctionException as exc:
+				vars["exception"] = exc.args[0]
+				vm_run_block(flow["val2"], vars)
+		elif typ == Function.FLOW_THROW:
+			raise FunctionException(vm_eval(flow["val1"], vars))
+		elif typ == Function.FLOW_BREAK:
+			raise LoopBreak()
+		elif typ == Function.FLOW_CONTINUE:
+			raise LoopContinue()
+		elif typ == Function.FLOW_RET:
+			raise FunctionReturn(vm_eval(flow["val1"], vars))
+		elif typ == Function.FLOW_BLOCKEND:
+			return
+		else:
+			raise Exception("Unsupported flow %d" % (typ, ))
+
+# compile a script and run one of its functions with the arguments
+def vm_run(code, name, *args):
+	visitor = compiler_visitor(None)
+	visitor.visit(ast.parse(code))
+	vars = collections.defaultdict(int)
+	vars.update(zip(xrange(1, len(args) + 1), [arg & WORD_MASK for arg in args]))
+	try:
+		vm_run_block([func for func in visitor.functions if func.name == name][0].final, vars)
+	except FunctionReturn as ret:
+		return ret.args[0]
+	raise Exception("The function didn't return")
+
+
+# read an unsigned variable-length number from a compact image. returns the number and the next offset
+def compact_read(image, offset):
+	value = 0
+	shift = 0
+	while True:
+		cur = ord(image[offset])
+		offset += 1
+		value |= (cur & 0x7f) << shift
+		shift += 7
+		if not cur & 0x80:
+			return value, offset
+
+# decode a compact image to the standard bytecode the same way as the kernel
+def decode_compact(image):
+	num, offset = compact_read(image, 0)
+	code = []
+	for index in xrange(num):
+		header = ord(image[offset])
+		offset += 1
+		op = header & 3
+		typ = header >> 2
+		if op == Function.OP_FLOW:
+			count = Function.COMPACT_FLOW_OPERANDS[typ]
+		elif op == Function.OP_EXPRESSION:
+			count = Function.COMPACT_EXP_OPERANDS.get(typ, 2)
+		else:
+			count = 3
+
+		values = [0, 0, 0]
+		for iter in xrange(count):
+			values[iter], offset = compact_read(image, offset)
+		if op == Function.OP_FUNCTION or op == Function.OP_VARIABLE:
+			values[1] = ((values[1] >> 1) ^ -(values[1] & 1)) & WORD_MASK
+		elif op == Function.OP_EXPRESSION and typ == Function.EXP_WORD:
+			values[0] = ((values[0] >> 1) ^ -(values[0] & 1)) & WORD_MASK
+		code.append(Function.RECORD.pack(header, *values))
+	return ''.join(code) + image[offset:]
+
+
+class CompactTest(unittest.TestCase):
+
+	CODE = """
+N = -7
+def f(a, b):
+	x = word(N)
+	buf = buffer(300)
+	buf[a] = 0x41
+	y = a * -3 + 0x123456789
+	if y < -1000:
+		return x
+	return y - 0x7fffffff + b
+"""
+
+	def setUp(self):
+		visitor = compiler_visitor(None)
+		visitor.visit(ast.parse(CompactTest.CODE))
+		self.func = visitor.functions[-1]
+
+	def test_round_trip(self):
+		for unhandled_return, function_type in ((None, 0), (-1, 0), (-0x123456, Function.FUNC_PROFILE), (0x7fffffff, 0)):
+			image = self.func.to_compact_bytes(unhandled_return, function_type)
+			self.assertEqual(decode_compact(image), self.func.to_bytes(unhandled_return, function_type))
+
+	def test_values(self):
+		code = decode_compact(self.func.to_compact_bytes(-1))
+		records = [Function.RECORD.unpack_from(code, offset) for offset in xrange(0, self.func.info["bytecode_size"], Function.RECORD.size)]
+		words = [signed_word(val1) for header, val1, val2, val3 in records if header == (Function.EXP_WORD << 2) | Function.OP_EXPRESSION]
+
+		# negative words, words that take many bytes, the error return and the initial value of a variable
+		self.assertTrue(-3 in words and 0x123456789 & WORD_MASK in [word & WORD_MASK for word in words])
+		self.assertEqual(signed_word(records[0][2]), -1)
+		self.assertTrue((Function.OP_VARIABLE, -7) in [(header & 3, signed_word(val2)) for header, val1, val2, val3 in records])
+		self.assertTrue((Function.OP_VARIABLE, 300) in [(header & 3, val1) for header, val1, val2, val3 in records])
+
+
+# the compiled loops must do what python does
+class ForTest(unittest.TestCase):
+
+	def test_target_assignment(self):
+		# changing the target doesn't change the iterations
+		code = """
+def f():
+	j = 0
+	for k in range(3):
+		k += 2
+		j += 1
+	return j * 10 + k
+"""
+		self.assertEqual(vm_run(code, "f"), 34)
+
+	def test_empty_range(self):
+		code = """
+def f(n):
+	t = 77
+	for t in range(n):
+		pass
+	return t
+"""
+		self.assertEqual(vm_run(code, "f", 0), 77)
+		self.assertEqual(vm_run(code, "f", 5), 4)
+
+	def test_steps(self):
+		code = """
+def f(start, stop, step):
+	s = 0
+	i = 100
+	for i in range(start, stop, step):
+		s = s * 3 + i
+	return s * 1000 + i
+"""
+		for start, stop, step in ((0, 5, 1), (5, 0, -1), (1, 10, 3), (10, 1, -4), (3, 3, 1), (3, 4, -1)):
+			i = 100
+			s = 0
+			for i in range(start, stop, step):
+				s = s * 3 + i
+			self.assertEqual(vm_run(code, "f", start, stop, step), s * 1000 + i, "range(%d, %d, %d)" % (start, stop, step))
+
+	def test_break_continue(self):
+		code = """
+def f():
+	s = 0
+	for i in range(10):
+		if i == 2:
+			continue
+		if i == 6:
+			break
+		for j in range(i):
+			if j == 3:
+				break
+			s += j
+		s = s * 10 + i
+	return s * 10 + i
+"""
+		s = 0
+		for i in range(10):
+			if i == 2:
+				continue
+			if i == 6:
+				break
+			for j in range(i):
+				if j == 3:
+					break
+				s += j
+			s = s * 10 + i
+		self.assertEqual(vm_run(code, "f"), s * 10 + i)
+
+	def test_except(self):
+		# the compiled "break" and "continue" inside "except" (VmLoopTest runs them in the kernel)
+		for name, result in VmLoopTest.RESULTS.items():
+			self.assertEqual(vm_run(VmLoopTest.CODE, name), result, name)
+
+
+# "break" and "continue" inside "except" in the kernel's vm
+@unittest.skipUnless(os.path.exists("/dev/kplugs"), "kplugs is not loaded")
+class VmLoopTest(unittest.TestCase):
+
+	CODE = """
+def except_break():
+	k = 0
+	n = 0
+	while k < 3:
+		k += 1
+		try:
+			raise 1
+		except e:
+			break
+		while n < 5:
+			n += 1
+		n += 100
+	return n * 10 + k
+
+def except_continue():
+	k = 0
+	n = 0
+	while k < 3:
+		k += 1
+		try:
+			raise 1
+		except e:
+			continue
+		while n < 5:
+			n += 1
+		n += 100
+	return n * 10 + k
+
+def except_for():
+	s = 0
+	for i in range(5):
+		try:
+			raise 1
+		except e:
+			if i == 3:
+				break
+			continue
+		while s < 10:
+			s += 1
+	return s * 10 + i
+
+def try_loops():
+	s = 0
+	for i in range(4):
+		try:
+			if i == 2:
+				raise 1
+		except e:
+			continue
+		for j in range(3):
+			s = s * 2 + j
+	return s
+"""
+
+	# the results of the functions in python
+	RESULTS = {
+			"except_break" : 1,
+			"except_continue" : 3,
+			"except_for" : 3,
+			"try_loops" : 292,
+		}
+
+	def setUp(self):
+		self.plug = Plug()
+		self.funcs = dict((func.name, func) for func in self.plug.compile(VmLoopTest.CODE))
+
+	def tearDown(self):
+		self.plug.close()
+
+	def test_functions(self):
+		for name, result in VmLoopTest.RESULTS.items():
+			self.assertEqual(self.funcs[name](), result, name)
+
+
+class FoldTest(unittest.TestCase):
+
+	VALUES = (0, 1, 2, 100, WORD_MASK)
+
+	def setUp(self):
+		self.func = Function("fold_test")
+
+	def word(self, value):
+		return self.func._get_exp(Function.EXP_WORD, value & WORD_MASK)
+
+	def binary(self, typ, val1, val2):
+		return self.func._get_exp(typ, val1, val2)
+
+	def unary(self, typ, val1):
+		return self.func._get_exp(typ, val1)
+
+	# the folded expression must have the same value as the original one for all the values of the variables
+	def check(self, exp, num_vars = 2):
+		folded = self.func._optimize_exp(exp)
+		for values in itertools.product(FoldTest.VALUES, repeat = num_vars):
+			vars = dict(zip(xrange(1, num_vars + 1), values))
+			self.assertEqual(vm_eval(folded, vars), vm_eval(exp, vars), "%r with %r" % (exp, values))
+
+	def test_or_constants(self):
+		for a, b in itertools.product(FoldTest.VALUES, repeat = 2):
+			self.check(self.binary(Function.EXP_BOOL_OR, self.word(a), self.word(b)), 0)
+
+	def test_or_first_operand(self):
+		# a or 100 (the operands are swapped like visit_BoolOp does)
+		self.check(self.binary(Function.EXP_BOOL_OR, self.word(100), 1))
+		self.check(self.binary(Function.EXP_BOOL_OR, 1, self.word(100)))
+		self.check(self.binary(Function.EXP_BOOL_OR, self.word(0), 1))
+
+	def test_or_compare(self):
+		# ((b and a) or -3) == -3
+		test = self.binary(Function.EXP_BOOL_OR, self.word(-3), self.binary(Function.EXP_BOOL_AND, 1, 2))
+		self.check(self.binary(Function.EXP_CMP_EQ, test, self.word(-3)))
+
+	def test_not_not_or(self):
+		# not not (a or b)
+		test = self.binary(Function.EXP_BOOL_OR, 2, 1)
+		self.check(self.unary(Function.EXP_BOOL_NOT, self.unary(Function.EXP_BOOL_NOT, test)))
+		test = self.binary(Function.EXP_BOOL_OR, self.word(100), 1)
+		self.check(self.unary(Function.EXP_BOOL_NOT, self.unary(Function.EXP_BOOL_NOT, test)))
+
+	def test_not_not_and(self):
+		test = self.binary(Function.EXP_BOOL_AND, 2, 1)
+		self.check(self.unary(Function.EXP_BOOL_NOT, self.unary(Function.EXP_BOOL_NOT, test)))
+
+
+if __name__ == "__main__":
+	unittest.main()
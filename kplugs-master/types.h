@@ -29,6 +29,10 @@ typedef struct list_head_s {
 	struct list_head_s *prev;
 } list_head_t;
 
+typedef struct hash_node_s {
+	struct hash_node_s *next;
+} hash_node_t;
+
 typedef unsigned long word;
 typedef signed long sword;
 typedef unsigned char byte;
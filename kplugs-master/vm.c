@@ -3,8 +3,45 @@
 #include "stack.h"
 #include "env.h"
 
+#ifdef PROFILING
+
+/* count a function call and remember when it has started */
+#define PROFILE_ENTER(func, start) do { \
+	if (NULL != (func)->stats) { \
+		(func)->stats->calls++; \
+		(start) = time_get_ns(); \
+	} \
+} while (0)
+
+/* add the run time of a function call */
+#define PROFILE_LEAVE(func, start) do { \
+	if (NULL != (func)->stats) { \
+		temp_time = time_get_ns() - (start); \
+		(func)->stats->total_ns += temp_time; \
+		if (temp_time > (func)->stats->max_ns) { \
+			(func)->stats->max_ns = temp_time; \
+		} \
+	} \
+} while (0)
+
+/* count an opcode when its execution starts */
+#define PROFILE_STEP(state) do { \
+	if (NULL != (state)->func->stats && 0 == (state)->stage) { \
+		(state)->func->stats->pc_counts[(state)->pc]++; \
+	} \
+} while (0)
+
+#else
+
+#define PROFILE_ENTER(func, start) do {} while (0)
+#define PROFILE_LEAVE(func, start) do {} while (0)
+#define PROFILE_STEP(state) do {} while (0)
+
+#endif
+
 /* restore a state when returning from a function */
 #define STATE_RESTORE(func) do { \
+	PROFILE_LEAVE(func, state->call_start); \
 	if (cache) { \
 		cache_clean(cache, calling_function->num_maxargs); \
 		memory_free(cache); \
@@ -27,6 +64,7 @@
 		VM_THROW_EXCEPTION(ERROR_RECUR); \
 	} \
 	recur++; \
+	PROFILE_ENTER(new_func, state->call_start); \
 	state->vars = vars; \
 	state->cache = cache; \
 	vars = memory_alloc(new_func->num_vars * sizeof(word)); \
@@ -77,10 +115,7 @@
 		if (NULL == state) { \
 			ERROR_CLEAN(-ERROR_SEMPTY); \
 		} \
-		if (	state->func->code[state->pc].op == OP_EXPRESSION && \
-				(state->func->code[state->pc].flow.type == EXP_CALL_STRING || \
-				 state->func->code[state->pc].flow.type == EXP_CALL_PTR) && \
-				state->vars != NULL) { \
+		if (IS_CALL_HANDLER(state->func->insns[state->pc].handler) && state->vars != NULL) { \
 			STATE_RESTORE(calling_function); \
 		} \
 	} \
@@ -95,6 +130,7 @@
 #define VM_STEP() do { \
 	state->pc++; \
 	state->stage = 0; \
+	state->in_loop = 0; \
 } while (0); continue
 
 
@@ -136,10 +172,7 @@
 		if (NULL == state) { \
 			ERROR_CLEAN(-ERROR_SEMPTY); \
 		} \
-		if (	state->func->code[state->pc].op == OP_EXPRESSION && \
-				(state->func->code[state->pc].flow.type == EXP_CALL_STRING || \
-				 state->func->code[state->pc].flow.type == EXP_CALL_PTR) && \
-				state->vars != NULL) { \
+		if (IS_CALL_HANDLER(state->func->insns[state->pc].handler) && state->vars != NULL) { \
 			/* we should always get here */ \
 			STATE_RESTORE(calling_function); \
 			ret = value; \
@@ -150,12 +183,26 @@
 } while (0); VM_LEAVE_BLOCK()
 
 
+/* leave the blocks of the innermost loop (the state of the loop's flow is left on the stack).
+ * a loop flow that is only the next flow of a "try" that caught an exception is not the innermost loop */
+#define VM_LEAVE_LOOP() do { \
+	do { \
+		err = stack_pop(&stack, NULL); \
+		CHECK_ERROR(err); \
+		state = stack_peek(&stack); \
+		if (NULL == state) { \
+			ERROR_CLEAN(-ERROR_SEMPTY); \
+		} \
+	} while (!state->in_loop || !IS_LOOP_HANDLER(state->func->insns[state->pc].handler)); \
+} while (0)
+
+
 /* load a state from a function and a pc */
 static void load_state(function_t *func, vm_state_t *state, word pc, word num_args)
 {
 	memory_set(state, 0, sizeof(vm_state_t));
 
-	state->op = (func->code[pc].op == OP_FLOW) ? VM_FLOW : VM_EXPRESSION;
+	state->op = (func->insns[pc].handler < VM_EXP_HANDLER(0)) ? VM_FLOW : VM_EXPRESSION;
 	state->pc = pc;
 	state->func = func;
 	state->args = num_args;
@@ -170,6 +217,55 @@ static vm_state_t *push_state(function_t *func, stack_t *stack, word pc, word nu
 	return stack_push(stack, &state);
 }
 
+/* compare two values by the handler of a compare expression */
+static word vm_compare(word handler, word val1, word val2)
+{
+	switch (handler) {
+	case VM_EXP_HANDLER(EXP_CMP_EQ):
+		return val1 == val2;
+	case VM_EXP_HANDLER(EXP_CMP_NE):
+		return val1 != val2;
+	case VM_EXP_HANDLER(EXP_CMP_UNSIGN):
+		return val1 < val2;
+	case VM_EXP_HANDLER(EXP_CMP_SIGN):
+		return (sword)val1 < (sword)val2;
+	case VM_EXP_HANDLER(EXP_CMP_LE_UNSIGN):
+		return val1 <= val2;
+	case VM_EXP_HANDLER(EXP_CMP_LE_SIGN):
+		return (sword)val1 <= (sword)val2;
+	case VM_EXP_HANDLER(EXP_CMP_GT_UNSIGN):
+		return val1 > val2;
+	case VM_EXP_HANDLER(EXP_CMP_GT_SIGN):
+		return (sword)val1 > (sword)val2;
+	case VM_EXP_HANDLER(EXP_CMP_GE_UNSIGN):
+		return val1 >= val2;
+	case VM_EXP_HANDLER(EXP_CMP_GE_SIGN):
+		return (sword)val1 >= (sword)val2;
+	default:
+		/* we should never get here! (the function was checked) */
+		return 0;
+	}
+}
+
+/* get the value of an operand that is a word variable or a constant without entering its block.
+ * returns 0 if the operand is not that simple */
+static int vm_simple_operand(vm_state_t *state, word *vars, word index, word *value)
+{
+	vm_insn_t *insn = &state->func->insns[index];
+
+	switch (insn->handler) {
+	case VM_HANDLER_VAR:
+	case VM_EXP_HANDLER(EXP_VAR):
+		*value = vars[insn->val1];
+		return 1;
+	case VM_EXP_HANDLER(EXP_WORD):
+		*value = insn->val1;
+		return 1;
+	default:
+		return 0;
+	}
+}
+
 /* initialize the arguments and local variables buffer */
 static int vm_init_local_variable(vm_state_t *state, stack_t *arg_stack, word *vars, arg_cache_t *cache)
 {
@@ -247,8 +343,106 @@ static int vm_init_local_variable(vm_state_t *state, stack_t *arg_stack, word *v
 	return 0;
 }
 
+/* lower the checked bytecode of a function to the vm instructions */
+int vm_lower_function(function_t *func)
+{
+	bytecode_t *code = func->code;
+	vm_insn_t *insn;
+	word pc;
+
+	func->insns = memory_alloc(func->num_opcodes * sizeof(vm_insn_t));
+	if (NULL == func->insns) {
+		ERROR(-ERROR_MEM);
+	}
+	memory_set(func->insns, 0, func->num_opcodes * sizeof(vm_insn_t));
+
+	for (pc = 0; pc < func->num_opcodes; ++pc) {
+		insn = &func->insns[pc];
+
+		switch (code[pc].op) {
+		case OP_FUNCTION:
+			insn->handler = VM_HANDLER_FUNCTION;
+			break;
+
+		case OP_VARIABLE:
+			/* the variable's index in the variables buffer */
+			insn->val1 = pc - 1;
+			if (code[pc].var.type == VAR_WORD || code[pc].var.type == VAR_POINTER) {
+				insn->handler = VM_HANDLER_VAR;
+			} else {
+				insn->handler = VM_HANDLER_BAD_VAR;
+			}
+			break;
+
+		case OP_FLOW:
+			insn->handler = VM_FLOW_HANDLER(code[pc].flow.type);
+			insn->val1 = code[pc].flow.val1;
+			insn->val2 = code[pc].flow.val2;
+			insn->val3 = code[pc].flow.val3;
+
+			if (	code[pc].flow.type == FLOW_ASSIGN ||
+					code[pc].flow.type == FLOW_MAP_UPDATE ||
+					code[pc].flow.type == FLOW_MAP_ADD) {
+				insn->val1--;
+			} else if (code[pc].flow.type == FLOW_ASSIGN_OFFSET) {
+				insn->var_type = code[insn->val1].var.type;
+				insn->var_size = code[insn->val1].var.size;
+			}
+			break;
+
+		default:
+			insn->handler = VM_EXP_HANDLER(code[pc].expression.type);
+			insn->val1 = code[pc].expression.val1;
+			insn->val2 = code[pc].expression.val2;
+
+			switch (code[pc].expression.type) {
+			case EXP_VAR:
+				insn->val1--;
+				break;
+
+			case EXP_STRING:
+				/* the address of the string */
+				insn->val1 = (word)func->raw + func->string_table[insn->val1 - 1];
+				break;
+
+			case EXP_ADDRESSOF:
+			case EXP_BUF_OFFSET:
+				insn->var_type = code[insn->val1].var.type;
+				insn->var_size = code[insn->val1].var.size;
+				break;
+
+			case EXP_CALL_STRING:
+			case EXP_CALL_PTR:
+				/* the arguments are right after the call. val3 is the stage in which all of them were pushed */
+				for (	insn->val3 = 1;
+						pc + insn->val3 < func->num_opcodes && code[pc + insn->val3].expression.type != EXP_CALL_END;
+						++insn->val3);
+				break;
+
+			default:
+				break;
+			}
+			break;
+		}
+	}
+
+	return 0;
+}
+
 extern context_t *GLOBAL_CONTEXT;
 
+/* find a map by its handle in a function's context or in the global context (inside an rcu read lock) */
+static hashmap_t *vm_find_map(context_t *cont, byte *ptr)
+{
+	hashmap_t *map = context_find_map(cont, ptr);
+
+	if (NULL == map && NULL != GLOBAL_CONTEXT && cont != GLOBAL_CONTEXT) {
+		map = context_find_map(GLOBAL_CONTEXT, ptr);
+	}
+
+	return map;
+}
+
 /* execute a function on the vm */
 word vm_run_function(function_t *func, stack_t *arg_stack, exception_t *excep)
 {
@@ -260,11 +454,14 @@ word vm_run_function(function_t *func, stack_t *arg_stack, exception_t *excep)
 
 	vm_state_t *state;
 	vm_state_t *new_state;
+	vm_insn_t *insn;
 	stack_t stack;
 
 	function_t *calling_function = NULL;
 	void *external_function = NULL;
 	dyn_mem_t *dyn;
+	events_t *events;
+	hashmap_t *map;
 	word recur = 0;
 	word type = 0;
 	word val1 = 0;
@@ -274,11 +471,17 @@ word vm_run_function(function_t *func, stack_t *arg_stack, exception_t *excep)
 	word exception_var = 0;
 	word ret = 0;
 	byte ret_b = 0;
+#ifdef PROFILING
+	word start_time = 0;
+	word temp_time;
+#endif
 
 	int err = 0;
 
 	excep->had_exception = 0;
 
+	PROFILE_ENTER(func, start_time);
+
 	err = stack_alloc(&stack, sizeof(vm_state_t), CALL_STACK_SIZE);
 	if (err < 0) {
 		return err;
@@ -323,604 +526,746 @@ word vm_run_function(function_t *func, stack_t *arg_stack, exception_t *excep)
 		pc = state->pc;
 		stage = state->stage;
 
-		if (pc > 0 && pc < state->func->num_vars + 1) {
-			switch (state->func->code[pc].var.type) {
-			case VAR_WORD:
-			case VAR_POINTER:
-				ret = vars[pc - 1];
-				VM_LEAVE_BLOCK();
-			break;
-			default:
-				VM_THROW_EXCEPTION(ERROR_VAR);
-			}
-		}
+		PROFILE_STEP(state);
 
-		switch (state->op) {
-		case VM_FLOW:
-			type = state->func->code[pc].flow.type;
-			val1 = state->func->code[pc].flow.val1;
-			val2 = state->func->code[pc].flow.val2;
-			val3 = state->func->code[pc].flow.val3;
+		insn = &state->func->insns[pc];
+		type = insn->handler;
+		val1 = insn->val1;
+		val2 = insn->val2;
+		val3 = insn->val3;
 
-			switch (type) {
-			case FLOW_ASSIGN:
-				if (stage == 0) {
-					VM_ENTER_BLOCK(val2);
-				} else {
-					vars[val1 - 1] = ret;
-					VM_STEP();
-				}
+		switch (type) {
+		case VM_HANDLER_VAR:
+			ret = vars[val1];
+			VM_LEAVE_BLOCK();
 
-			break;
+		break;
 
-			case FLOW_ASSIGN_OFFSET:
-				if (stage == 0) {
-					VM_ENTER_BLOCK(val3);
-				} else if (stage == 1) {
-					state->val = ret;
+		case VM_HANDLER_BAD_VAR:
+			VM_THROW_EXCEPTION(ERROR_VAR);
 
-					VM_ENTER_BLOCK(val2);
-				} else {
+		break;
 
+		case VM_FLOW_HANDLER(FLOW_ASSIGN):
+			if (stage == 0) {
+				VM_ENTER_BLOCK(val2);
+			} else {
+				vars[val1] = ret;
+				VM_STEP();
+			}
 
+		break;
 
-					if (state->func->code[val1].var.type == VAR_POINTER) {
-						temp_value = sizeof(byte);
-						temp_value2 = ret;
-					} else if (state->func->code[val1].var.type == VAR_BUF) {
-						if (temp_value2 >= state->func->code[val1].var.size) {
-							VM_THROW_EXCEPTION(ERROR_OOB);
-						}
+		case VM_FLOW_HANDLER(FLOW_ASSIGN_OFFSET):
+			if (stage == 0) {
+				VM_ENTER_BLOCK(val3);
+			} else if (stage == 1) {
+				state->val = ret;
 
-						temp_value = sizeof(byte);
-						temp_value2 = ret;
-					} else {
+				VM_ENTER_BLOCK(val2);
+			} else {
 
-						/* VAR_ARRAY */
 
-						temp_value = sizeof(word);
-						temp_value2 = ret * temp_value;
 
-						/* because of the alignment we can't overflow */
-						if (temp_value2 >= state->func->code[val1].var.size) {
-							VM_THROW_EXCEPTION(ERROR_OOB);
-						}
+				if (insn->var_type == VAR_POINTER) {
+					temp_value = sizeof(byte);
+					temp_value2 = ret;
+				} else if (insn->var_type == VAR_BUF) {
+					if (temp_value2 >= insn->var_size) {
+						VM_THROW_EXCEPTION(ERROR_OOB);
+					}
 
+					temp_value = sizeof(byte);
+					temp_value2 = ret;
+				} else {
+
+					/* VAR_ARRAY */
+
+					temp_value = sizeof(word);
+					temp_value2 = ret * temp_value;
+
+					/* because of the alignment we can't overflow */
+					if (temp_value2 >= insn->var_size) {
+						VM_THROW_EXCEPTION(ERROR_OOB);
 					}
 
-					if (state->func->code[val1].var.type != VAR_POINTER) {
+				}
 
-						if (val1 > state->args) {
-							/* This is NOT a pointer and it's a local variable */
-							if (temp_value == sizeof(word)) {
-								*(word *)(vars[val1 - 1] + temp_value2) = state->val;
-							} else {
-								*(byte *)(vars[val1 - 1] + temp_value2) = (byte)state->val;
-							}
-							err = 0;
+				if (insn->var_type != VAR_POINTER) {
+
+					if (val1 > state->args) {
+						/* This is NOT a pointer and it's a local variable */
+						if (temp_value == sizeof(word)) {
+							*(word *)(vars[val1 - 1] + temp_value2) = state->val;
 						} else {
-							/* This is NOT a pointer and it's an argument */
-							err = cache_memory_copy((byte *)vars[val1 - 1], (byte *)&state->val, temp_value2, temp_value, state->func->code[val1].var.size, &cache[val1 - 1], 1);
-						}
-					} else {
-						/* This is a pointer */
-
-						/* check if it's a dynamic memory */
-						dyn = get_dyn_mem(&dyn_head, (void *)vars[val1 - 1]);
-						if (NULL != dyn) {
-							/* we can check boundaries */
-							if (temp_value2 >= dyn->size) {
-								VM_THROW_EXCEPTION(ERROR_OOB);
-							}
 							*(byte *)(vars[val1 - 1] + temp_value2) = (byte)state->val;
-						} else {
-							err = safe_memory_copy(((byte *)vars[val1 - 1]) + temp_value2, &state->val, temp_value, ADDR_UNDEF, ADDR_INSIDE, 0, 0);
 						}
+						err = 0;
+					} else {
+						/* This is NOT a pointer and it's an argument */
+						err = cache_memory_copy((byte *)vars[val1 - 1], (byte *)&state->val, temp_value2, temp_value, insn->var_size, &cache[val1 - 1], 1);
 					}
+				} else {
+					/* This is a pointer */
 
-					if (err < 0) {
-						VM_THROW_EXCEPTION(-err);
+					/* check if it's a dynamic memory */
+					dyn = get_dyn_mem(&dyn_head, (void *)vars[val1 - 1]);
+					if (NULL != dyn) {
+						/* we can check boundaries */
+						if (temp_value2 >= dyn->size) {
+							VM_THROW_EXCEPTION(ERROR_OOB);
+						}
+						*(byte *)(vars[val1 - 1] + temp_value2) = (byte)state->val;
+					} else {
+						err = safe_memory_copy(((byte *)vars[val1 - 1]) + temp_value2, &state->val, temp_value, ADDR_UNDEF, ADDR_INSIDE, 0, 0);
 					}
+				}
 
-					VM_STEP();
+				if (err < 0) {
+					VM_THROW_EXCEPTION(-err);
 				}
 
-			break;
-			case FLOW_IF:
-				if (stage == 0) {
-					VM_ENTER_BLOCK(val1);
-				} else if (stage == 1) {
-					if (ret) {
-						VM_ENTER_BLOCK(val2);
-					} else {
-						VM_ENTER_BLOCK(val3);
-					}
+				VM_STEP();
+			}
+
+		break;
+		case VM_FLOW_HANDLER(FLOW_IF):
+			if (stage == 0) {
+				VM_ENTER_BLOCK(val1);
+			} else if (stage == 1) {
+				if (ret) {
+					VM_ENTER_BLOCK(val2);
 				} else {
-					VM_STEP();
+					VM_ENTER_BLOCK(val3);
 				}
+			} else {
+				VM_STEP();
+			}
 
-			break;
+		break;
 
-			case FLOW_TRY:
-				if (stage == 0) {
-					state->exception_handler = val2;
-					VM_ENTER_BLOCK(val1);
+		case VM_FLOW_HANDLER(FLOW_TRY):
+			if (stage == 0) {
+				state->exception_handler = val2;
+				VM_ENTER_BLOCK(val1);
+			} else {
+				VM_STEP();
+			}
+
+		break;
+
+		case VM_FLOW_HANDLER(FLOW_WHILE):
+			if (stage == 0) {
+				VM_ENTER_BLOCK(val1);
+			} else if (stage == 1) {
+				if (ret) {
+					state->in_loop = 1;
+					VM_ENTER_BLOCK(val2);
 				} else {
 					VM_STEP();
 				}
+			} else {
+				state->stage = 0;
+			}
 
-			break;
+		break;
 
-			case FLOW_WHILE:
-				if (stage == 0) {
-					VM_ENTER_BLOCK(val1);
-				} else if (stage == 1) {
-					if (ret) {
-						VM_ENTER_BLOCK(val2);
-					} else {
-						VM_STEP();
-					}
+		case VM_FLOW_HANDLER(FLOW_IF_CMP):
+		case VM_FLOW_HANDLER(FLOW_WHILE_CMP):
+			/* val1 is a compare expression: its operands are evaluated here, and simple operands are read directly */
+			if (stage == 0) {
+				if (!vm_simple_operand(state, vars, state->func->insns[val1].val1, &ret)) {
+					VM_ENTER_BLOCK(state->func->insns[val1].val1);
+				}
+				stage = 1;
+			}
+			if (stage == 1) {
+				state->val = ret;
+				if (!vm_simple_operand(state, vars, state->func->insns[val1].val2, &ret)) {
+					state->stage = 1;
+					VM_ENTER_BLOCK(state->func->insns[val1].val2);
+				}
+				stage = 2;
+			}
+			if (stage == 2) {
+				state->stage = 2;
+				if (vm_compare(state->func->insns[val1].handler, state->val, ret)) {
+					state->in_loop = (type == VM_FLOW_HANDLER(FLOW_WHILE_CMP));
+					VM_ENTER_BLOCK(val2);
+				} else if (type == VM_FLOW_HANDLER(FLOW_IF_CMP)) {
+					VM_ENTER_BLOCK(val3);
 				} else {
-					state->stage = 0;
+					VM_STEP();
 				}
+			} else if (type == VM_FLOW_HANDLER(FLOW_IF_CMP)) {
+				VM_STEP();
+			} else {
+				state->stage = 0;
+			}
 
-			break;
+		break;
 
-			case FLOW_DYN_FREE:
-				if (stage == 0) {
+		case VM_FLOW_HANDLER(FLOW_FOR):
+			if (stage == 0) {
+				/* a compare of simple operands is done here, without entering the condition */
+				if (	IS_COMPARE_HANDLER(state->func->insns[val1].handler) &&
+						vm_simple_operand(state, vars, state->func->insns[val1].val1, &state->val) &&
+						vm_simple_operand(state, vars, state->func->insns[val1].val2, &ret)) {
+					ret = vm_compare(state->func->insns[val1].handler, state->val, ret);
+					stage = 1;
+				} else {
 					VM_ENTER_BLOCK(val1);
+				}
+			}
+			if (stage == 1) {
+				if (ret) {
+					state->stage = 1;
+					state->in_loop = 1;
+					VM_ENTER_BLOCK(val2);
 				} else {
-					err = memory_free_dyn(val2 ? NULL : &dyn_head, (void *)ret);
-					if (err) {
-						VM_THROW_EXCEPTION(-err);
-					}
 					VM_STEP();
 				}
+			} else if (stage == 2) {
+				/* the iteration has ended (or "continue"): run the step block */
+				VM_ENTER_BLOCK(val3);
+			} else {
+				state->stage = 0;
+			}
 
-			break;
+		break;
 
-			case FLOW_BLOCKEND:
-				VM_LEAVE_BLOCK();
+		case VM_FLOW_HANDLER(FLOW_BREAK):
+			VM_LEAVE_LOOP();
+			VM_STEP();
 
-			break;
+		break;
 
-			case FLOW_THROW:
-				if (stage == 0) {
-					VM_ENTER_BLOCK(val1);
+		case VM_FLOW_HANDLER(FLOW_CONTINUE):
+			VM_LEAVE_LOOP();
+			if (state->func->insns[state->pc].handler == VM_FLOW_HANDLER(FLOW_FOR)) {
+				state->stage = 2;
+			} else {
+				state->stage = 0;
+			}
+
+		break;
+
+		case VM_FLOW_HANDLER(FLOW_MAP_UPDATE):
+		case VM_FLOW_HANDLER(FLOW_MAP_ADD):
+			if (stage == 0) {
+				VM_ENTER_BLOCK(val3);
+			} else if (stage == 1) {
+				state->val = ret;
+
+				VM_ENTER_BLOCK(val2);
+			} else {
+				rcu_read_lock();
+				map = vm_find_map(state->func->cont, (byte *)vars[val1]);
+				if (NULL == map) {
+					err = -ERROR_PARAM;
+				} else if (type == VM_FLOW_HANDLER(FLOW_MAP_ADD)) {
+					err = hashmap_add(map, ret, state->val);
 				} else {
-					VM_THROW_EXCEPTION(ret);
+					err = hashmap_update(map, ret, state->val);
 				}
+				rcu_read_unlock();
 
-			break;
+				if (err < 0) {
+					VM_THROW_EXCEPTION(-err);
+				}
+				VM_STEP();
+			}
 
-			case FLOW_RET:
-				if (stage == 0) {
-					VM_ENTER_BLOCK(val1);
-				} else {
-					VM_RET(ret);
+		break;
+
+		case VM_FLOW_HANDLER(FLOW_DYN_FREE):
+			if (stage == 0) {
+				VM_ENTER_BLOCK(val1);
+			} else {
+				err = memory_free_dyn(val2 ? NULL : &dyn_head, (void *)ret);
+				if (err) {
+					VM_THROW_EXCEPTION(-err);
 				}
+				VM_STEP();
+			}
 
-			break;
+		break;
 
+		case VM_FLOW_HANDLER(FLOW_BLOCKEND):
+			VM_LEAVE_BLOCK();
 
-			default:
-				/* we should never get here! */
-				VM_THROW_EXCEPTION(ERROR_OP);
-			break;
+		break;
+
+		case VM_FLOW_HANDLER(FLOW_THROW):
+			if (stage == 0) {
+				VM_ENTER_BLOCK(val1);
+			} else {
+				VM_THROW_EXCEPTION(ret);
 			}
+
 		break;
-		case VM_EXPRESSION:
-			type = state->func->code[pc].expression.type;
-			val1 = state->func->code[pc].expression.val1;
-			val2 = state->func->code[pc].expression.val2;
-			switch (type) {
-			case EXP_WORD:
-				ret = val1;
-				VM_LEAVE_BLOCK();
 
-			break;
+		case VM_FLOW_HANDLER(FLOW_RET):
+			if (stage == 0) {
+				VM_ENTER_BLOCK(val1);
+			} else {
+				VM_RET(ret);
+			}
 
-			case EXP_VAR:
-				ret = vars[val1 - 1];
-				VM_LEAVE_BLOCK();
+		break;
 
-			break;
 
-			case EXP_STRING:
-				ret = (word)state->func->raw + state->func->string_table[val1 - 1];
-				VM_LEAVE_BLOCK();
+		case VM_EXP_HANDLER(EXP_WORD):
+			ret = val1;
+			VM_LEAVE_BLOCK();
 
-			break;
+		break;
 
-			case EXP_EXCEPTION_VAR:
-				ret = exception_var;
-				VM_LEAVE_BLOCK();
+		case VM_EXP_HANDLER(EXP_VAR):
+			ret = vars[val1];
+			VM_LEAVE_BLOCK();
 
-			break;
+		break;
 
-			case EXP_ADDRESSOF:
-				if (	state->func->code[val1].var.type == VAR_WORD || 
-						state->func->code[val1].var.type == VAR_POINTER) {
-					ret = (word)&vars[val1 - 1];
+		case VM_EXP_HANDLER(EXP_STRING):
+			ret = val1;
+			VM_LEAVE_BLOCK();
+
+		break;
+
+		case VM_EXP_HANDLER(EXP_EXCEPTION_VAR):
+			ret = exception_var;
+			VM_LEAVE_BLOCK();
+
+		break;
+
+		case VM_EXP_HANDLER(EXP_ADDRESSOF):
+			if (	insn->var_type == VAR_WORD || 
+					insn->var_type == VAR_POINTER) {
+				ret = (word)&vars[val1 - 1];
+			} else {
+				if (val1 > state->args) {
+					/* this is a local variable */
+					ret = vars[val1 - 1];
 				} else {
-					if (val1 > state->args) {
-						/* this is a local variable */
-						ret = vars[val1 - 1];
-					} else {
-						/* this is a buffer/array argument */
-						if (!IS_CACHED(&cache[val1 - 1])) {
-							err = cache_memory_map((byte *)vars[val1 - 1], state->func->code[val1].var.size, &cache[val1 - 1], 0);
-							if (err < 0) {
-								/* we cannot allow using the original address of a buffer, because we want buffers to be safe and we can't how address will be used */
-								VM_THROW_EXCEPTION(ERROR_POINT);
-							}
+					/* this is a buffer/array argument */
+					if (!IS_CACHED(&cache[val1 - 1])) {
+						err = cache_memory_map((byte *)vars[val1 - 1], insn->var_size, &cache[val1 - 1], 0);
+						if (err < 0) {
+							/* we cannot allow using the original address of a buffer, because we want buffers to be safe and we can't how address will be used */
+							VM_THROW_EXCEPTION(ERROR_POINT);
 						}
-
-						ret = (word)cache[val1 - 1].addr;
 					}
-					
+
+					ret = (word)cache[val1 - 1].addr;
 				}
-				VM_LEAVE_BLOCK();
+				
+			}
+			VM_LEAVE_BLOCK();
 
-			break;
+		break;
 
-			case EXP_DEREF:
-				if (stage == 0) {
-					VM_ENTER_BLOCK(val1);
+		case VM_EXP_HANDLER(EXP_DEREF):
+			if (stage == 0) {
+				VM_ENTER_BLOCK(val1);
+			} else {
+				if (val2 == sizeof(byte)) {
+					err = safe_memory_copy(&ret_b, (byte *)ret, sizeof(byte), ADDR_INSIDE, ADDR_UNDEF, 0, 0);
+					ret = (word)ret_b;
+				} else if (val2 == sizeof(word)) {
+					err = safe_memory_copy(&temp_value, (byte *)ret, sizeof(word), ADDR_INSIDE, ADDR_UNDEF, 0, 0);
+					ret = temp_value;
 				} else {
-					if (val2 == sizeof(byte)) {
-						err = safe_memory_copy(&ret_b, (byte *)ret, sizeof(byte), ADDR_INSIDE, ADDR_UNDEF, 0, 0);
-						ret = (word)ret_b;
-					} else if (val2 == sizeof(word)) {
-						err = safe_memory_copy(&temp_value, (byte *)ret, sizeof(word), ADDR_INSIDE, ADDR_UNDEF, 0, 0);
-						ret = temp_value;
-					} else {
-						/* we should never get here! */
-						VM_THROW_EXCEPTION(ERROR_PARAM);
-					}
-					
-					if (err < 0) {
-						VM_THROW_EXCEPTION(-err);
-					}
-					VM_LEAVE_BLOCK();
+					/* we should never get here! */
+					VM_THROW_EXCEPTION(ERROR_PARAM);
 				}
-			break;
-			case EXP_BUF_OFFSET:
-				if (stage == 0) {
-					VM_ENTER_BLOCK(val2);
+				
+				if (err < 0) {
+					VM_THROW_EXCEPTION(-err);
+				}
+				VM_LEAVE_BLOCK();
+			}
+		break;
+		case VM_EXP_HANDLER(EXP_BUF_OFFSET):
+			if (stage == 0) {
+				VM_ENTER_BLOCK(val2);
+			} else {
+
+				if (insn->var_type == VAR_POINTER) {
+					temp_value = sizeof(byte);
+					temp_value2 = ret;
+				} else if (insn->var_type == VAR_BUF) {
+					if (ret >= insn->var_size) {
+						VM_THROW_EXCEPTION(ERROR_OOB);
+					}
+
+					temp_value = sizeof(byte);
+					temp_value2 = ret;
 				} else {
 
-					if (state->func->code[val1].var.type == VAR_POINTER) {
-						temp_value = sizeof(byte);
-						temp_value2 = ret;
-					} else if (state->func->code[val1].var.type == VAR_BUF) {
-						if (ret >= state->func->code[val1].var.size) {
-							VM_THROW_EXCEPTION(ERROR_OOB);
-						}
+					/* VAR_ARRAY */
 
-						temp_value = sizeof(byte);
-						temp_value2 = ret;
-					} else {
+					temp_value = sizeof(word);
+					temp_value2 = ret * temp_value;
 
-						/* VAR_ARRAY */
+					/* because of the alignment we can't overflow */
+					if (temp_value2 >= insn->var_size) {
+						VM_THROW_EXCEPTION(ERROR_OOB);
+					}
+				}
 
-						temp_value = sizeof(word);
-						temp_value2 = ret * temp_value;
+				if (insn->var_type != VAR_POINTER) {
 
-						/* because of the alignment we can't overflow */
-						if (temp_value2 >= state->func->code[val1].var.size) {
-							VM_THROW_EXCEPTION(ERROR_OOB);
+					if (val1 > state->args) {
+						/* This is NOT a pointer and it's a local variable */
+						ret = (temp_value == sizeof(word)) ? *(word *)(vars[val1 - 1] + temp_value2) : *(byte *)(vars[val1 - 1] + temp_value2);
+						err = 0;
+					} else {
+						/* This is NOT a pointer and it's an argument */
+						err = cache_memory_copy((byte *)vars[val1 - 1], (temp_value == sizeof(byte)) ? &ret_b : (byte *)&ret, temp_value2, temp_value, insn->var_size, &cache[val1 - 1], 0);
+						if (temp_value == sizeof(byte)) {
+							ret = ret_b;
 						}
 					}
+				} else {
+					/* This is a pointer */
 
-					if (state->func->code[val1].var.type != VAR_POINTER) {
-
-						if (val1 > state->args) {
-							/* This is NOT a pointer and it's a local variable */
-							ret = (temp_value == sizeof(word)) ? *(word *)(vars[val1 - 1] + temp_value2) : *(byte *)(vars[val1 - 1] + temp_value2);
-							err = 0;
-						} else {
-							/* This is NOT a pointer and it's an argument */
-							err = cache_memory_copy((byte *)vars[val1 - 1], (temp_value == sizeof(byte)) ? &ret_b : (byte *)&ret, temp_value2, temp_value, state->func->code[val1].var.size, &cache[val1 - 1], 0);
-							if (temp_value == sizeof(byte)) {
-								ret = ret_b;
-							}
+					/* check if it's a dynamic memory */
+					dyn = get_dyn_mem(&dyn_head, (void *)vars[val1 - 1]);
+					if (NULL != dyn) {
+						/* we can check boundaries */
+						if (temp_value2 >= dyn->size) {
+							VM_THROW_EXCEPTION(ERROR_OOB);
 						}
+						ret = *(byte *)(vars[val1 - 1] + temp_value2);
 					} else {
-						/* This is a pointer */
-
-						/* check if it's a dynamic memory */
-						dyn = get_dyn_mem(&dyn_head, (void *)vars[val1 - 1]);
-						if (NULL != dyn) {
-							/* we can check boundaries */
-							if (temp_value2 >= dyn->size) {
-								VM_THROW_EXCEPTION(ERROR_OOB);
-							}
-							ret = *(byte *)(vars[val1 - 1] + temp_value2);
-						} else {
-							err = safe_memory_copy((temp_value == sizeof(byte)) ? &ret_b : (byte *)&ret, ((byte *)vars[val1 - 1]) + temp_value2, temp_value, ADDR_INSIDE, ADDR_UNDEF, 0, 0);
-							if (temp_value == sizeof(byte)) {
-								ret = ret_b;
-							}
+						err = safe_memory_copy((temp_value == sizeof(byte)) ? &ret_b : (byte *)&ret, ((byte *)vars[val1 - 1]) + temp_value2, temp_value, ADDR_INSIDE, ADDR_UNDEF, 0, 0);
+						if (temp_value == sizeof(byte)) {
+							ret = ret_b;
 						}
 					}
-					if (err < 0) {
-						VM_THROW_EXCEPTION(-err);
-					}
-
-					VM_LEAVE_BLOCK();
-				}
-			break;
-
-			case EXP_ADD:
-				if (stage == 2) {
-					ret = state->val + ret;
-					VM_LEAVE_BLOCK();
-				}
-			case EXP_SUB:
-				if (stage == 2) {
-					ret = state->val - ret;
-					VM_LEAVE_BLOCK();
 				}
-			case EXP_MUL:
-				if (stage == 2) {
-					ret = state->val * ret;
-					VM_LEAVE_BLOCK();
+				if (err < 0) {
+					VM_THROW_EXCEPTION(-err);
 				}
-			case EXP_DIV:
-				if (stage == 2) {
-					if (ret == 0) {
-						VM_THROW_EXCEPTION(ERROR_DIV);
-					}
-					ret = state->val / ret;
 
-					VM_LEAVE_BLOCK();
-				}
-			case EXP_AND:
-				if (stage == 2) {
-					ret = state->val & ret;
-					VM_LEAVE_BLOCK();
-				}
-			case EXP_OR:
-				if (stage == 2) {
-					ret = state->val | ret;
-					VM_LEAVE_BLOCK();
-				}
-			case EXP_XOR:
-				if (stage == 2) {
-					ret = state->val ^ ret;
-					VM_LEAVE_BLOCK();
-				}
-			case EXP_BOOL_AND:
-				if (stage == 2) {
-					ret = state->val && ret;
-					VM_LEAVE_BLOCK();
-				}
-			case EXP_BOOL_OR:
-				if (stage == 2) {
-					ret = state->val || ret;
-					VM_LEAVE_BLOCK();
-				}
+				VM_LEAVE_BLOCK();
+			}
+		break;
 
-			case EXP_MOD:
-				if (stage == 2) {
-					ret = state->val % ret;
-					VM_LEAVE_BLOCK();
+		case VM_EXP_HANDLER(EXP_ADD):
+			if (stage == 2) {
+				ret = state->val + ret;
+				VM_LEAVE_BLOCK();
+			}
+		case VM_EXP_HANDLER(EXP_SUB):
+			if (stage == 2) {
+				ret = state->val - ret;
+				VM_LEAVE_BLOCK();
+			}
+		case VM_EXP_HANDLER(EXP_MUL):
+			if (stage == 2) {
+				ret = state->val * ret;
+				VM_LEAVE_BLOCK();
+			}
+		case VM_EXP_HANDLER(EXP_DIV):
+			if (stage == 2) {
+				if (ret == 0) {
+					VM_THROW_EXCEPTION(ERROR_DIV);
 				}
+				ret = state->val / ret;
 
-				if (type == EXP_BOOL_OR && stage == 1 && ret) {
-					VM_LEAVE_BLOCK();
-				}
-				if (type == EXP_BOOL_AND && stage == 1 && !ret) {
-					VM_LEAVE_BLOCK();
-				}
-				if (stage == 0) {
-					VM_ENTER_BLOCK(val1);
-				} else if (stage == 1) {
-					state->val = ret;
-					VM_ENTER_BLOCK(val2);
-				}
+				VM_LEAVE_BLOCK();
+			}
+		case VM_EXP_HANDLER(EXP_AND):
+			if (stage == 2) {
+				ret = state->val & ret;
+				VM_LEAVE_BLOCK();
+			}
+		case VM_EXP_HANDLER(EXP_OR):
+			if (stage == 2) {
+				ret = state->val | ret;
+				VM_LEAVE_BLOCK();
+			}
+		case VM_EXP_HANDLER(EXP_XOR):
+			if (stage == 2) {
+				ret = state->val ^ ret;
+				VM_LEAVE_BLOCK();
+			}
+		case VM_EXP_HANDLER(EXP_BOOL_AND):
+			if (stage == 2) {
+				ret = state->val && ret;
+				VM_LEAVE_BLOCK();
+			}
+		case VM_EXP_HANDLER(EXP_BOOL_OR):
+			if (stage == 2) {
+				ret = state->val || ret;
+				VM_LEAVE_BLOCK();
+			}
+		case VM_EXP_HANDLER(EXP_SHL):
+			if (stage == 2) {
+				ret = (ret < sizeof(word) * BITS_PER_BYTE) ? (state->val << ret) : 0;
+				VM_LEAVE_BLOCK();
+			}
+		case VM_EXP_HANDLER(EXP_SHR):
+			if (stage == 2) {
+				ret = (ret < sizeof(word) * BITS_PER_BYTE) ? (state->val >> ret) : 0;
+				VM_LEAVE_BLOCK();
+			}
 
-				/* we should never get here! */
-				VM_THROW_EXCEPTION(ERROR_PARAM);
-			break;
-			case EXP_NOT:
-				if (stage == 1) {
-					ret = ~ret;
-					VM_LEAVE_BLOCK();
-				}
-			case EXP_BOOL_NOT:
-				if (stage == 1) {
-					ret = !ret;
-					VM_LEAVE_BLOCK();
-				}
-				if (stage == 0) {
-					VM_ENTER_BLOCK(val1);
-				}
+		case VM_EXP_HANDLER(EXP_MOD):
+			if (stage == 2) {
+				ret = state->val % ret;
+				VM_LEAVE_BLOCK();
+			}
 
-				/* we should never get here! */
-				VM_THROW_EXCEPTION(ERROR_PARAM);
-			break;
-			case EXP_CALL_STRING:
-			case EXP_CALL_PTR:
-				if (stage == 0) {
-					state->val = 0;
-					if (type == EXP_CALL_STRING) {
-						ret = 0;
-						state->stage = 1;
-						stage = 1;
-					} else {
-						VM_ENTER_BLOCK(val1);
-					}
-				}
+			if (type == VM_EXP_HANDLER(EXP_BOOL_OR) && stage == 1 && ret) {
+				VM_LEAVE_BLOCK();
+			}
+			if (type == VM_EXP_HANDLER(EXP_BOOL_AND) && stage == 1 && !ret) {
+				VM_LEAVE_BLOCK();
+			}
+			if (stage == 0) {
+				VM_ENTER_BLOCK(val1);
+			} else if (stage == 1) {
+				state->val = ret;
+				VM_ENTER_BLOCK(val2);
+			}
 
-				if (stage == 1) {
-					/* if this is a EXP_CALL_PTR in this stage we got the address of the function in ret */
-					external_function = (void *)ret;
-				}
+			/* we should never get here! */
+			VM_THROW_EXCEPTION(ERROR_PARAM);
+		break;
+		case VM_EXP_HANDLER(EXP_NOT):
+			if (stage == 1) {
+				ret = ~ret;
+				VM_LEAVE_BLOCK();
+			}
+		case VM_EXP_HANDLER(EXP_BOOL_NOT):
+			if (stage == 1) {
+				ret = !ret;
+				VM_LEAVE_BLOCK();
+			}
+			if (stage == 0) {
+				VM_ENTER_BLOCK(val1);
+			}
 
-				/* in this stage we are pushing the previous argument */
-				if (stage > 1) {
-					if (NULL == stack_push(arg_stack, &ret)) {
-						ERROR_CLEAN(-ERROR_MEM);
-					}
+			/* we should never get here! */
+			VM_THROW_EXCEPTION(ERROR_PARAM);
+		break;
+		case VM_EXP_HANDLER(EXP_CALL_STRING):
+		case VM_EXP_HANDLER(EXP_CALL_PTR):
+			if (stage == 0) {
+				state->val = 0;
+				if (type == VM_EXP_HANDLER(EXP_CALL_STRING)) {
+					ret = 0;
+					state->stage = 1;
+					stage = 1;
+				} else {
+					VM_ENTER_BLOCK(val1);
 				}
+			}
 
-				if (state->func->code[pc + stage].expression.type == EXP_CALL_END) {
-					/* this is it. now all we need is to call the right function */
-					if (type == EXP_CALL_STRING) {
+			if (stage == 1) {
+				/* if this is a EXP_CALL_PTR in this stage we got the address of the function in ret */
+				external_function = (void *)ret;
+			}
 
-						if (val2 & FUNC_EXTERNAL) {
-							/* an external function. trying to find it by symbol */
+			/* in this stage we are pushing the previous argument */
+			if (stage > 1) {
+				if (NULL == stack_push(arg_stack, &ret)) {
+					ERROR_CLEAN(-ERROR_MEM);
+				}
+			}
 
-							external_function = find_external_function(state->func->raw + state->func->string_table[val1 - 1]);
-							if (NULL == external_function) {
-								DEBUG_PRINT("External \"%s\" function couldn't be found!\n", state->func->raw + state->func->string_table[val1 - 1]);
-								VM_THROW_EXCEPTION(ERROR_UFUNC);
-							}
+			if (stage == val3) {
+				/* this is it. now all we need is to call the right function */
+				if (type == VM_EXP_HANDLER(EXP_CALL_STRING)) {
 
-							/* maybe it's not an executable symbol */
-							if (!memory_check_addr_exec(external_function)) {
-								VM_THROW_EXCEPTION(ERROR_POINT);
-							}
+					if (val2 & FUNC_EXTERNAL) {
+						/* an external function. trying to find it by symbol */
 
-							DEBUG_PRINT("Calling external function: \"%s\", PC: %lx, stage: %ld\n",
-									state->func->raw + state->func->string_table[val1 - 1],
-									pc, stage);
+						external_function = context_resolve_external(state->func, val1);
+						if (NULL == external_function) {
+							DEBUG_PRINT("External \"%s\" function couldn't be found!\n", state->func->raw + state->func->string_table[val1 - 1]);
+							VM_THROW_EXCEPTION(ERROR_UFUNC);
+						}
 
-							ret = call_external_function(external_function, arg_stack, val2);
+						/* maybe it's not an executable symbol */
+						if (!memory_check_addr_exec(external_function)) {
+							VM_THROW_EXCEPTION(ERROR_POINT);
+						}
 
-							VM_LEAVE_BLOCK();
+						DEBUG_PRINT("Calling external function: \"%s\", PC: %lx, stage: %ld\n",
+								state->func->raw + state->func->string_table[val1 - 1],
+								pc, stage);
 
-						} else {
-							/* an internal function. looking for it in our context */
-							calling_function = context_find_function(state->func->cont, state->func->raw + state->func->string_table[val1 - 1]);
-							if (NULL == calling_function) {
-								if (NULL != GLOBAL_CONTEXT && state->func->cont != GLOBAL_CONTEXT) {
-									calling_function = context_find_function(GLOBAL_CONTEXT, state->func->raw + state->func->string_table[val1 - 1]);
-								}
-								if (NULL == calling_function) {
-									VM_THROW_EXCEPTION(ERROR_UFUNC);
-								}
-							}
+						ret = call_external_function(external_function, arg_stack, val2);
 
-							DEBUG_PRINT("PC: %lx, stage: %ld, Enter a VM function: %s(",
-									pc, stage, state->func->raw + state->func->string_table[val1 - 1]);
+						VM_LEAVE_BLOCK();
 
-							VM_CALL(calling_function);
+					} else {
+						/* an internal function. looking for it in our context */
+						calling_function = context_resolve_function(state->func, val1);
+						if (NULL == calling_function) {
+							VM_THROW_EXCEPTION(ERROR_UFUNC);
 						}
 
-					} else {
+						DEBUG_PRINT("PC: %lx, stage: %ld, Enter a VM function: %s(",
+								pc, stage, state->func->raw + state->func->string_table[val1 - 1]);
 
-						if (val2 & FUNC_EXTERNAL) {
-							/* this is an external function using a pointer */
+						VM_CALL(calling_function);
+					}
 
-							/* check if this is an executable memory */
-							if (!memory_check_addr_exec(external_function)) {
-								VM_THROW_EXCEPTION(ERROR_POINT);
-							}
+				} else {
 
-							DEBUG_PRINT("Calling external function: (address:%p), PC: %lx, stage: %ld\n",
-									external_function, pc, stage);
+					if (val2 & FUNC_EXTERNAL) {
+						/* this is an external function using a pointer */
 
+						/* check if this is an executable memory */
+						if (!memory_check_addr_exec(external_function)) {
+							VM_THROW_EXCEPTION(ERROR_POINT);
+						}
 
-							ret = call_external_function(external_function, arg_stack, val2);
-							VM_LEAVE_BLOCK();
+						DEBUG_PRINT("Calling external function: (address:%p), PC: %lx, stage: %ld\n",
+								external_function, pc, stage);
 
-						} else {
-							/* an internal anonymous function. looking for it in our context */
 
-							/* ok, so external_function is not really an external function, but an address of an anonymous function */
-							calling_function = context_find_anonymous(state->func->cont, external_function);
+						ret = call_external_function(external_function, arg_stack, val2);
+						VM_LEAVE_BLOCK();
+
+					} else {
+						/* an internal anonymous function. looking for it in our context */
+
+						/* ok, so external_function is not really an external function, but an address of an anonymous function */
+						calling_function = context_find_anonymous(state->func->cont, external_function);
+						if (NULL == calling_function) {
+							if (NULL != GLOBAL_CONTEXT && state->func->cont != GLOBAL_CONTEXT) {
+								calling_function = context_find_anonymous(GLOBAL_CONTEXT, external_function);
+							}
 							if (NULL == calling_function) {
-								if (NULL != GLOBAL_CONTEXT && state->func->cont != GLOBAL_CONTEXT) {
-									calling_function = context_find_anonymous(GLOBAL_CONTEXT, external_function);
-								}
-								if (NULL == calling_function) {
-									VM_THROW_EXCEPTION(ERROR_UFUNC);
-								}
+								VM_THROW_EXCEPTION(ERROR_UFUNC);
 							}
+						}
 
-							DEBUG_PRINT("PC: %lx, stage: %ld, Enter a VM Anonymous function: %p(",
-									pc, stage, calling_function);
+						DEBUG_PRINT("PC: %lx, stage: %ld, Enter a VM Anonymous function: %p(",
+								pc, stage, calling_function);
 
-							VM_CALL(calling_function);
-						}
+						VM_CALL(calling_function);
 					}
-
 				}
 
-				/* parsing the next argument */
-				VM_ENTER_BLOCK(pc + stage);
-
-			case EXP_CALL_END:
-				/* we should never get here! */
-				VM_THROW_EXCEPTION(ERROR_PARAM);
+			}
 
-			case EXP_CMP_EQ:
-			case EXP_CMP_UNSIGN:
-			case EXP_CMP_SIGN:
+			/* parsing the next argument */
+			VM_ENTER_BLOCK(pc + stage);
 
-				if (stage == 0) {
-					VM_ENTER_BLOCK(val1);
-				} else if (stage == 1) {
-					state->val = ret;
-					VM_ENTER_BLOCK(val2);
-				} else {
-					switch (type) {
-					case EXP_CMP_EQ:
-						ret = (state->val == ret);
-					break;
-					case EXP_CMP_UNSIGN:
-						ret = (state->val < ret);
-					break;
-					case EXP_CMP_SIGN:
-						ret = ((sword)state->val) < ((sword)ret);
-					break;
-					default:
-						/* we should never get here! */
-						VM_THROW_EXCEPTION(ERROR_PARAM);
-					}
+		case VM_EXP_HANDLER(EXP_CALL_END):
+			/* we should never get here! */
+			VM_THROW_EXCEPTION(ERROR_PARAM);
+
+		case VM_EXP_HANDLER(EXP_CMP_EQ):
+		case VM_EXP_HANDLER(EXP_CMP_NE):
+		case VM_EXP_HANDLER(EXP_CMP_UNSIGN):
+		case VM_EXP_HANDLER(EXP_CMP_SIGN):
+		case VM_EXP_HANDLER(EXP_CMP_LE_UNSIGN):
+		case VM_EXP_HANDLER(EXP_CMP_LE_SIGN):
+		case VM_EXP_HANDLER(EXP_CMP_GT_UNSIGN):
+		case VM_EXP_HANDLER(EXP_CMP_GT_SIGN):
+		case VM_EXP_HANDLER(EXP_CMP_GE_UNSIGN):
+		case VM_EXP_HANDLER(EXP_CMP_GE_SIGN):
+
+			if (stage == 0) {
+				VM_ENTER_BLOCK(val1);
+			} else if (stage == 1) {
+				state->val = ret;
+				VM_ENTER_BLOCK(val2);
+			} else {
+				ret = vm_compare(type, state->val, ret);
+				VM_LEAVE_BLOCK();
+			}
+		break;
 
-					VM_LEAVE_BLOCK();
+		case VM_EXP_HANDLER(EXP_DYN_ALLOC):
+			if (stage == 0) {
+				VM_ENTER_BLOCK(val1);
+			} else {
+				ret = (word)memory_alloc_dyn(val2 ? NULL : &dyn_head, ret);
+				if ((word)NULL == ret) {
+					VM_THROW_EXCEPTION(ERROR_MEM);
 				}
-			break;
 
-			case EXP_DYN_ALLOC:
-				if (stage == 0) {
-					VM_ENTER_BLOCK(val1);
-				} else {
-					ret = (word)memory_alloc_dyn(val2 ? NULL : &dyn_head, ret);
-					if ((word)NULL == ret) {
-						VM_THROW_EXCEPTION(ERROR_MEM);
-					}
+				VM_LEAVE_BLOCK();
+			}
 
-					VM_LEAVE_BLOCK();
+		case VM_EXP_HANDLER(EXP_EMIT):
+			if (stage == 0) {
+				VM_ENTER_BLOCK(val1);
+			} else if (stage == 1) {
+				state->val = ret;
+				VM_ENTER_BLOCK(val2);
+			} else {
+				/* without events rings the record is dropped */
+				rcu_read_lock();
+				events = rcu_dereference(state->func->cont->events);
+				err = (NULL == events) ? 0 : events_emit(events, (byte *)state->val, ret);
+				rcu_read_unlock();
+
+				if (err < 0) {
+					VM_THROW_EXCEPTION(-err);
 				}
+				ret = (word)err;
 
-			case EXP_ARGS:
-				ret = state->args;
 				VM_LEAVE_BLOCK();
-			break;
+			}
+		break;
 
-			case EXP_EXP:
-				if (stage == 0) {
-					VM_ENTER_BLOCK(val1);
-				} else {
-					VM_LEAVE_BLOCK();
+		case VM_EXP_HANDLER(EXP_MAP_LOOKUP):
+		case VM_EXP_HANDLER(EXP_MAP_DELETE):
+			if (stage == 0) {
+				VM_ENTER_BLOCK(val1);
+			} else if (stage == 1) {
+				state->val = ret;
+				VM_ENTER_BLOCK(val2);
+			} else {
+				rcu_read_lock();
+				map = vm_find_map(state->func->cont, (byte *)state->val);
+				if (NULL != map) {
+					if (type == VM_EXP_HANDLER(EXP_MAP_LOOKUP)) {
+						/* a missing key is 0 */
+						temp_value = 0;
+						hashmap_lookup(map, ret, &temp_value);
+						ret = temp_value;
+					} else {
+						ret = hashmap_delete(map, ret);
+					}
 				}
+				rcu_read_unlock();
 
-			break;
+				if (NULL == map) {
+					VM_THROW_EXCEPTION(ERROR_PARAM);
+				}
+				VM_LEAVE_BLOCK();
+			}
+		break;
 
-			default:
-				/* we should never get here! */
-				VM_THROW_EXCEPTION(ERROR_OP);
-			break;
+		case VM_EXP_HANDLER(EXP_ARGS):
+			ret = state->args;
+			VM_LEAVE_BLOCK();
+		break;
+
+		case VM_EXP_HANDLER(EXP_EXP):
+			if (stage == 0) {
+				VM_ENTER_BLOCK(val1);
+			} else {
+				VM_LEAVE_BLOCK();
 			}
+
 		break;
+
 		default:
 			/* we should never get here! */
 			VM_THROW_EXCEPTION(ERROR_OP);
+		break;
 		}
 	}
 
@@ -936,6 +1281,8 @@ clean:
 
 	memory_dyn_clean(&dyn_head);
 
+	PROFILE_LEAVE(func, start_time);
+
 	if (err == 0) {
 		return ret;
 	}
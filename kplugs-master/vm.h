@@ -14,8 +14,34 @@ typedef enum {
 	VM_EXPRESSION,
 } vm_ops_t;
 
+/* the handlers of the flows and the expressions keep their types */
+#define VM_FLOW_HANDLER(type) (type)
+#define VM_EXP_HANDLER(type) (FLOW_MAX + (type))
+
+/* the handlers of the vm instructions (one dense range, so the vm dispatches with a single jump) */
+typedef enum {
+	VM_HANDLER_VAR = VM_EXP_HANDLER(EXP_MAX),	/* read a word or a pointer variable */
+	VM_HANDLER_BAD_VAR,		/* a buffer or an array that is used as a value */
+	VM_HANDLER_FUNCTION,	/* the function opcode (never runs) */
+
+	VM_HANDLER_MAX,
+} vm_handlers_t;
+
+/* check if a handler calls a function */
+#define IS_CALL_HANDLER(handler) (	(handler) == VM_EXP_HANDLER(EXP_CALL_STRING) || \
+									(handler) == VM_EXP_HANDLER(EXP_CALL_PTR))
+
+/* check if a handler is a compare expression */
+#define IS_COMPARE_HANDLER(handler) ((handler) >= VM_EXP_HANDLER(0) && IS_COMPARE_EXPRESSION((handler) - VM_EXP_HANDLER(0)))
+
+/* check if a handler is a loop that "break" and "continue" can leave */
+#define IS_LOOP_HANDLER(handler) (	(handler) == VM_FLOW_HANDLER(FLOW_WHILE) || \
+									(handler) == VM_FLOW_HANDLER(FLOW_WHILE_CMP) || \
+									(handler) == VM_FLOW_HANDLER(FLOW_FOR))
+
 typedef struct {
 	byte op;
+	byte in_loop;	/* this is a loop flow and its body was entered ("break" and "continue" leave to it) */
 	word pc;
 	sword stage;
 
@@ -27,8 +53,14 @@ typedef struct {
 
 	word val;
 	word exception_handler;
+#ifdef PROFILING
+	word call_start;	/* when the function that this state calls has started */
+#endif
 } vm_state_t;
 
+/* lower the checked bytecode of a function to the vm instructions */
+int vm_lower_function(function_t *func);
+
 /* execute a function on the vm */
 word vm_run_function(function_t *func, stack_t *arg_stack, exception_t *excep);
 